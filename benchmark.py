@@ -0,0 +1,238 @@
+"""
+Benchmarks
+
+Times the parts of the fractionator that set how fast and how accurately a
+plate runs, all against the simulated backend so they can run anywhere:
+- step rate: microsteps per second of wall time through move_relative, with
+  no driver latency, which is the cost of the step loop itself
+- plates: a full 96 and 384 well run, as virtual time (how long the plate
+  would take on the instrument) and wall time (the cost of the run logic),
+  and a 96 well run in continuous flow
+- pump jitter: how far the time the pump is open strays from the pump time,
+  timed on the real clock
+- canvas: the cost of updating one well on the plate view, when Tk has a
+  display to draw on
+
+Results are saved as JSON, and compared against a saved baseline:
+
+	python benchmark.py --save baseline.json
+	python benchmark.py --baseline baseline.json
+
+A metric that is worse than the baseline by more than the tolerance counts
+as a regression, and the exit status is 1 if there are any.
+"""
+import argparse
+import json
+import platform
+import sys
+from time import perf_counter
+
+from hardware import SimBackend, RealClock, SimPump
+from motor import StepperMotor, NEMA_17_STEPS_PER_DEGREE, LEAD_SCREW_PITCH_IN_CM
+from motion import TABLE_PROFILE
+from gantry import open_gantry
+from loop import HeadlessLoop
+from dispenser import Dispenser
+from fractionation import make_fractionation
+from cycle import WellCycle, FlowCycle
+from wellplan import WellPlan
+from labware import Labware
+from profiler import percentile
+
+# Runs of each timing benchmark, keeping the best
+REPEATS = 3
+
+# Allowed change for the worse before a metric counts as a regression
+TOLERANCE = 0.1
+
+# Pump settings for the plate benchmarks: 0.5 cc at 360 cc/hr, which is a
+# drop every half second
+PLATE_PUMP_TIME = 5.0
+PLATE_DROP_INTERVAL = 0.5
+
+# Number and length of dispenses for the pump jitter benchmark
+JITTER_DISPENSES = 50
+JITTER_PUMP_TIME = 0.02
+
+# Differences in pump timing smaller than this are scheduler noise
+JITTER_NOISE = 0.0005
+
+# Build a metric, saying whether a higher or lower value is better
+# Changes smaller than noise never count as a regression
+def metric(value, unit, better, noise=0.0):
+	return {"value": value, "unit": unit, "better": better, "noise": noise}
+
+# Microsteps per second through move_relative, with and without hybrid
+# stepping, back and forth over 10 cm
+def bench_step_rate(hybrid):
+	backend = SimBackend(step_latency=0.0)
+	motor = StepperMotor(1, NEMA_17_STEPS_PER_DEGREE, LEAD_SCREW_PITCH_IN_CM, True, backend, TABLE_PROFILE, "table", hybrid)
+	angle = 10.0 / motor.cm_per_deg
+	best = 0.0
+	steps = 2 * round(angle * motor.steps_per_degree)
+	for _ in range(REPEATS):
+		start = perf_counter()
+		motor.move_relative(angle)
+		motor.move_relative(-angle)
+		best = max(best, steps / (perf_counter() - start))
+	return best
+
+# Run a whole plate headless and return (virtual seconds, wall seconds)
+def bench_plate(rows, cols, well_size, cycle):
+	best = None
+	for _ in range(REPEATS):
+		backend = SimBackend()
+		gantry = open_gantry(backend)
+		loop = HeadlessLoop(backend.clock, gantry.motion)
+		dispenser = Dispenser(backend.pump(), backend.clock)
+		loop.add_worker(dispenser.worker)
+
+		geometry = Labware.uniform(rows, cols, well_size, gantry.position())
+		plan = WellPlan(geometry.ordering, None, "serpentine", geometry.distance)
+		run = make_fractionation(loop, gantry, dispenser, backend.clock, geometry, plan, cycle)
+
+		start = perf_counter()
+		run.start()
+		loop.run_until(run.is_over)
+		elapsed = perf_counter() - start
+		dispenser.shutdown()
+		gantry.shutdown()
+
+		if best is None or elapsed < best[1]:
+			best = (backend.clock.now(), elapsed)
+	return best
+
+# Error in the time the pump is open, in seconds: (mean, 99th percentile)
+# of the absolute error, from the steadiest of a few rounds of dispenses
+def bench_pump_jitter():
+	clock = RealClock()
+	dispenser = Dispenser(SimPump(clock), clock)
+
+	# Let the wake margin settle first
+	dispenser.dispense(JITTER_PUMP_TIME)
+	dispenser.worker.results.get()
+
+	best = None
+	for _ in range(REPEATS):
+		errors = []
+		for _ in range(JITTER_DISPENSES):
+			dispenser.dispense(JITTER_PUMP_TIME)
+			dispenser.worker.results.get()
+			errors.append(abs(dispenser.open_time - JITTER_PUMP_TIME))
+		errors.sort()
+		result = (sum(errors) / len(errors), percentile(errors, 0.99))
+		if best is None or result[1] < best[1]:
+			best = result
+	dispenser.shutdown()
+	return best
+
+# Seconds to update one well of a 384 well plate view and draw it, or None
+# if Tk has no display
+def bench_canvas():
+	try:
+		import tkinter as tk
+		root = tk.Tk()
+	except Exception:
+		return None
+	from plate_view import PlateView
+	try:
+		canvas = tk.Canvas(root, width=500, height=300)
+		canvas.pack()
+		view = PlateView(canvas, 500, 300)
+		view.reset(16, 24, "black")
+		root.update()
+		best = None
+		for fill in ("green", "blue", "black")[:REPEATS]:
+			start = perf_counter()
+			for x in range(24):
+				for y in range(16):
+					view.set_well(x, y, fill)
+			view.flush()
+			root.update()
+			elapsed = (perf_counter() - start) / (16 * 24)
+			best = elapsed if best is None else min(best, elapsed)
+		return best
+	finally:
+		root.destroy()
+
+def run_benchmarks(log=print):
+	metrics = {}
+
+	log("Step rate...")
+	metrics["step_rate"] = metric(bench_step_rate(False), "steps/s", "higher")
+	metrics["step_rate_hybrid"] = metric(bench_step_rate(True), "steps/s", "higher")
+
+	plates = (
+		("plate_96", 8, 12, 0.9, WellCycle(PLATE_PUMP_TIME)),
+		("plate_384", 16, 24, 0.45, WellCycle(PLATE_PUMP_TIME)),
+		("plate_96_flow", 8, 12, 0.9, FlowCycle(PLATE_PUMP_TIME, PLATE_DROP_INTERVAL)),
+	)
+	for name, rows, cols, well_size, cycle in plates:
+		log("%s..." % name)
+		virtual, wall = bench_plate(rows, cols, well_size, cycle)
+		metrics[name + "_virtual"] = metric(virtual, "s", "lower")
+		metrics[name + "_wall"] = metric(wall, "s", "lower")
+
+	log("Pump jitter...")
+	mean, p99 = bench_pump_jitter()
+	metrics["pump_jitter_mean"] = metric(mean, "s", "lower", JITTER_NOISE)
+	metrics["pump_jitter_p99"] = metric(p99, "s", "lower", JITTER_NOISE)
+
+	log("Canvas...")
+	per_well = bench_canvas()
+	if per_well is not None:
+		metrics["canvas_per_well"] = metric(per_well, "s", "lower")
+	else:
+		log("  skipped, Tk has no display")
+
+	return {
+		"environment": {"python": platform.python_version(), "machine": platform.machine(), "system": platform.system()},
+		"metrics": metrics,
+	}
+
+# Compare results against a baseline
+# Returns lines for a report and the names of metrics that got worse by
+# more than the tolerance
+def compare(results, baseline, tolerance=TOLERANCE):
+	lines = []
+	regressions = []
+	for name, current in results["metrics"].items():
+		text = "%-20s %14.6g %-8s" % (name, current["value"], current["unit"])
+		base = baseline["metrics"].get(name)
+		if base is not None and base["value"]:
+			change = (current["value"] - base["value"]) / abs(base["value"])
+			worse = -change if current["better"] == "higher" else change
+			text += " %+7.1f%% vs %.6g" % (100 * change, base["value"])
+			if worse > tolerance and abs(current["value"] - base["value"]) > current.get("noise", 0.0):
+				text += "  REGRESSION"
+				regressions.append(name)
+		lines.append(text)
+	return lines, regressions
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Benchmark the fractionator on the simulated hardware")
+	parser.add_argument("--save", metavar="FILE", help="save the results as JSON")
+	parser.add_argument("--baseline", metavar="FILE", help="compare against results saved earlier")
+	parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="allowed change for the worse (default: %(default)s)")
+	args = parser.parse_args(argv)
+
+	results = run_benchmarks()
+	baseline = {"metrics": {}}
+	if args.baseline:
+		with open(args.baseline) as f:
+			baseline = json.load(f)
+
+	lines, regressions = compare(results, baseline, args.tolerance)
+	print("\n".join(lines))
+
+	if args.save:
+		with open(args.save, "w") as f:
+			json.dump(results, f, indent=1)
+
+	if regressions:
+		print("Regressions: " + ", ".join(regressions))
+		return 1
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,37 @@
+"""
+Calibration
+
+Values measured on the instrument itself rather than taken from a
+datasheet, kept on disk so they only need measuring once: the backlash of
+each axis in microsteps, found while homing, and the travel of each axis
+in cm from its home switch, as {"table": [low, high], ...}, and the flow
+the pump really delivers (see flow.py).
+
+The file is a JSON object with one entry per kind of calibration, so each
+can be saved without touching the others.
+"""
+import json
+import os
+
+# Where the calibration is kept between runs
+CALIBRATION_PATH = os.path.join(os.path.expanduser("~"), ".local", "share", "robotic-fractionator", "calibration.json")
+
+# Everything saved so far, or nothing if nothing has been calibrated
+def load_calibration(path=CALIBRATION_PATH):
+	if not os.path.exists(path):
+		return {}
+	with open(path) as f:
+		return json.load(f)
+
+# Save one kind of calibration, keeping the rest
+# Like the job queue, the file is replaced only once the new one is on disk
+def save_calibration(name, value, path=CALIBRATION_PATH):
+	data = load_calibration(path)
+	data[name] = value
+	os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+	temp_path = path + ".tmp"
+	with open(temp_path, "w") as f:
+		json.dump(data, f, indent=1)
+		f.flush()
+		os.fsync(f.fileno())
+	os.replace(temp_path, path)
@@ -0,0 +1,84 @@
+"""
+WellCycle Class
+
+Timing for one well of an automated fractionation. The pump is on for
+pump_time. Once it turns off, drops keep falling from the needle for the
+settle time, so the needle stays over the well until then. After that it is
+free to travel to the next well while the rest of the dwell time runs out,
+and the pump only turns on again once both the move and the dwell are over.
+
+Leaving the settle and dwell times out gives the original cycle, where the
+pump is off for as long as it was on before the needle moves.
+"""
+
+class WellCycle:
+	continuous = False
+
+	def __init__(self, pump_time, settle_time=None, dwell_time=None):
+		self.pump_time = pump_time
+		self.settle_time = pump_time if settle_time is None else settle_time
+		self.dwell_time = pump_time if dwell_time is None else dwell_time
+
+		# The needle can never leave before the dwell is over
+		self.settle_time = min(self.settle_time, self.dwell_time)
+
+	# Seconds after the pump turns off before the needle can move
+	def move_delay(self):
+		return self.settle_time
+
+	# Seconds still to wait before the pump can turn on again, given when it
+	# last turned off and the current time
+	def pump_delay(self, off_time, now):
+		return max(0.0, off_time + self.dwell_time - now)
+
+	# Shortest possible time for one well, given how long the move takes
+	def period(self, move_time):
+		return self.pump_time + max(self.dwell_time, self.settle_time + move_time)
+
+"""
+FlowCycle Class
+
+Timing for a continuous flow run, where the pump stays on from the first
+well to the last and each well gets the flow for pump_time. The needle
+leaves a well once it has had its share, timed from when the flow started.
+
+Liquid leaves the needle as drops, one every drop_interval. When a move is
+short enough to fit between two drops, it starts just after the drop
+nearest the end of the well's share, so nothing falls on the way and the
+drop that is forming is carried to the next well. Longer moves straddle the
+end of the share, so the wells either side split what falls on the way.
+Drops are taken to fall at even intervals from when the flow started.
+
+The flow is taken to start lag seconds after the pump turns on, once liquid
+reaches the needle, and again after each pause.
+"""
+
+# Volume of one drop from the needle in cc
+DROP_VOLUME = 0.05
+
+class FlowCycle:
+	continuous = True
+
+	def __init__(self, pump_time, drop_interval=None, lag=0.0):
+		self.pump_time = pump_time
+		self.drop_interval = drop_interval
+		self.lag = lag
+
+	# Seconds after the flow started at which the needle should leave the
+	# well, once a number of wells have had their share, for a move that
+	# takes move_time (None if there is no move to make)
+	def departure(self, wells, move_time=None):
+		end = wells * self.pump_time
+		if move_time is None:
+			return end
+		gap = self.drop_interval
+		if gap is None or move_time >= gap:
+			return end - move_time / 2
+
+		# Move in the middle of the gap after the drop nearest the end
+		drop = round(end / gap) * gap
+		return drop + (gap - move_time) / 2
+
+	# Time for one well, which moves do not add to
+	def period(self, move_time):
+		return self.pump_time
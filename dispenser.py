@@ -0,0 +1,97 @@
+"""
+Dispenser Class
+
+Runs the pump for a set time on its own thread. The pump turns on and the
+thread then waits for an absolute deadline on the monotonic clock, so the
+time the pump is open does not depend on how busy the event loop is, is not
+rounded to whole milliseconds, and is not stretched by anything else that
+happens to be running when it should turn off.
+
+Sleeps tend to end a little late, so the thread wakes up early by about as
+much as recent sleeps have overslept and waits out the last moment in a
+tight loop. The time the pump was actually open is kept after every
+dispense.
+
+The pump's FlowModel (see flow.py), from the calibration if it has been
+measured, is kept with it so runs can time the pump by what it delivers.
+"""
+from worker import MotionWorker
+from flow import FlowModel
+
+# Longest single sleep, so that a cancel is noticed quickly
+CANCEL_CHECK_INTERVAL = 0.05
+
+# Starting value, upper limit and smoothing of the early wake up
+WAKE_MARGIN = 0.001
+MAX_WAKE_MARGIN = 0.005
+WAKE_MARGIN_SMOOTHING = 0.2
+
+class Dispenser:
+	def __init__(self, pump, clock, flow=None):
+		self.pump = pump
+		self.clock = clock
+		self.flow = flow if flow is not None else FlowModel()
+
+		# Dispenses run one at a time on their own worker, which is
+		# polled by the event loop just like the motion worker
+		self.worker = MotionWorker(clock.virtual)
+		self.wake_margin = WAKE_MARGIN
+
+		# Times of the last pump edges and how long it was open
+		self.on_time = None
+		self.off_time = float("-inf")
+		self.open_time = 0.0
+
+	# Turn the pump on for a number of seconds
+	# on_done is called from the event loop with True if the pump ran for
+	# the full time, or False if it was cancelled
+	def dispense(self, seconds, on_done=None):
+		self.worker.submit(lambda cancel: self.run(seconds, cancel), on_done)
+
+	# Turn the pump off straight away if it is dispensing
+	def cancel(self):
+		self.worker.cancel()
+
+	# Wait for the last dispense and shut the thread down, leaving the
+	# pump off
+	def shutdown(self):
+		self.worker.stop()
+		self.pump.off()
+
+	def run(self, seconds, cancel):
+		self.pump.on()
+		self.on_time = self.clock.now()
+		try:
+			return self.wait_until(self.on_time + seconds, cancel)
+		finally:
+			self.pump.off()
+			self.off_time = self.clock.now()
+			self.open_time = self.off_time - self.on_time
+
+	# Wait for a deadline, returning False if cancelled first
+	def wait_until(self, deadline, cancel):
+		clock = self.clock
+		if clock.virtual:
+			clock.sleep_until(deadline)
+			return True
+
+		# Sleep until just before the deadline
+		while not cancel.is_set():
+			now = clock.now()
+			wake = deadline - self.wake_margin
+			if now >= wake:
+				break
+			target = min(wake, now + CANCEL_CHECK_INTERVAL)
+			cancel.wait(target - now)
+
+			# Learn how late the last sleep before the deadline ended
+			if target == wake:
+				late = max(0.0, clock.now() - target)
+				margin = (1 - WAKE_MARGIN_SMOOTHING) * self.wake_margin + WAKE_MARGIN_SMOOTHING * late
+				self.wake_margin = min(MAX_WAKE_MARGIN, margin)
+
+		# Then wait out the rest without giving up the processor
+		while clock.now() < deadline:
+			if cancel.is_set():
+				return False
+		return not cancel.is_set()
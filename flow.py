@@ -0,0 +1,105 @@
+"""
+Flow calibration
+
+The rate typed in for a job is what the pump is set to, but what reaches
+the wells drifts from it with the tubing and the back-pressure, and the
+liquid takes a moment to reach the tip of the needle after the pump turns
+on. A FlowModel measured on the instrument corrects both, so each well gets
+its volume with the pump open no longer than it has to be.
+
+Calibrating runs the pump for a few shots of different lengths into a tube
+under the needle, and the volume of each is measured, by weighing the tube
+or reading it off the graduations. A straight line through the shots gives
+the real flow (its slope) and the start-up lag (where it crosses zero
+volume). The flow is kept as a gain on the rate the pump was set to, so the
+same model holds when the pump is set to another rate.
+"""
+
+# Lengths of the calibration shots in seconds
+FLOW_SHOTS = (5.0, 10.0, 20.0)
+
+# Density of water in g/cc, for weighed shots
+WATER_DENSITY = 1.0
+
+"""
+FlowModel Class
+
+Delivered flow as a gain on the rate the pump is set to, and the lag in
+seconds between the pump turning on and liquid leaving the needle. The
+default model takes the pump at its word.
+"""
+
+class FlowModel:
+	def __init__(self, gain=1.0, lag=0.0):
+		self.gain = gain
+		self.lag = lag
+
+	# Model saved in the calibration, or the default one if there is none
+	@classmethod
+	def from_dict(cls, data):
+		if not data:
+			return cls()
+		return cls(data["gain"], data["lag"])
+
+	def to_dict(self):
+		return {"gain": self.gain, "lag": self.lag}
+
+	# Rate in cc/hr that reaches the wells with the pump set to nominal
+	def rate(self, nominal):
+		return self.gain * nominal
+
+	# Seconds of flow that deliver a volume in cc, once liquid is flowing
+	def flow_time(self, volume, nominal):
+		return volume / (self.rate(nominal) / 3600)
+
+	# Shortest time the pump must be open to deliver a volume in cc
+	def open_time(self, volume, nominal):
+		return self.lag + self.flow_time(volume, nominal)
+
+	# Volume in cc delivered over seconds, with the start-up lag taken off
+	# unless liquid was already flowing
+	def volume(self, seconds, nominal, flowing=False):
+		if not flowing:
+			seconds = max(0.0, seconds - self.lag)
+		return seconds * self.rate(nominal) / 3600
+
+	def describe(self):
+		return "Flow %.1f%% of the pump setting, %.3f s start-up lag" % (100 * self.gain, self.lag)
+
+# Run the pump for one calibration shot, returning how long it was
+# actually open
+# Raises RuntimeError if the shot was cut short
+def dispense_shot(loop, dispenser, seconds):
+	done = []
+	dispenser.dispense(seconds, done.append)
+	loop.run_until(lambda: done)
+	if not done[0]:
+		raise RuntimeError("The shot was cut short")
+	return dispenser.open_time
+
+# Fit a FlowModel to shots of (seconds open, cc delivered) with the pump
+# set to a nominal rate in cc/hr
+# A fit that puts liquid at the needle before the pump turns on is only
+# noise in the measurements, so the line is then taken through zero
+# Raises ValueError if the shots cannot give a flow
+def fit_flow_model(nominal, shots):
+	times = [seconds for seconds, volume in shots]
+	if len(set(times)) < 2:
+		raise ValueError("Calibration needs shots of at least two different lengths")
+	n = len(shots)
+	mean_time = sum(times) / n
+	mean_volume = sum(volume for seconds, volume in shots) / n
+	spread = sum((seconds - mean_time) ** 2 for seconds in times)
+	slope = sum((seconds - mean_time) * (volume - mean_volume) for seconds, volume in shots) / spread
+	if slope <= 0:
+		raise ValueError("Longer shots did not deliver more, check the measurements")
+	lag = mean_time - mean_volume / slope
+	if lag < 0:
+		slope = sum(seconds * volume for seconds, volume in shots) / sum(seconds * seconds for seconds in times)
+		lag = 0.0
+	return FlowModel(slope * 3600 / nominal, lag)
+
+# Largest difference in cc between the shots and what a model says they
+# should have delivered
+def fit_error(model, nominal, shots):
+	return max(abs(volume - model.volume(seconds, nominal)) for seconds, volume in shots)
@@ -0,0 +1,325 @@
+"""
+Fractionation Class
+
+One automated run over a plate: for each well in the plan the needle moves
+to the well, the pump runs for the pump time, and then the pump stays off
+while drops settle before moving on (see WellCycle). Once every well is
+done the needle returns to the starting position.
+
+The run only uses an event loop (TkLoop or HeadlessLoop) for timing, the
+gantry for moves and a Dispenser for the pump, so the same sequence drives
+the GUI and headless runs. The time the pump was actually open over each
+well is kept in open_times.
+Listeners are called as listener(event, run) with one of these events:
+- "move": heading to the well at plan_index
+- "arrived": the needle reached the current well
+- "pump": the pump turned on over the current well
+- "done": the pump turned off over the current well
+- "paused" / "resumed": the run was paused or carried on
+- "return": heading back to the start after the last well
+- "finished": every well is done and the needle is back at the start
+- "stopped": the run was abandoned
+"""
+
+class Fractionation:
+	def __init__(self, loop, gantry, dispenser, clock, geometry, plan, cycle):
+		self.loop = loop
+		self.gantry = gantry
+		self.dispenser = dispenser
+		self.pump = dispenser.pump
+		self.clock = clock
+		self.geometry = geometry
+		self.plan = plan
+		self.cycle = cycle
+		self.listeners = []
+
+		self.state = "idle"
+		self.is_paused = False
+		self.plan_index = -1
+		self.wells_done = 0
+		self.move_target = None
+		self.task = None
+		self.pump_off_time = float("-inf")
+		self.open_times = {}
+
+		# The compiled Schedule, to follow the run against (see schedule.py),
+		# and when the run began
+		self.schedule = None
+		self.start_time = None
+
+	def emit(self, event):
+		for listener in self.listeners:
+			listener(event, self)
+
+	# Grid position (column, row) of the current well
+	def position(self):
+		return self.plan.position(self.plan_index)
+
+	# Name of the current well
+	def well(self):
+		return self.plan.wells[self.plan_index]
+
+	# Whether the run has come to an end
+	def is_over(self):
+		return self.state in ("finished", "stopped")
+
+	# Begin by going to the first well in the plan, or to a later well when
+	# carrying on an earlier run
+	def start(self, index=0):
+		self.start_time = self.clock.now()
+		self.plan_index = index - 1
+		self.wells_done = index
+		self.move()
+
+	# Cancel what is happening right now and force the pump off
+	def pause(self):
+		if self.is_paused or self.is_over():
+			return
+		self.is_paused = True
+		if self.task is not None:
+			self.loop.cancel(self.task)
+			self.task = None
+		self.dispenser.cancel()
+		self.pump.off()
+
+		# Stop the motors between steps if they are moving
+		self.gantry.cancel()
+		self.emit("paused")
+
+	# Based on the current state, go to the next step in the
+	# fractionation process
+	def resume(self):
+		if not self.is_paused:
+			return
+		self.is_paused = False
+		self.emit("resumed")
+
+		if self.state == "pump":
+			self.stop_pump()
+		elif self.state == "wait":
+			self.move()
+		elif self.state == "dwell":
+			self.pump_liquid()
+		elif self.state == "move":
+			self.gantry.move_to(*self.move_target, self.move_finished)
+		elif self.state == "return":
+			self.carriage_return()
+
+	# Abandon the run, leaving the pump off
+	def stop(self):
+		if self.is_over():
+			return
+		if self.task is not None:
+			self.loop.cancel(self.task)
+			self.task = None
+		self.dispenser.cancel()
+		self.pump.off()
+		self.gantry.cancel()
+		self.state = "stopped"
+		self.emit("stopped")
+
+	# Move to the next well in the plan
+	def move(self):
+		self.state = "move"
+		self.plan_index = self.plan_index + 1
+
+		# If there are no more wells, return to the starting position
+		if self.plan_index == len(self.plan):
+			self.carriage_return()
+			return
+
+		# Remember where we are heading so a paused move can be finished
+		self.move_target = self.geometry.position(self.well())
+		self.emit("move")
+		self.gantry.move_to(*self.move_target, self.move_finished)
+
+	# Carry on once the needle has reached the next well
+	def move_finished(self, completed):
+		# If paused during the motor movement, then stop here
+		if not completed or self.is_paused or self.is_over():
+			return
+		self.emit("arrived")
+
+		# The move may have been quicker than the rest of the dwell
+		delay = self.cycle.pump_delay(self.pump_off_time, self.clock.now())
+		if delay > 0:
+			self.state = "dwell"
+			self.task = self.loop.call_later(delay, self.pump_liquid)
+		else:
+			self.pump_liquid()
+
+	# Turn on the pump for the time specified by the desired volume
+	# The dispenser times the pump on its own thread
+	def pump_liquid(self):
+		self.state = "pump"
+		self.emit("pump")
+		self.dispenser.dispense(self.cycle.pump_time, self.dispensed)
+
+	def dispensed(self, completed):
+		# If paused while the pump was on, then stop here
+		if not completed or self.is_paused or self.is_over():
+			return
+		self.stop_pump()
+
+	# Make sure the pump is off and wait for drops to settle to prevent
+	# them from entering other wells
+	def stop_pump(self):
+		self.state = "wait"
+		self.pump.off()
+		self.pump_off_time = self.dispenser.off_time
+		self.open_times[self.plan_index] = self.dispenser.open_time
+		self.wells_done += 1
+		self.emit("done")
+
+		# The rest of the dwell overlaps with the move to the next well
+		# Timed from when the pump actually turned off, so any delay in
+		# getting here does not add up over the plate
+		delay = max(0.0, self.pump_off_time + self.cycle.move_delay() - self.clock.now())
+		self.task = self.loop.call_later(delay, self.move)
+
+	# Return the needle to the starting position
+	def carriage_return(self):
+		self.state = "return"
+		self.emit("return")
+		self.gantry.move_to(0.0, 0.0, self.returned)
+
+	def returned(self, completed):
+		if not completed or self.is_paused or self.is_over():
+			return
+		self.state = "finished"
+		self.emit("finished")
+
+"""
+FlowFractionation Class
+
+A run in continuous flow (see FlowCycle). The pump turns on once the needle
+reaches the first well and stays on, and the needle moves on each time the
+current well has had its share. Departures are timed from when the flow
+started rather than from the last well, so timing errors do not add up over
+the plate, and the time the flow was paused is added back on.
+
+How long the next move will take is estimated from the motion profiles and
+scaled by how long moves have really been taking, so the move lands where
+the FlowCycle wants it.
+
+Events are the same as for Fractionation, with "pump" once the needle is
+over a well with the pump on and "done" when it leaves. open_times holds
+the time the flow went to each well: from leaving the well before to
+leaving this one.
+"""
+
+# Weight of the latest move when learning how long moves really take
+MOVE_TIME_SMOOTHING = 0.3
+
+class FlowFractionation(Fractionation):
+	def __init__(self, loop, gantry, dispenser, clock, geometry, plan, cycle):
+		super().__init__(loop, gantry, dispenser, clock, geometry, plan, cycle)
+		self.first = 0
+		self.flow_start = None
+		self.paused_at = None
+		self.departed = None
+
+		# Start and estimated length of the current move, and how much
+		# longer than estimated moves are taking
+		self.move_start = None
+		self.planned_move = 0.0
+		self.move_scale = 1.0
+
+	def start(self, index=0):
+		self.first = index
+		super().start(index)
+
+	# Note when the flow stopped, so the wells after it are not short
+	def pause(self):
+		if self.is_paused or self.is_over():
+			return
+		if self.flow_start is not None and self.paused_at is None:
+			self.paused_at = self.clock.now()
+		super().pause()
+
+	def resume(self):
+		if not self.is_paused:
+			return
+		self.is_paused = False
+		self.emit("resumed")
+
+		if self.state == "pump":
+			self.flow_on()
+			self.schedule_departure()
+		elif self.state == "move":
+			# Only part of the move is left, so it says nothing about
+			# how long moves take
+			self.move_start = None
+			self.gantry.move_to(*self.move_target, self.move_finished)
+		elif self.state == "return":
+			self.carriage_return()
+
+	# Turn the pump on, starting the flow the first time and catching up
+	# with the pause after that
+	# The flow only reaches the needle once the start-up lag is over
+	def flow_on(self):
+		self.pump.on()
+		now = self.clock.now() + self.cycle.lag
+		if self.flow_start is None:
+			self.flow_start = self.departed = now
+		elif self.paused_at is not None:
+			self.flow_start += now - self.paused_at
+			self.departed += now - self.paused_at
+		self.paused_at = None
+
+	def move(self):
+		index = self.plan_index + 1
+		if index < len(self.plan):
+			self.planned_move = self.gantry.move_time(*self.geometry.position(self.plan.wells[index]))
+			self.move_start = self.clock.now()
+		super().move()
+
+	def move_finished(self, completed):
+		if not completed or self.is_paused or self.is_over():
+			return
+		if self.move_start is not None and self.planned_move > 0:
+			measured = self.clock.now() - self.move_start
+			self.move_scale += MOVE_TIME_SMOOTHING * (measured / self.planned_move - self.move_scale)
+		self.move_start = None
+		self.emit("arrived")
+
+		self.flow_on()
+		self.state = "pump"
+		self.emit("pump")
+		self.schedule_departure()
+
+	# Wait until the current well has had its share
+	def schedule_departure(self):
+		index = self.plan_index + 1
+		move_time = None
+		if index < len(self.plan):
+			move_time = self.move_scale * self.gantry.move_time(*self.geometry.position(self.plan.wells[index]))
+		departure = self.flow_start + self.cycle.departure(self.plan_index - self.first + 1, move_time)
+		self.task = self.loop.call_later(max(0.0, departure - self.clock.now()), self.depart)
+
+	# Leave the current well for the next, turning the pump off after the
+	# last one
+	def depart(self):
+		self.task = None
+		if self.plan_index == len(self.plan) - 1:
+			self.pump.off()
+			self.pump_off_time = self.clock.now()
+		now = self.clock.now()
+		self.open_times[self.plan_index] = now - self.departed
+		self.departed = now
+		self.wells_done += 1
+		self.state = "wait"
+		self.emit("done")
+		self.move()
+
+	def carriage_return(self):
+		self.pump.off()
+		super().carriage_return()
+
+# Build the run for a cycle, in continuous flow for a FlowCycle, along with
+# its compiled schedule if there is one
+def make_fractionation(loop, gantry, dispenser, clock, geometry, plan, cycle, schedule=None):
+	kind = FlowFractionation if cycle.continuous else Fractionation
+	run = kind(loop, gantry, dispenser, clock, geometry, plan, cycle)
+	run.schedule = schedule
+	return run
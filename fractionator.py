@@ -0,0 +1,568 @@
+"""
+Command line runner
+
+Runs a fractionation without the GUI, for scripted and unattended runs:
+
+	python -m fractionator run --labware custom_96_well_plate.json --rate 360 --volume 0.5
+	python -m fractionator run --rows 8 --cols 12 --well-size 0.9 --rate 360 --volume 0.5 --simulate
+	python -m fractionator run --labware custom_96_well_plate.json --rate 360 --volume 0.5 --dry-run
+	python -m fractionator queue add --labware custom_96_well_plate.json --rate 360 --volume 0.5 --hold 120
+	python -m fractionator queue run
+	python -m fractionator resume
+	python -m fractionator report --wells
+	python -m fractionator home --calibrate-backlash
+	python -m fractionator calibrate-flow --rate 360 --gravimetric
+	python -m fractionator instruments --serve 8765
+	python -m fractionator gui --simulate
+
+Tkinter and the hardware libraries are only imported when they are used, so
+a headless run never touches a display and a simulated run needs neither
+the Raspberry Pi libraries nor Tk.
+"""
+import argparse
+import os
+import sys
+import threading
+
+from hardware import make_backend
+from gantry import open_gantry
+from loop import HeadlessLoop
+from fractionation import make_fractionation
+from dispenser import Dispenser
+from jobs import Job, JobQueue, JobRunner, JOB_QUEUE_PATH
+from journal import RunJournal, read_journal, RUN_JOURNAL_PATH
+from runlog import RunLog, read_run_log, latest_run_log, run_report, RUN_LOG_DIR
+from calibration import load_calibration, save_calibration, CALIBRATION_PATH
+from flow import FlowModel, FLOW_SHOTS, WATER_DENSITY, dispense_shot, fit_flow_model, fit_error
+from telemetry import Telemetry, TelemetryServer, TELEMETRY_HOST
+from schedule import compile_run
+from instrument import load_instruments, instrument_files, INSTRUMENTS_PATH
+from wellplan import ORDERS
+from profiler import StepProfiler
+
+# Options that describe a plate, shared by run and queue add
+def add_job_arguments(parser):
+	parser.add_argument("--labware", help="Opentrons labware definition (JSON)")
+	parser.add_argument("--rows", type=int, help="number of rows, without --labware")
+	parser.add_argument("--cols", type=int, help="number of columns, without --labware")
+	parser.add_argument("--well-size", type=float, help="well size in cm, without --labware")
+	parser.add_argument("--rate", type=float, required=True, help="pump rate in cc/hr")
+	parser.add_argument("--volume", type=float, required=True, help="volume per well in cc")
+	parser.add_argument("--settle", type=float, help="drip settle time in s (default: pump time)")
+	parser.add_argument("--dwell", type=float, help="dwell time in s (default: pump time)")
+	parser.add_argument("--wells", default="", help="wells to fill, e.g. A1-H6,A7 (default: all)")
+	parser.add_argument("--order", choices=ORDERS, default=ORDERS[0], help="visiting order")
+	parser.add_argument("--continuous", action="store_true", help="keep the pump on and move between wells in the flow")
+
+# Options for anything that drives the hardware
+def add_hardware_arguments(parser):
+	parser.add_argument("--simulate", action="store_true", help="use the simulated hardware")
+	parser.add_argument("--profile-steps", metavar="FILE", help="save step timing as CSV or JSON")
+	parser.add_argument("--journal", default=RUN_JOURNAL_PATH, help="run journal (default: %(default)s)")
+	parser.add_argument("--log-dir", default=RUN_LOG_DIR, help="where to log every run (default: %(default)s)")
+	parser.add_argument("--binary-log", action="store_true", help="also log runs in the binary columnar format")
+	parser.add_argument("--home", action="store_true", help="home both axes against the limit switches first")
+	parser.add_argument("--serve", type=int, metavar="PORT", help="serve the run state and controls over HTTP and WebSocket")
+	parser.add_argument("--serve-host", default=TELEMETRY_HOST, help="address to serve on (default: %(default)s)")
+
+def parse_args(argv):
+	parser = argparse.ArgumentParser(prog="fractionator", description="Robotic fractionator")
+	commands = parser.add_subparsers(dest="command", required=True)
+
+	run = commands.add_parser("run", help="run a fractionation without the GUI")
+	add_job_arguments(run)
+	add_hardware_arguments(run)
+	run.add_argument("--quiet", action="store_true", help="only print the summary")
+	run.add_argument("--dry-run", action="store_true", help="print the timed plan on the simulated hardware and stop")
+
+	resume = commands.add_parser("resume", help="carry on a run that was cut short")
+	add_hardware_arguments(resume)
+	resume.add_argument("--skip-interrupted", action="store_true", help="skip the well the pump was on over")
+	resume.add_argument("--file", default=JOB_QUEUE_PATH, help="queue file (default: %(default)s)")
+	resume.add_argument("--quiet", action="store_true", help="only print the summary")
+
+	queue = commands.add_parser("queue", help="manage and run the job queue")
+	queue.add_argument("--file", default=JOB_QUEUE_PATH, help="queue file (default: %(default)s)")
+	queue.add_argument("--instrument", metavar="NAME", help="use the queue of one of several instruments instead of --file")
+	actions = queue.add_subparsers(dest="action", required=True)
+	add = actions.add_parser("add", help="add a plate to the end of the queue")
+	add_job_arguments(add)
+	add.add_argument("--hold", type=float, help="seconds to hold before this plate (default: wait for Enter)")
+	actions.add_parser("list", help="show the queued jobs")
+	remove = actions.add_parser("remove", help="remove a job")
+	remove.add_argument("id", type=int)
+	actions.add_parser("clear", help="remove every job that is over")
+	queue_run = actions.add_parser("run", help="run the pending jobs back to back")
+	add_hardware_arguments(queue_run)
+	queue_run.add_argument("--quiet", action="store_true", help="only print job changes")
+
+	report = commands.add_parser("report", help="report on a logged run")
+	report.add_argument("path", nargs="?", help="run log, CSV or binary (default: the newest in --log-dir)")
+	report.add_argument("--log-dir", default=RUN_LOG_DIR, help="where runs are logged (default: %(default)s)")
+	report.add_argument("--wells", action="store_true", help="list every well")
+
+	home = commands.add_parser("home", help="home both axes against the limit switches")
+	add_hardware_arguments(home)
+	home.add_argument("--calibrate-backlash", action="store_true", help="measure and save the backlash of both axes")
+
+	flow = commands.add_parser("calibrate-flow", help="measure what the pump really delivers and save it")
+	flow.add_argument("--rate", type=float, required=True, help="rate the pump is set to in cc/hr")
+	flow.add_argument("--shots", type=float, nargs="+", default=list(FLOW_SHOTS), help="seconds the pump is on for each shot (default: %(default)s)")
+	flow.add_argument("--gravimetric", action="store_true", help="weigh each shot in g instead of reading its volume")
+	flow.add_argument("--density", type=float, default=WATER_DENSITY, help="density of the liquid in g/cc, with --gravimetric (default: %(default)s)")
+	flow.add_argument("--simulate", action="store_true", help="use the simulated hardware")
+	flow.add_argument("--instrument", metavar="NAME", help="calibrate the pump of one of several instruments")
+	flow.add_argument("--config", default=INSTRUMENTS_PATH, help="list of instruments, with --instrument (default: %(default)s)")
+
+	instruments = commands.add_parser("instruments", help="run the queues of several instruments at once")
+	instruments.add_argument("--config", default=INSTRUMENTS_PATH, help="list of instruments (default: %(default)s)")
+	instruments.add_argument("--simulate", action="store_true", help="use the simulated hardware")
+	instruments.add_argument("--home", action="store_true", help="home every instrument against its limit switches first")
+	instruments.add_argument("--serve", type=int, metavar="PORT", help="serve the state and controls of every instrument over HTTP and WebSocket")
+	instruments.add_argument("--serve-host", default=TELEMETRY_HOST, help="address to serve on (default: %(default)s)")
+
+	gui = commands.add_parser("gui", help="open the GUI")
+	add_hardware_arguments(gui)
+
+	args = parser.parse_args(argv)
+	if args.command == "run" or getattr(args, "action", None) == "add":
+		try:
+			args.job = make_job(args)
+		except ValueError as e:
+			parser.error(str(e))
+	return args
+
+def make_job(args):
+	return Job(args.rate, args.volume, args.labware, args.rows, args.cols, args.well_size,
+		args.settle, args.dwell, args.wells, args.order, getattr(args, "hold", None), args.continuous)
+
+# Print each well as it finishes, and how far behind the plan the run is
+def print_progress(clock, start):
+	def report(event, run):
+		if event == "done":
+			late = ""
+			if run.schedule is not None:
+				late = ", %+.1f s against plan" % run.schedule.lateness(run.plan_index, clock.now() - run.start_time)
+			print("%s done (%d/%d) at %.1f s%s, pump open %.3f s" % (run.well(), run.wells_done, len(run.plan), clock.now() - start, late, run.open_times[run.plan_index]))
+		elif event in ("paused", "resumed", "finished", "stopped"):
+			print("Fractionation " + event)
+	return report
+
+# Turn the pump off, release the motors and print what the hardware did
+def close_hardware(backend, gantry, dispenser, profiler, profile_path):
+	# Never leave the pump running, and release the motors to prevent
+	# overheating
+	dispenser.shutdown()
+	gantry.shutdown()
+
+	print(backend.report())
+	if profiler is not None:
+		profiler.export(profile_path)
+		print(profiler.summary())
+
+# Open the backend, gantry and dispenser, and make the usual small start up
+# move or home the axes
+# Positions saved in a run journal are taken up first when resuming
+# Raises RuntimeError if homing fails
+def open_hardware(args, state=None):
+	backend = make_backend(args.simulate)
+	profiler = StepProfiler() if args.profile_steps else None
+	calibration = load_calibration()
+	gantry = open_gantry(backend, profiler, calibration)
+	if state is not None:
+		gantry.restore(state)
+	loop = HeadlessLoop(backend.clock, gantry.motion)
+	dispenser = Dispenser(backend.pump(), backend.clock, FlowModel.from_dict(calibration.get("flow")))
+	loop.add_worker(dispenser.worker)
+
+	# Initialize the motors the same way the GUI does, and take the needle
+	# to be over A1 afterwards
+	ready = []
+	if args.home:
+		gantry.home(ready.append, getattr(args, "calibrate_backlash", False))
+	else:
+		gantry.initialize(ready.append)
+	loop.run_until(lambda: ready)
+	if not ready[0]:
+		close_hardware(backend, gantry, dispenser, profiler, args.profile_steps)
+		raise RuntimeError(gantry.error or "Homing was cancelled")
+	return backend, profiler, gantry, dispenser, loop
+
+# Start the telemetry server if --serve was given
+def open_telemetry(args, hardware):
+	if args.serve is None:
+		return None
+	backend, profiler, gantry, dispenser, loop = hardware
+	telemetry = Telemetry(loop, gantry, dispenser.pump, backend.clock, args.serve_host, args.serve)
+	telemetry.start()
+	print("Serving on http://%s:%d" % (telemetry.host, telemetry.port))
+	return telemetry
+
+# Run one fractionation to the end, or until Ctrl-C, and report on it from
+# its RunLog
+def run_fractionation(args, hardware, fractionation, log, index=0):
+	backend, profiler, gantry, dispenser, loop = hardware
+	start = backend.clock.now()
+	if not args.quiet:
+		fractionation.listeners.append(print_progress(backend.clock, start))
+
+	status = 0
+	try:
+		fractionation.start(index)
+		loop.run_until(fractionation.is_over)
+	except KeyboardInterrupt:
+		fractionation.stop()
+		status = 130
+	finally:
+		print("%d of %d wells in %.1f s" % (fractionation.wells_done, len(fractionation.plan), backend.clock.now() - start))
+		print(log.report())
+		close_hardware(backend, gantry, dispenser, profiler, args.profile_steps)
+	return status
+
+def run(args):
+	job = args.job
+
+	# A dry run only plans, so nothing needs to move
+	if args.dry_run:
+		args.simulate = True
+	hardware = backend, profiler, gantry, dispenser, loop = open_hardware(args)
+
+	origin = gantry.position()
+	try:
+		geometry = job.geometry(origin)
+		plan = job.plan(geometry)
+		cycle = job.cycle(dispenser.flow)
+		schedule = compile_run(gantry, geometry, plan, cycle)
+	except (OSError, ValueError, KeyError) as e:
+		print(e, file=sys.stderr)
+		close_hardware(backend, gantry, dispenser, profiler, args.profile_steps)
+		return 2
+
+	if args.dry_run:
+		for action in schedule.actions:
+			print(action.describe())
+	print(schedule.describe())
+	if args.dry_run:
+		close_hardware(backend, gantry, dispenser, profiler, args.profile_steps)
+		return 0
+
+	fractionation = make_fractionation(loop, gantry, dispenser, backend.clock, geometry, plan, cycle, schedule)
+	journal = RunJournal(args.journal)
+	journal.attach(fractionation, job, origin)
+	log = RunLog(args.log_dir, args.binary_log)
+	log.attach(fractionation, job)
+	telemetry = open_telemetry(args, hardware)
+	if telemetry is not None:
+		telemetry.watch(fractionation)
+	status = run_fractionation(args, hardware, fractionation, log)
+	journal.close()
+	if telemetry is not None:
+		telemetry.close()
+	return status
+
+# Carry on the run in the journal from its first unfinished well
+def resume(args):
+	unfinished = read_journal(args.journal)
+	if unfinished is None:
+		print("Nothing to resume", file=sys.stderr)
+		return 1
+	print(unfinished.describe())
+	try:
+		unfinished.check_position(args.home)
+		geometry, plan = unfinished.plan()
+	except (OSError, ValueError, KeyError) as e:
+		print(e, file=sys.stderr)
+		return 2
+
+	index = unfinished.next_index
+	if args.skip_interrupted and unfinished.interrupted is not None:
+		index += 1
+	hardware = backend, profiler, gantry, dispenser, loop = open_hardware(args, unfinished.state)
+
+	job = unfinished.job
+	cycle = job.cycle(dispenser.flow)
+	try:
+		schedule = compile_run(gantry, geometry, plan, cycle, index)
+	except ValueError as e:
+		print(e, file=sys.stderr)
+		close_hardware(backend, gantry, dispenser, profiler, args.profile_steps)
+		return 2
+	print(schedule.describe())
+	fractionation = make_fractionation(loop, gantry, dispenser, backend.clock, geometry, plan, cycle, schedule)
+	journal = RunJournal(args.journal)
+	journal.attach(fractionation, job, unfinished.origin, True)
+	log = RunLog(args.log_dir, args.binary_log)
+	log.attach(fractionation, job)
+	telemetry = open_telemetry(args, hardware)
+	if telemetry is not None:
+		telemetry.watch(fractionation)
+	status = run_fractionation(args, hardware, fractionation, log, index)
+	journal.close()
+	if telemetry is not None:
+		telemetry.close()
+
+	# A queued job is finished off in the queue as well
+	if job.id is not None and fractionation.state == "finished":
+		queue = JobQueue(args.file)
+		for queued in queue.jobs:
+			if queued.id == job.id:
+				queue.set_status(queued, "done")
+	return status
+
+def run_queue(args, queue):
+	# Carry on an interrupted job if it is the next one in the queue
+	unfinished = read_journal(args.journal)
+	pending = queue.next_pending()
+	if unfinished is None or pending is None or unfinished.job.id != pending.id:
+		unfinished = None
+	else:
+		print(unfinished.describe())
+		try:
+			unfinished.check_position(args.home)
+		except ValueError as e:
+			print(e, file=sys.stderr)
+			return 2
+
+	hardware = backend, profiler, gantry, dispenser, loop = open_hardware(args, unfinished.state if unfinished else None)
+
+	runner = JobRunner(queue, loop, gantry, dispenser, backend.clock, RunJournal(args.journal), RunLog(args.log_dir, args.binary_log))
+	telemetry = open_telemetry(args, hardware)
+	if telemetry is not None:
+		telemetry.watch_runner(runner)
+	start = backend.clock.now()
+	def report(event, runner):
+		if event in ("start", "end"):
+			print(runner.job.describe())
+			if event == "start":
+				print(runner.fractionation.schedule.describe())
+			elif runner.fractionation is not None:
+				print(runner.log.report())
+		elif event == "hold":
+			print("Holding %g s before job #%d" % (runner.job.hold, runner.job.id))
+		elif event == "idle":
+			print("Queue finished at %.1f s" % (backend.clock.now() - start))
+	runner.listeners.append(report)
+	if not args.quiet:
+		runner.run_listeners.append(print_progress(backend.clock, start))
+
+	status = 0
+	try:
+		runner.start(unfinished)
+		while True:
+			loop.run_until(lambda: not runner.is_busy())
+			if runner.state != "waiting":
+				break
+			input("Load the plate for job #%d and press Enter..." % runner.job.id)
+			runner.proceed()
+	except (KeyboardInterrupt, EOFError):
+		runner.stop()
+		status = 130
+	finally:
+		runner.journal.close()
+		runner.log.close()
+		if telemetry is not None:
+			telemetry.close()
+		close_hardware(backend, gantry, dispenser, profiler, args.profile_steps)
+	return status
+
+# Report on a run from its log
+def report(args):
+	path = args.path or latest_run_log(args.log_dir)
+	if path is None:
+		print("No runs logged in " + args.log_dir, file=sys.stderr)
+		return 1
+	try:
+		rows = read_run_log(path)
+	except (OSError, ValueError, KeyError) as e:
+		print(e, file=sys.stderr)
+		return 2
+	print(path)
+	print(run_report(rows, args.wells))
+	return 0
+
+# Home both axes, saving the backlash if it was measured
+def home(args):
+	args.home = True
+	backend, profiler, gantry, dispenser, loop = open_hardware(args)
+	print("Homed, now at table %.3f cm, carriage %.3f cm" % gantry.position())
+	if args.calibrate_backlash:
+		save_calibration("backlash", gantry.backlash())
+		print("Backlash: table %(table)d, carriage %(carriage)d microsteps" % gantry.backlash())
+	close_hardware(backend, gantry, dispenser, profiler, args.profile_steps)
+	return 0
+
+# Run the pump for timed shots into a tube, ask what each delivered, and
+# save the FlowModel that fits them
+def calibrate_flow(args):
+	path = CALIBRATION_PATH
+	if args.instrument is not None:
+		try:
+			instruments = {instrument.name: instrument for instrument in load_instruments(args.config)}
+		except (OSError, ValueError, KeyError) as e:
+			print(e, file=sys.stderr)
+			return 2
+		if args.instrument not in instruments:
+			print("No instrument called " + args.instrument, file=sys.stderr)
+			return 2
+		instrument = instruments[args.instrument]
+		backend = make_backend(args.simulate, instrument.address, instrument.pump_pin, instrument.limit_pins)
+		path = instrument.calibration_path
+	else:
+		backend = make_backend(args.simulate)
+
+	# Only the pump is used, so the loop waits on the dispenser alone
+	dispenser = Dispenser(backend.pump(), backend.clock)
+	loop = HeadlessLoop(backend.clock, dispenser.worker)
+	unit = "g" if args.gravimetric else "cc"
+	shots = []
+	try:
+		for i, seconds in enumerate(args.shots):
+			input("Shot %d of %d, %g s: put an empty tube under the needle and press Enter " % (i + 1, len(args.shots), seconds))
+			open_time = dispense_shot(loop, dispenser, seconds)
+			amount = float(input("Pump was open %.3f s. Collected (%s): " % (open_time, unit)))
+			shots.append((open_time, amount / args.density if args.gravimetric else amount))
+		model = fit_flow_model(args.rate, shots)
+	except ValueError as e:
+		print(e, file=sys.stderr)
+		return 2
+	except (KeyboardInterrupt, EOFError):
+		print("\nCalibration abandoned", file=sys.stderr)
+		return 130
+	finally:
+		dispenser.shutdown()
+
+	print(model.describe())
+	print("Worst shot %.4f cc off the fit" % fit_error(model, args.rate, shots))
+	save_calibration("flow", model.to_dict(), path)
+	print("Saved in " + path)
+	return 0
+
+# Run every instrument's queue at once, each on a thread of its own
+# Type an instrument's name and Enter once its next plate is in place, or
+# send proceed to it over the telemetry server
+def run_instruments(args):
+	try:
+		instruments = load_instruments(args.config)
+	except (OSError, ValueError, KeyError) as e:
+		print(e, file=sys.stderr)
+		return 2
+
+	server = TelemetryServer(args.serve_host, args.serve) if args.serve is not None else None
+	for instrument in instruments:
+		instrument.open(args.simulate)
+		instrument.runner.listeners.append(print_instrument(instrument))
+		if server is not None:
+			server.add(instrument.telemetry)
+	if server is not None:
+		server.start()
+		print("Serving on http://%s:%d" % (server.host, server.port))
+
+	# Console input is read on a thread of its own, so the main thread is
+	# free to notice when every queue is over
+	by_name = {instrument.name: instrument for instrument in instruments}
+	def read_console():
+		for line in sys.stdin:
+			name = line.strip()
+			if name in by_name:
+				by_name[name].telemetry.send("proceed")
+	threading.Thread(target=read_console, daemon=True).start()
+
+	status = 0
+	for instrument in instruments:
+		instrument.start(args.home)
+	try:
+		for instrument in instruments:
+			while instrument.is_running():
+				instrument.join(0.5)
+	except KeyboardInterrupt:
+		for instrument in instruments:
+			instrument.telemetry.send("stop")
+		for instrument in instruments:
+			instrument.join()
+		status = 130
+	finally:
+		if server is not None:
+			server.close()
+		for instrument in instruments:
+			instrument.close()
+			print_from(instrument, instrument.backend.report())
+			if instrument.error is not None:
+				print_from(instrument, instrument.error, sys.stderr)
+				status = status or 1
+	return status
+
+# Print job changes of one of several instruments, marked with its name
+def print_instrument(instrument):
+	clock = instrument.backend.clock
+	start = clock.now()
+	def report(event, runner):
+		if event in ("start", "end"):
+			print_from(instrument, runner.job.describe())
+			if event == "start":
+				print_from(instrument, runner.fractionation.schedule.describe())
+			elif runner.fractionation is not None:
+				print_from(instrument, runner.log.report())
+		elif event == "hold":
+			print_from(instrument, "holding %g s before job #%d" % (runner.job.hold, runner.job.id))
+		elif event == "waiting":
+			print_from(instrument, "load the plate for job #%d and enter %s" % (runner.job.id, instrument.name))
+		elif event in ("idle", "stopped"):
+			print_from(instrument, "queue %s at %.1f s" % ("finished" if event == "idle" else "stopped", clock.now() - start))
+	return report
+
+# Every instrument prints from its own thread, so lines are printed whole
+print_lock = threading.Lock()
+
+def print_from(instrument, text, file=None):
+	with print_lock:
+		for line in text.split("\n"):
+			print("%s: %s" % (instrument.name, line), file=file)
+
+def queue_command(args):
+	if args.instrument is not None:
+		args.file, args.journal = instrument_files(args.instrument)
+	queue = JobQueue(args.file)
+	if args.action == "add":
+		# The queue may be run from another directory
+		if args.job.labware is not None:
+			args.job.labware = os.path.abspath(args.job.labware)
+		print(queue.add(args.job).describe())
+	elif args.action == "list":
+		for job in queue.jobs:
+			print(job.describe())
+	elif args.action == "remove":
+		queue.remove(args.id)
+	elif args.action == "clear":
+		queue.clear_finished()
+	elif args.action == "run":
+		return run_queue(args, queue)
+	return 0
+
+def main(argv=None):
+	args = parse_args(sys.argv[1:] if argv is None else argv)
+	if args.command == "gui":
+		# Only import Tk when the GUI is actually wanted
+		from main import run_gui
+		run_gui(args.simulate, args.profile_steps, args.home, args.serve, args.serve_host, args.journal,
+			args.log_dir, args.binary_log)
+		return 0
+	try:
+		if args.command == "queue":
+			return queue_command(args)
+		if args.command == "resume":
+			return resume(args)
+		if args.command == "home":
+			return home(args)
+		if args.command == "report":
+			return report(args)
+		if args.command == "calibrate-flow":
+			return calibrate_flow(args)
+		if args.command == "instruments":
+			return run_instruments(args)
+		return run(args)
+	except RuntimeError as e:
+		print(e, file=sys.stderr)
+		return 1
+
+if __name__ == "__main__":
+	sys.exit(main())
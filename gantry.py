@@ -0,0 +1,203 @@
+"""
+Gantry Class
+
+The table and carriage axes that position the needle over the plate. Moves
+are queued on a MotionWorker so callers never block on the motors; on_done
+callbacks are called with whether the move completed once it is over.
+
+With limit switches, both axes can be homed so that positions are measured
+from the same place on every start (see homing.py).
+
+For lining the needle up by hand, an axis can be jogged: it runs for as
+long as a key or button is held and stops when it is let go.
+"""
+import threading
+
+from motor import StepperMotor, move_together, move_dist_absolute_together, jog, NEMA_17_STEPS_PER_DEGREE, LEAD_SCREW_PITCH_IN_CM
+from motion import TABLE_PROFILE, CARRIAGE_PROFILE
+from homing import home_axis
+from worker import MotionWorker
+
+# Usable travel of each axis in cm, from its home switch, as (low, high)
+# The carriage reaches past the plate to the cleaning position at 14 cm
+# A "travel" entry in the calibration replaces these
+TRAVEL = {"table": (0.0, 20.0), "carriage": (0.0, 15.0)}
+
+# Fine and coarse jogs as (shortest jog in cm, top speed in cm/s)
+# A tap moves the shortest jog, and None runs at the axis's top speed
+FINE_JOG = (0.01, 0.2)
+COARSE_JOG = (0.1, None)
+
+class Gantry:
+	def __init__(self, table_motor, carriage_motor, motion, table_limit=None, carriage_limit=None):
+		self.table_motor = table_motor
+		self.carriage_motor = carriage_motor
+		self.motion = motion
+		self.table_limit = table_limit
+		self.carriage_limit = carriage_limit
+		self.initialized = False
+
+		# Whether the positions are measured from home, and why the last
+		# homing failed
+		self.homed = False
+		self.error = None
+
+		# Once homed, targets outside this are refused, and runs are
+		# checked against it before they start (see schedule.py)
+		self.travel = dict(TRAVEL)
+
+	# Move the motors a small distance to better initialize
+	# This only happens the first time, later calls just call on_done
+	def initialize(self, on_done=None):
+		if self.initialized:
+			if on_done is not None:
+				on_done(True)
+			return
+		self.initialized = True
+		self.move_by(-0.1, -0.1, on_done)
+
+	# Home both axes against their limit switches, and measure their
+	# backlash if calibrate is True
+	# on_done is called with False if homing was cancelled or failed, with
+	# the reason in error
+	def home(self, on_done=None, calibrate=False):
+		self.initialized = True
+		self.motion.submit(lambda cancel: self.run_home(cancel, calibrate), on_done)
+
+	def run_home(self, cancel, calibrate):
+		self.homed = False
+		self.error = None
+		try:
+			for motor, limit in ((self.carriage_motor, self.carriage_limit), (self.table_motor, self.table_limit)):
+				if not home_axis(motor, limit, cancel, calibrate):
+					return False
+		except RuntimeError as e:
+			self.error = str(e)
+			return False
+		self.homed = True
+		return True
+
+	# Backlash of both axes in microsteps, as saved in the calibration
+	def backlash(self):
+		return {"table": self.table_motor.backlash, "carriage": self.carriage_motor.backlash}
+
+	def set_backlash(self, backlash):
+		self.table_motor.backlash = backlash.get("table", self.table_motor.backlash)
+		self.carriage_motor.backlash = backlash.get("carriage", self.carriage_motor.backlash)
+
+	# Current table and carriage positions in cm
+	def position(self):
+		return (self.table_motor.get_dist(), self.carriage_motor.get_dist())
+
+	# Move the table and carriage to absolute positions in cm at the same time
+	# Leave a position as None to keep that axis where it is
+	# Once homed, raises ValueError if a position is outside the travel
+	def move_to(self, table, carriage, on_done=None):
+		if self.homed:
+			self.check_travel(table, carriage)
+		targets = []
+		if table is not None:
+			targets.append((self.table_motor, table))
+		if carriage is not None:
+			targets.append((self.carriage_motor, carriage))
+		if targets:
+			self.motion.submit(lambda cancel: move_dist_absolute_together(targets, cancel), on_done)
+		elif on_done is not None:
+			on_done(True)
+
+	# Raise ValueError if a position in cm is outside the travel of its axis
+	def check_travel(self, table, carriage):
+		for name, position in (("table", table), ("carriage", carriage)):
+			low, high = self.travel[name]
+			if position is not None and not low <= position <= high:
+				raise ValueError("%.2f cm is outside the %s travel of %.2f to %.2f cm" % (position, name, low, high))
+
+	# Rough time a move_to from the current position would take, from the
+	# motion profiles of both axes
+	# Driver latency, backlash and hybrid steps are left out, so scale it by
+	# how long moves really take where it matters
+	def move_time(self, table, carriage):
+		times = [0.0]
+		for motor, dist in ((self.table_motor, table), (self.carriage_motor, carriage)):
+			steps = round(abs(dist - motor.get_dist()) / motor.cm_per_step)
+			times.append(motor.profile.duration(steps, motor.cm_per_step))
+		return max(times)
+
+	# Move the table and carriage a distance in cm relative to where they
+	# are when the move starts
+	def move_by(self, table, carriage, on_done=None):
+		moves = []
+		if table != 0:
+			moves.append((self.table_motor, table / self.table_motor.cm_per_deg))
+		if carriage != 0:
+			moves.append((self.carriage_motor, carriage / self.carriage_motor.cm_per_deg))
+		if moves:
+			self.motion.submit(lambda cancel: move_together(moves, cancel), on_done)
+		elif on_done is not None:
+			on_done(True)
+
+	# Jog the "table" or "carriage" axis forwards or backwards until the
+	# returned event is set, finely or coarsely
+	# Once homed, the jog stops at the end of the axis's travel
+	# A virtual clock gives no time for a key to be held, so there every
+	# jog is the shortest one
+	def jog(self, axis, forwards, coarse=False, on_done=None):
+		motor = self.table_motor if axis == "table" else self.carriage_motor
+		increment, speed = COARSE_JOG if coarse else FINE_JOG
+		release = threading.Event()
+		if self.motion.synchronous:
+			release.set()
+
+		limit = None
+		if self.homed:
+			low, high = self.travel[axis]
+			room = high - motor.get_dist() if forwards else motor.get_dist() - low
+			limit = max(0, int(room / motor.cm_per_step))
+		shortest = round(increment / motor.cm_per_step)
+		self.motion.submit(lambda cancel: jog(motor, forwards, release, cancel, shortest, limit, speed, coarse), on_done)
+		return release
+
+	# Positions in microsteps, last directions and slack left of both axes,
+	# and whether they are measured from home, as saved in the run journal
+	def state(self):
+		return {
+			"table": [self.table_motor.position, self.table_motor.forwards, self.table_motor.slack],
+			"carriage": [self.carriage_motor.position, self.carriage_motor.forwards, self.carriage_motor.slack],
+			"homed": self.homed,
+		}
+
+	# Take up positions saved by state()
+	# Only call this before the motors have moved, while they are still
+	# where the saved run left them
+	# Journals from before the slack was saved have none left
+	def restore(self, state):
+		for motor, saved in ((self.table_motor, state["table"]), (self.carriage_motor, state["carriage"])):
+			motor.position, motor.forwards = saved[:2]
+			motor.slack = saved[2] if len(saved) > 2 else 0
+
+	# Stop the current move between steps and drop queued moves
+	def cancel(self):
+		self.motion.cancel()
+
+	# Let the queued moves finish, then release both motors
+	def shutdown(self):
+		self.motion.stop()
+		self.table_motor.release()
+		self.carriage_motor.release()
+
+# Build the gantry for a backend, with the motors in hybrid step mode and an
+# optional StepProfiler shared by both
+# A calibration loaded with load_calibration() sets the backlash and travel
+def open_gantry(backend, profiler=None, calibration=None):
+	table_motor = StepperMotor(2, NEMA_17_STEPS_PER_DEGREE, LEAD_SCREW_PITCH_IN_CM, True, backend, TABLE_PROFILE, "table", True)
+	carriage_motor = StepperMotor(1, NEMA_17_STEPS_PER_DEGREE, LEAD_SCREW_PITCH_IN_CM, True, backend, CARRIAGE_PROFILE, "carriage", True)
+	table_motor.profiler = profiler
+	carriage_motor.profiler = profiler
+
+	# With a virtual clock there is nothing to wait for, so moves run inline
+	gantry = Gantry(table_motor, carriage_motor, MotionWorker(backend.clock.virtual), backend.limit(2), backend.limit(1))
+	if calibration is not None:
+		gantry.set_backlash(calibration.get("backlash", {}))
+		for axis, limits in calibration.get("travel", {}).items():
+			gantry.travel[axis] = tuple(limits)
+	return gantry
@@ -0,0 +1,298 @@
+"""
+Hardware backends
+
+The fractionator only talks to three kinds of hardware: the stepper motors on
+the Adafruit motor HAT, the pump on a GPIO pin and the home limit switches on
+two more pins. A backend hands out drivers for all of them, along with the
+clock that is used to time steps and dispenses.
+
+The Raspberry Pi backend wraps the real libraries. The simulated backend
+records every step and pump edge against a virtual clock so that a whole
+plate can be replayed in seconds on any machine.
+
+Both backends open each device once and hand the same driver to everyone
+who asks for it, and keep how long opening each device took. A backend is
+one instrument: several can share a host by giving each its own motor HAT
+address and pins.
+"""
+from time import monotonic, perf_counter, sleep
+
+##  STEPPER CONSTANTS  ##
+# - Same values as adafruit_motor.stepper so either can be passed to a driver
+FORWARD = 1
+BACKWARD = 2
+SINGLE = 1
+DOUBLE = 2
+INTERLEAVE = 3
+MICROSTEP = 4
+
+# Microsteps per full step used by the motor HAT
+MICROSTEPS = 16
+
+# Rough cost of one onestep() call on the HAT: a microstep is four PCA9685
+# duty cycle writes over 100 kHz I2C
+SIM_STEP_LATENCY = 0.002
+
+# I2C address of the motor HAT, as set by its address jumpers
+HAT_ADDRESS = 0x60
+
+# GPIO pin the pump is wired to
+PUMP_PIN = "5"
+
+# GPIO pins of the home limit switches, by motor port
+LIMIT_PINS = {1: "6", 2: "13"}
+
+# Where the simulated limit switches are, in microsteps towards home from
+# where the simulated motors start, and the slack between each simulated
+# lead screw and its slider in microsteps (0.3 cm)
+SIM_HOME_DISTANCE = 2400
+SIM_BACKLASH = 240
+
+# Clock backed by the system monotonic clock
+class RealClock:
+	virtual = False
+
+	# Current time in seconds
+	def now(self):
+		return monotonic()
+
+	# Block for a number of seconds
+	def sleep(self, seconds):
+		if seconds > 0:
+			sleep(seconds)
+
+	# Block until the clock reaches a specific time
+	def sleep_until(self, deadline):
+		self.sleep(deadline - monotonic())
+
+# Clock that only advances when something sleeps on it
+class VirtualClock:
+	virtual = True
+
+	def __init__(self, start=0.0):
+		self.time = start
+
+	# Current time in seconds
+	def now(self):
+		return self.time
+
+	# Advance the clock instead of blocking
+	def sleep(self, seconds):
+		if seconds > 0:
+			self.time += seconds
+
+	# Jump forwards to a specific time (never backwards)
+	def sleep_until(self, deadline):
+		self.time = max(self.time, deadline)
+
+# Stand-in for an adafruit_motor StepperMotor
+# Every onestep call is recorded as (time, direction, style)
+# The shaft and the slider it drives are also tracked, in microsteps
+# counted FORWARD from where they started, with the slider lagging up to
+# backlash microsteps behind the shaft when it changes direction
+class SimStepper:
+	def __init__(self, clock, step_latency=SIM_STEP_LATENCY, microsteps=MICROSTEPS, backlash=0):
+		self.clock = clock
+		self.step_latency = step_latency
+		self.microsteps = microsteps
+		self.current_microstep = 0
+		self.steps = []
+		self.releases = 0
+		self.backlash = backlash
+		self.shaft = 0
+		self.slider = 0
+
+	# Follows the same coil phase logic as adafruit_motor so the returned
+	# microstep position matches the real driver
+	def onestep(self, *, direction=FORWARD, style=SINGLE):
+		start = self.current_microstep
+		step_size = 0
+		if style == MICROSTEP:
+			step_size = 1
+		else:
+			half_step = self.microsteps // 2
+			full_step = self.microsteps
+
+			# Snap to the nearest half step boundary first
+			additional_microsteps = self.current_microstep % half_step
+			if additional_microsteps != 0:
+				if direction == FORWARD:
+					self.current_microstep += half_step - additional_microsteps
+				else:
+					self.current_microstep -= additional_microsteps
+			elif style == INTERLEAVE:
+				step_size = half_step
+
+			current_interleave = self.current_microstep // half_step
+			if (style == SINGLE and current_interleave % 2 == 1) or (style == DOUBLE and current_interleave % 2 == 0):
+				step_size = half_step
+			elif style in (SINGLE, DOUBLE):
+				step_size = full_step
+
+		if direction == FORWARD:
+			self.current_microstep += step_size
+		else:
+			self.current_microstep -= step_size
+		self.shaft += self.current_microstep - start
+		self.slider = min(self.shaft, max(self.slider, self.shaft - self.backlash))
+		self.current_microstep %= self.microsteps * 4
+
+		self.steps.append((self.clock.now(), direction, style))
+		self.clock.sleep(self.step_latency)
+		return self.current_microstep
+
+	def release(self):
+		self.releases += 1
+
+# Stand-in for the gpiozero LED that switches the pump
+# Every edge is recorded as (time, state)
+class SimPump:
+	def __init__(self, clock):
+		self.clock = clock
+		self.value = 0
+		self.edges = []
+
+	# Only real changes are recorded, like a logic analyser on the pin
+	def on(self):
+		if self.value != 1:
+			self.value = 1
+			self.edges.append((self.clock.now(), 1))
+
+	def off(self):
+		if self.value != 0:
+			self.value = 0
+			self.edges.append((self.clock.now(), 0))
+
+	# Total time the pump has been switched on
+	def open_time(self):
+		total = 0.0
+		opened = None
+		for t, state in self.edges:
+			if state and opened is None:
+				opened = t
+			elif not state and opened is not None:
+				total += t - opened
+				opened = None
+		return total
+
+# Stand-in for the gpiozero Button of a limit switch
+# The switch closes once the slider of a SimStepper has moved distance
+# microsteps in a direction
+class SimLimit:
+	def __init__(self, stepper, distance, direction=FORWARD):
+		self.stepper = stepper
+		self.distance = distance
+		self.sign = 1 if direction == FORWARD else -1
+
+	@property
+	def is_pressed(self):
+		return self.sign * self.stepper.slider >= self.distance
+
+# Backend for the real instrument
+# The Adafruit and gpiozero imports only happen here so the rest of the
+# code can be imported on machines without them
+class PiBackend:
+	simulated = False
+
+	def __init__(self, address=HAT_ADDRESS, pump_pin=PUMP_PIN, limit_pins=LIMIT_PINS):
+		self.clock = RealClock()
+		self.address = address
+		self.pump_pin = pump_pin
+		self.limit_pins = limit_pins
+		self.kit = None
+		self.steppers = {}
+		self.pumps = {}
+		self.limits = {}
+		self.open_times = {}
+
+	# Get the stepper driver for a motor port on the HAT (1 or 2)
+	# The HAT is set up over I2C once and shared by both ports
+	def stepper(self, index):
+		if index not in self.steppers:
+			if self.kit is None:
+				start = perf_counter()
+				from adafruit_motorkit import MotorKit
+				self.kit = MotorKit(address=self.address)
+				self.open_times["motor HAT 0x%02x" % self.address] = perf_counter() - start
+			self.steppers[index] = self.kit.stepper2 if index == 2 else self.kit.stepper1
+		return self.steppers[index]
+
+	# Get the digital output that switches the pump
+	def pump(self, pin=None):
+		if pin is None:
+			pin = self.pump_pin
+		if pin not in self.pumps:
+			start = perf_counter()
+			from gpiozero import LED
+			self.pumps[pin] = LED(pin)
+			self.open_times["pump %s" % pin] = perf_counter() - start
+		return self.pumps[pin]
+
+	# Get the input for the home limit switch of a motor port
+	def limit(self, index):
+		if index not in self.limits:
+			start = perf_counter()
+			from gpiozero import Button
+			self.limits[index] = Button(self.limit_pins[index])
+			self.open_times["limit %d" % index] = perf_counter() - start
+		return self.limits[index]
+
+	# How long each device took to open
+	def report(self):
+		return "\n".join(open_time_lines(self.open_times))
+
+# Backend that runs entirely in memory against a virtual clock
+class SimBackend:
+	simulated = True
+
+	def __init__(self, step_latency=SIM_STEP_LATENCY, home_distance=SIM_HOME_DISTANCE, backlash=SIM_BACKLASH, pump_pin=PUMP_PIN):
+		self.clock = VirtualClock()
+		self.pump_pin = pump_pin
+		self.step_latency = step_latency
+		self.home_distance = home_distance
+		self.backlash = backlash
+		self.steppers = {}
+		self.pumps = {}
+		self.limits = {}
+		self.open_times = {}
+
+	def stepper(self, index):
+		if index not in self.steppers:
+			start = perf_counter()
+			self.steppers[index] = SimStepper(self.clock, self.step_latency, backlash=self.backlash)
+			self.open_times["stepper %d" % index] = perf_counter() - start
+		return self.steppers[index]
+
+	def pump(self, pin=None):
+		if pin is None:
+			pin = self.pump_pin
+		if pin not in self.pumps:
+			start = perf_counter()
+			self.pumps[pin] = SimPump(self.clock)
+			self.open_times["pump %s" % pin] = perf_counter() - start
+		return self.pumps[pin]
+
+	# Both motors are reversed, so home is FORWARD on the driver
+	def limit(self, index):
+		if index not in self.limits:
+			self.limits[index] = SimLimit(self.stepper(index), self.home_distance)
+		return self.limits[index]
+
+	# Summary of everything the simulated hardware was asked to do
+	def report(self):
+		lines = ["Virtual time: %.1f s" % self.clock.now()]
+		for index, driver in sorted(self.steppers.items()):
+			lines.append("Stepper %d: %d steps" % (index, len(driver.steps)))
+		for pin, pump in sorted(self.pumps.items()):
+			lines.append("Pump %s: %d edges, open %.1f s" % (pin, len(pump.edges), pump.open_time()))
+		return "\n".join(lines + open_time_lines(self.open_times))
+
+# Report lines for the time taken to open each device
+def open_time_lines(open_times):
+	return ["Opened %s in %.1f ms" % (name, 1000 * seconds) for name, seconds in open_times.items()]
+
+# Pick a backend for an instrument
+def make_backend(simulate=False, address=HAT_ADDRESS, pump_pin=PUMP_PIN, limit_pins=LIMIT_PINS):
+	if simulate:
+		return SimBackend(pump_pin=pump_pin)
+	return PiBackend(address, pump_pin, limit_pins)
@@ -0,0 +1,125 @@
+"""
+Homing
+
+Finds a fixed zero for an axis against its limit switch, which sits at the
+low end of travel, so every start is from the same place instead of
+wherever the motors happened to be when the power came on.
+
+The axis runs towards the switch at its normal speed until the switch
+closes, backs off a little, and then creeps back one microstep at a time
+until it closes again. However far the fast approach overshot, the creep
+finds the switch to within a microstep, and that point becomes zero.
+
+While it is at the switch the axis can also measure its backlash by
+creeping away until the switch opens: every microstep before that only
+takes up the slack between the lead screw and the slider. The creep back
+in measures it again from the other side, and the average of a few of these
+replaces the default in StepperMotor.backlash.
+"""
+from hardware import FORWARD, BACKWARD, MICROSTEP
+from motor import move_together
+
+# Longest fast approach before giving up on the switch, in cm
+HOME_TRAVEL = 30.0
+
+# Distance backed off before creeping back to the switch, in cm
+HOME_BACKOFF = 0.25
+
+# Time between microsteps while creeping, in seconds (0.25 cm/s)
+CREEP_DELAY = 0.005
+
+# Where the axis is left after homing, clear of the switch, in cm
+HOME_CLEARANCE = 0.5
+
+# Largest backlash that is believed, in cm
+MAX_BACKLASH = 1.0
+
+# Times the backlash is measured each way
+BACKLASH_TRIALS = 3
+
+# Microsteps the switch itself moves between closing and opening again
+SWITCH_HYSTERESIS = 0
+
+# Looks like the cancel event to move_together, and is set once the switch
+# closes or the move is cancelled
+class LimitStop:
+	def __init__(self, limit, cancel=None):
+		self.limit = limit
+		self.cancel = cancel
+
+	def is_set(self):
+		return self.limit.is_pressed or (self.cancel is not None and self.cancel.is_set())
+
+# Step a motor one microstep at a time, towards home or away from it, until
+# the switch is pressed or released
+# Returns the number of microsteps taken, or None if it took more than
+# max_steps or was cancelled
+def creep(motor, limit, towards, pressed, max_steps, cancel=None):
+	# Home is at negative angles, which turn the driver FORWARD on a
+	# reversed motor (see StepperMotor.plan_relative)
+	direction = FORWARD if towards == motor.reverse else BACKWARD
+	clock = motor.clock
+	deadline = clock.now()
+	reported = None
+	steps = 0
+	while limit.is_pressed != pressed:
+		if steps >= max_steps or (cancel is not None and cancel.is_set()):
+			steps = None
+			break
+		reported = motor.motor.onestep(direction=direction, style=MICROSTEP)
+		steps += 1
+		deadline += CREEP_DELAY
+		clock.sleep_until(deadline)
+
+	if steps:
+		taken = motor.track_phase(direction, steps, reported)
+		motor.position += -taken if towards else taken
+		motor.forwards = not towards
+		motor.slack = 0
+	return steps
+
+# Home one motor against its limit switch, leaving it HOME_CLEARANCE from
+# zero, and measure its backlash if calibrate is True
+# Returns False if cancelled, and raises RuntimeError if the switch does not
+# behave
+def home_axis(motor, limit, cancel=None, calibrate=False):
+	backoff_steps = round(HOME_BACKOFF / motor.cm_per_step)
+	max_backlash = round(MAX_BACKLASH / motor.cm_per_step)
+
+	# Get off the switch if the axis is already on it
+	if limit.is_pressed:
+		if creep(motor, limit, False, False, max_backlash + backoff_steps, cancel) is None:
+			return cancelled(cancel, "The %s limit switch did not open" % motor.name)
+
+	# Fast approach, stopping as soon as the switch closes
+	move_together([(motor, -HOME_TRAVEL / motor.cm_per_deg)], LimitStop(limit, cancel))
+	if not limit.is_pressed:
+		return cancelled(cancel, "The %s limit switch did not close" % motor.name)
+
+	# Back off and creep back to find the switch exactly
+	if not move_together([(motor, HOME_BACKOFF / motor.cm_per_deg)], cancel):
+		return False
+	if creep(motor, limit, True, True, max_backlash + 2 * backoff_steps, cancel) is None:
+		return cancelled(cancel, "The %s limit switch did not close" % motor.name)
+
+	if calibrate:
+		trials = []
+		for _ in range(BACKLASH_TRIALS):
+			for towards in (False, True):
+				steps = creep(motor, limit, towards, towards, max_backlash, cancel)
+				if steps is None:
+					return cancelled(cancel, "The %s limit switch did not %s" % (motor.name, "close" if towards else "open"))
+				trials.append(steps)
+
+		# The switch only changes one microstep after the slack is taken up
+		motor.backlash = max(0, round(sum(trials) / len(trials)) - 1 - SWITCH_HYSTERESIS)
+
+	motor.position = 0
+	return move_together([(motor, HOME_CLEARANCE / motor.cm_per_deg)], cancel)
+
+# Return False for a cancelled homing, or raise an error if it was not
+# cancelled
+def cancelled(cancel, message):
+	if cancel is not None and cancel.is_set():
+		return False
+	raise RuntimeError(message)
@@ -0,0 +1,183 @@
+"""
+Instruments
+
+Several fractionators can be driven from one host. Each Instrument is one
+rig with its own motor HAT address, pump pin and limit switch pins, its own
+job queue, run journal and calibration, and its own event loop on a thread
+of its own. Moves and dispenses already run on workers of their own, so one
+rig's step loop never holds up another rig's pump.
+
+The rigs are listed in a JSON file:
+
+	{"instruments": [
+		{"name": "left", "address": 96, "pump_pin": "5", "limit_pins": {"1": "6", "2": "13"}},
+		{"name": "right", "address": 97, "pump_pin": "12", "limit_pins": {"1": "16", "2": "20"}}
+	]}
+
+The queue, journal, run log and calibration files default to the usual
+ones with the rig's name added (jobs-left.json and so on), so jobs are
+queued for a rig with `queue --instrument left add ...`.
+"""
+import json
+import os
+import threading
+import traceback
+
+from hardware import make_backend, HAT_ADDRESS, PUMP_PIN, LIMIT_PINS
+from gantry import open_gantry
+from loop import HeadlessLoop
+from dispenser import Dispenser
+from jobs import JobQueue, JobRunner, JOB_QUEUE_PATH
+from journal import RunJournal, read_journal, RUN_JOURNAL_PATH
+from runlog import RunLog, RUN_LOG_DIR
+from calibration import load_calibration, CALIBRATION_PATH
+from flow import FlowModel
+from telemetry import Telemetry
+
+# Where the list of rigs is kept
+INSTRUMENTS_PATH = os.path.join(os.path.dirname(JOB_QUEUE_PATH), "instruments.json")
+
+# Add a rig's name to a file path, before the extension
+def instrument_path(path, name):
+	root, ext = os.path.splitext(path)
+	return "%s-%s%s" % (root, name, ext)
+
+"""
+Instrument Class
+
+One rig. open() sets up its hardware, queue and runner, start() runs its
+queue on a thread of its own and join() waits for the queue to finish.
+Everything about a running rig is reached through its Telemetry, which
+carries commands over to the rig's own thread.
+"""
+
+class Instrument:
+	def __init__(self, name, address=HAT_ADDRESS, pump_pin=PUMP_PIN, limit_pins=LIMIT_PINS, queue_path=None, journal_path=None, calibration_path=None, log_dir=None):
+		self.name = name
+		self.address = address
+		self.pump_pin = str(pump_pin)
+		self.limit_pins = {int(index): str(pin) for index, pin in limit_pins.items()}
+		self.queue_path = queue_path or instrument_path(JOB_QUEUE_PATH, name)
+		self.journal_path = journal_path or instrument_path(RUN_JOURNAL_PATH, name)
+		self.calibration_path = calibration_path or instrument_path(CALIBRATION_PATH, name)
+		self.log_dir = log_dir or instrument_path(RUN_LOG_DIR, name)
+
+		self.backend = None
+		self.thread = None
+		self.error = None
+
+	@classmethod
+	def from_dict(cls, data):
+		return cls(data["name"], data.get("address", HAT_ADDRESS), data.get("pump_pin", PUMP_PIN), data.get("limit_pins", LIMIT_PINS),
+			data.get("queue"), data.get("journal"), data.get("calibration"), data.get("log_dir"))
+
+	# Pins the rig uses, to check that no two rigs share one
+	def pins(self):
+		return [self.pump_pin] + list(self.limit_pins.values())
+
+	# Open the hardware and the queue, ready to start
+	def open(self, simulate=False):
+		self.backend = make_backend(simulate, self.address, self.pump_pin, self.limit_pins)
+		calibration = load_calibration(self.calibration_path)
+		self.gantry = open_gantry(self.backend, None, calibration)
+		self.loop = HeadlessLoop(self.backend.clock, self.gantry.motion)
+		self.dispenser = Dispenser(self.backend.pump(), self.backend.clock, FlowModel.from_dict(calibration.get("flow")))
+		self.loop.add_worker(self.dispenser.worker)
+
+		self.queue = JobQueue(self.queue_path)
+		self.runner = JobRunner(self.queue, self.loop, self.gantry, self.dispenser, self.backend.clock, RunJournal(self.journal_path), RunLog(self.log_dir))
+		self.telemetry = Telemetry(self.loop, self.gantry, self.dispenser.pump, self.backend.clock, name=self.name)
+		self.telemetry.watch_runner(self.runner)
+
+		# A virtual clock has nothing to sleep on while waiting for a plate,
+		# so the rig's thread waits here for a command instead
+		self.wakeup = threading.Event()
+		if self.backend.clock.virtual:
+			self.telemetry.inbox.notify = self.wakeup.set
+
+	# Run the queue on a thread of its own, homing first if asked to
+	def start(self, home=False):
+		self.thread = threading.Thread(target=self.run, args=(home,), daemon=True)
+		self.thread.start()
+
+	def run(self, home):
+		try:
+			# Carry on an interrupted job if it is the next one in the queue,
+			# taking up the positions it left the motors in
+			unfinished = read_journal(self.journal_path)
+			pending = self.queue.next_pending()
+			if unfinished is not None and (pending is None or unfinished.job.id != pending.id):
+				unfinished = None
+			if unfinished is not None:
+				try:
+					unfinished.check_position(home)
+				except ValueError as e:
+					self.error = str(e)
+					return
+				self.gantry.restore(unfinished.state)
+
+			ready = []
+			if home:
+				self.gantry.home(ready.append)
+			else:
+				self.gantry.initialize(ready.append)
+			self.loop.run_until(lambda: ready)
+			if not ready[0]:
+				self.error = self.gantry.error or "Homing was cancelled"
+				return
+
+			self.runner.start(unfinished)
+
+			# Plate changes are confirmed with the proceed command
+			over = lambda: self.runner.state in ("idle", "stopped")
+			while not self.loop.run_until(over):
+				self.wakeup.wait()
+				self.wakeup.clear()
+		except Exception:
+			self.error = traceback.format_exc()
+		finally:
+			self.runner.journal.close()
+			self.runner.log.close()
+
+	def is_running(self):
+		return self.thread is not None and self.thread.is_alive()
+
+	def join(self, timeout=None):
+		if self.thread is not None:
+			self.thread.join(timeout)
+
+	# Turn the pump off and release the motors
+	def close(self):
+		self.dispenser.shutdown()
+		self.gantry.shutdown()
+
+# Queue and journal files of a rig, from the list of rigs if it is there
+def instrument_files(name, path=INSTRUMENTS_PATH):
+	instrument = Instrument(name)
+	if os.path.exists(path):
+		for listed in load_instruments(path):
+			if listed.name == name:
+				instrument = listed
+	return instrument.queue_path, instrument.journal_path
+
+# Read the list of rigs, checking that they do not share any hardware
+# Raises ValueError if they do
+def load_instruments(path=INSTRUMENTS_PATH):
+	with open(path) as f:
+		instruments = [Instrument.from_dict(data) for data in json.load(f)["instruments"]]
+
+	names = set()
+	addresses = set()
+	pins = set()
+	for instrument in instruments:
+		if instrument.name in names:
+			raise ValueError("Two instruments are called " + instrument.name)
+		if instrument.address in addresses:
+			raise ValueError("Two instruments use the motor HAT at 0x%02x" % instrument.address)
+		for pin in instrument.pins():
+			if pin in pins:
+				raise ValueError("Two instruments use GPIO " + pin)
+			pins.add(pin)
+		names.add(instrument.name)
+		addresses.add(instrument.address)
+	return instruments
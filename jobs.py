@@ -0,0 +1,324 @@
+"""
+Job queue
+
+A job is everything needed to fractionate one plate: the labware (a
+definition file, or rows, columns and well size for a plain grid), the pump
+rate and volume, the settle and dwell times, the wells to fill, the
+visiting order and whether the pump runs continuously. Jobs wait in a JobQueue that is saved to disk after every
+change, so a batch queued in the evening is still there after a restart.
+
+JobRunner takes pending jobs off the queue and runs them back to back.
+Between plates it either holds for the job's hold time or, when a job has
+no hold time, waits for someone to confirm the next plate is in place.
+"""
+import json
+import os
+
+from fractionation import make_fractionation
+from schedule import compile_run
+from cycle import WellCycle, FlowCycle, DROP_VOLUME
+from flow import FlowModel
+from wellplan import WellPlan, ORDERS, parse_selection
+from labware import Labware, load_labware
+
+# Where the queue is kept between runs
+JOB_QUEUE_PATH = os.path.join(os.path.expanduser("~"), ".local", "share", "robotic-fractionator", "jobs.json")
+
+# Settings saved for each job
+JOB_FIELDS = ("labware", "rows", "cols", "well_size", "rate", "volume", "settle", "dwell", "wells", "order", "hold", "continuous")
+
+"""
+Job Class
+
+One plate worth of settings, plus its place in the queue: an id, a status
+(pending, running, done, failed or stopped) and a message saying why a job
+failed.
+"""
+
+class Job:
+	def __init__(self, rate, volume, labware=None, rows=None, cols=None, well_size=None, settle=None, dwell=None, wells="", order=ORDERS[0], hold=None, continuous=False):
+		self.labware = labware
+		self.rows = rows
+		self.cols = cols
+		self.well_size = well_size
+		self.rate = rate
+		self.volume = volume
+		self.settle = settle
+		self.dwell = dwell
+		self.wells = wells
+		self.order = order
+
+		# Seconds to hold before this job starts, or None to wait for the
+		# plate to be confirmed
+		self.hold = hold
+
+		# Keep the pump on from the first well to the last (see FlowCycle)
+		# Settle and dwell times are not used then
+		self.continuous = continuous
+
+		self.id = None
+		self.status = "pending"
+		self.message = ""
+
+		if rate <= 0 or volume <= 0:
+			raise ValueError("Pump rate and volume must be positive")
+		if labware is None and not (rows and cols and well_size):
+			raise ValueError("A job needs a labware file or the rows, columns and well size")
+		if order not in ORDERS:
+			raise ValueError("Unknown order: " + order)
+
+	def to_dict(self):
+		data = {field: getattr(self, field) for field in JOB_FIELDS}
+		data.update(id=self.id, status=self.status, message=self.message)
+		return data
+
+	@classmethod
+	def from_dict(cls, data):
+		job = cls(**{field: data[field] for field in JOB_FIELDS if field in data})
+		job.id = data.get("id")
+		job.status = data.get("status", "pending")
+		job.message = data.get("message", "")
+		return job
+
+	# One line summary for lists
+	def describe(self):
+		plate = os.path.basename(self.labware) if self.labware else "%dx%d" % (self.rows, self.cols)
+		text = "#%d %s, %g cc at %g cc/hr" % (self.id, plate, self.volume, self.rate)
+		if self.wells:
+			text += ", wells " + self.wells
+		if self.continuous:
+			text += ", continuous"
+		text += ": " + self.status
+		if self.message:
+			text += " (" + self.message + ")"
+		return text
+
+	# Seconds the pump is on for each well, corrected by the pump's
+	# FlowModel if one is given
+	def pump_time(self, flow=None):
+		flow = flow or FlowModel()
+		if self.continuous:
+			return flow.flow_time(self.volume, self.rate)
+		return flow.open_time(self.volume, self.rate)
+
+	def cycle(self, flow=None):
+		flow = flow or FlowModel()
+		if self.continuous:
+			return FlowCycle(self.pump_time(flow), flow.flow_time(DROP_VOLUME, self.rate), flow.lag)
+		return WellCycle(self.pump_time(flow), self.settle, self.dwell)
+
+	# Where the wells are, with A1 at the origin for a plain grid
+	def geometry(self, origin):
+		if self.labware is not None:
+			return load_labware(self.labware)
+		return Labware.uniform(self.rows, self.cols, self.well_size, origin)
+
+	def plan(self, geometry):
+		wells = None
+		if self.wells.strip() != "":
+			wells = parse_selection(self.wells, WellPlan(geometry.ordering).positions)
+		return WellPlan(geometry.ordering, wells, self.order, geometry.distance)
+
+"""
+JobQueue Class
+
+The list of jobs, saved as JSON. Saves go to a temporary file that replaces
+the old one only once it is safely on disk, so a crash never leaves half a
+queue behind. A job that was running when the program stopped goes back to
+pending when the queue is loaded.
+"""
+
+class JobQueue:
+	def __init__(self, path=JOB_QUEUE_PATH):
+		self.path = path
+		self.jobs = []
+		self.next_id = 1
+		self.load()
+
+	def load(self):
+		if not os.path.exists(self.path):
+			return
+		with open(self.path) as f:
+			data = json.load(f)
+		self.jobs = [Job.from_dict(job) for job in data["jobs"]]
+		self.next_id = data.get("next_id", 1)
+		for job in self.jobs:
+			if job.status == "running":
+				job.status = "pending"
+				job.message = "interrupted"
+
+	def save(self):
+		os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+		temp_path = self.path + ".tmp"
+		with open(temp_path, "w") as f:
+			json.dump({"next_id": self.next_id, "jobs": [job.to_dict() for job in self.jobs]}, f, indent=1)
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(temp_path, self.path)
+
+	def add(self, job):
+		job.id = self.next_id
+		self.next_id += 1
+		self.jobs.append(job)
+		self.save()
+		return job
+
+	def remove(self, job_id):
+		self.jobs = [job for job in self.jobs if job.id != job_id]
+		self.save()
+
+	# Forget jobs that are over, keeping pending ones
+	def clear_finished(self):
+		self.jobs = [job for job in self.jobs if job.status in ("pending", "running")]
+		self.save()
+
+	# The first job still waiting to run, if any
+	def next_pending(self):
+		for job in self.jobs:
+			if job.status == "pending":
+				return job
+		return None
+
+	def set_status(self, job, status, message=""):
+		job.status = status
+		job.message = message
+		self.save()
+
+"""
+JobRunner Class
+
+Runs the pending jobs one after another on an event loop (TkLoop or
+HeadlessLoop). Listeners are called as listener(event, runner) with:
+- "start": a job has started, runner.job and runner.fractionation are set
+  and runner.index is the well it starts from
+- "end": a job is over, with its status on runner.job, and
+  runner.fractionation is None if it failed before it could start
+- "hold": holding for runner.job.hold seconds before the next job
+- "waiting": waiting for proceed() once the next plate is in place
+- "idle": no pending jobs are left
+- "stopped": the queue was stopped
+run_listeners are added to every Fractionation the runner starts, and each
+run is written to the RunJournal and the RunLog if they are given.
+
+The needle is over A1 when the queue starts, and every run ends back at
+the start of the axes rather than over A1, so plates without labware all
+take A1 from where the needle was when the queue started.
+"""
+
+class JobRunner:
+	def __init__(self, queue, loop, gantry, dispenser, clock, journal=None, log=None):
+		self.queue = queue
+		self.loop = loop
+		self.gantry = gantry
+		self.dispenser = dispenser
+		self.clock = clock
+		self.journal = journal
+		self.log = log
+		self.listeners = []
+		self.run_listeners = []
+
+		self.state = "idle"
+		self.job = None
+		self.fractionation = None
+		self.index = 0
+		self.task = None
+
+		# Position of A1 for plates without labware, set when the queue starts
+		self.origin = None
+
+	def emit(self, event):
+		for listener in self.listeners:
+			listener(event, self)
+
+	# Whether the runner is doing something that needs no input
+	def is_busy(self):
+		return self.state in ("running", "hold")
+
+	# Start on the first pending job, with the plate already in place
+	# Given a Resume for that job, carry on from its first unfinished well
+	def start(self, resume=None):
+		if self.is_busy():
+			return
+		self.origin = self.gantry.position()
+		self.run_job(resume)
+
+	# Carry on once the next plate is in place
+	def proceed(self):
+		if self.state == "waiting":
+			self.run_job()
+
+	# Abandon the current job and stop taking jobs off the queue
+	def stop(self):
+		if self.task is not None:
+			self.loop.cancel(self.task)
+			self.task = None
+		if self.state == "running":
+			self.fractionation.stop()
+		self.state = "stopped"
+		self.emit("stopped")
+
+	def run_job(self, resume=None):
+		self.task = None
+		self.job = self.queue.next_pending()
+		if self.job is None:
+			self.state = "idle"
+			self.emit("idle")
+			return
+
+		# A job that cannot be set up, or would take the needle out of
+		# reach, fails without holding up the rest
+		try:
+			if resume is not None and resume.job.id == self.job.id:
+				origin = self.origin = resume.origin
+				geometry, plan = resume.plan()
+				index = resume.next_index
+			else:
+				resume = None
+				origin = self.origin
+				geometry = self.job.geometry(origin)
+				plan = self.job.plan(geometry)
+				index = 0
+			cycle = self.job.cycle(self.dispenser.flow)
+			schedule = compile_run(self.gantry, geometry, plan, cycle, index)
+		except (OSError, ValueError, KeyError) as e:
+			self.fractionation = None
+			self.queue.set_status(self.job, "failed", str(e))
+			self.emit("end")
+			self.between_jobs()
+			return
+
+		self.state = "running"
+		self.queue.set_status(self.job, "running")
+		self.fractionation = make_fractionation(self.loop, self.gantry, self.dispenser, self.clock, geometry, plan, cycle, schedule)
+		if self.journal is not None:
+			self.journal.attach(self.fractionation, self.job, origin, resume is not None)
+		if self.log is not None:
+			self.log.attach(self.fractionation, self.job)
+		self.fractionation.listeners.extend(self.run_listeners)
+		self.fractionation.listeners.append(self.fractionation_event)
+		self.index = index
+		self.emit("start")
+		self.fractionation.start(index)
+
+	def fractionation_event(self, event, run):
+		if event == "finished":
+			self.queue.set_status(self.job, "done")
+			self.emit("end")
+			self.between_jobs()
+		elif event == "stopped":
+			self.queue.set_status(self.job, "stopped")
+			self.emit("end")
+
+	# Hold or wait for the plate to be changed before the next job
+	def between_jobs(self):
+		self.job = self.queue.next_pending()
+		if self.job is None:
+			self.state = "idle"
+			self.emit("idle")
+		elif self.job.hold is not None:
+			self.state = "hold"
+			self.emit("hold")
+			self.task = self.loop.call_later(self.job.hold, self.run_job)
+		else:
+			self.state = "waiting"
+			self.emit("waiting")
@@ -0,0 +1,180 @@
+"""
+Run journal
+
+An append-only record of a fractionation, one JSON object per line, so that
+a run cut short by a crash or power cut can carry on from the first well
+that was not finished instead of starting the plate again.
+
+The first line holds the job, the origin and the planned wells. After that a
+line is added whenever the needle sets off for a well, the pump turns on or
+off, and when the run ends, each with the motor positions at that moment.
+Those positions are always taken while the motors are standing still.
+
+Lines are handed to a writer thread, which writes whatever has built up and
+then syncs the file once, so the run itself never waits on the disk and the
+pump timing is not disturbed.
+"""
+import json
+import os
+import queue
+import threading
+import time
+
+from jobs import Job
+
+# Where the journal of the current run is kept
+RUN_JOURNAL_PATH = os.path.join(os.path.expanduser("~"), ".local", "share", "robotic-fractionator", "run.journal")
+
+# Fractionation events that are written to the journal
+JOURNAL_EVENTS = ("move", "pump", "done", "finished", "stopped")
+
+class RunJournal:
+	def __init__(self, path=RUN_JOURNAL_PATH):
+		self.path = path
+		self.lines = queue.Queue()
+		self.thread = None
+
+	# Start journaling a run, starting a new journal or adding to the old one
+	# when resuming
+	def attach(self, run, job, origin, resuming=False):
+		self.close()
+		self.lines = queue.Queue()
+		os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+		f = open(self.path, "a" if resuming else "w")
+
+		# The first line is written straight away, before anything moves
+		header = {"event": "resume" if resuming else "begin", "time": time.time(), "job": job.to_dict(),
+			"origin": list(origin), "wells": run.plan.wells, "state": run.gantry.state()}
+		f.write(json.dumps(header) + "\n")
+		f.flush()
+		os.fsync(f.fileno())
+
+		self.thread = threading.Thread(target=self.write, args=(f,), daemon=True)
+		self.thread.start()
+		run.listeners.append(self.record)
+
+	# Listener for Fractionation events
+	def record(self, event, run):
+		if event not in JOURNAL_EVENTS:
+			return
+		self.lines.put(json.dumps({"event": event, "time": time.time(), "index": run.plan_index, "state": run.gantry.state()}))
+		if event in ("finished", "stopped"):
+			self.lines.put(None)
+
+	# Write lines as they come, syncing once for each batch
+	def write(self, f):
+		with f:
+			while True:
+				line = self.lines.get()
+				batch = []
+				while line is not None:
+					batch.append(line)
+					try:
+						line = self.lines.get_nowait()
+					except queue.Empty:
+						break
+				if batch:
+					f.write("\n".join(batch) + "\n")
+					f.flush()
+					os.fsync(f.fileno())
+				if line is None:
+					return
+
+	# Wait for everything so far to reach the disk
+	def close(self):
+		if self.thread is not None:
+			self.lines.put(None)
+			self.thread.join()
+			self.thread = None
+
+"""
+Resume Class
+
+What is left of an unfinished run, read back from its journal: the job,
+the origin and planned wells, the motor positions when the journal ends
+and whether they were measured from home, and the index of the first well
+that was not finished.
+"""
+
+class Resume:
+	def __init__(self, header, records):
+		self.job = Job.from_dict(header["job"])
+		self.origin = tuple(header["origin"])
+		self.wells = header["wells"]
+		self.state = header["state"]
+		self.homed = self.state.get("homed", False)
+
+		done = [record["index"] for record in records if record["event"] == "done"]
+		self.next_index = max(done) + 1 if done else 0
+		self.interrupted = None
+		self.moving = False
+		if records:
+			self.state = records[-1]["state"]
+
+			# Stopping a run does not wait for the needle or change the pump
+			# state, so look at what was happening before that
+			events = [record for record in records if record["event"] != "stopped"]
+			last = events[-1] if events else records[-1]
+
+			# The pump was on when the journal ends, so this well already
+			# has some liquid in it
+			if last["event"] == "pump":
+				self.interrupted = self.wells[last["index"]]
+
+			# The needle may have stopped anywhere on its way to a well
+			self.moving = last["event"] == "move"
+
+	# Rebuild the geometry and plan of the run, which must still visit the
+	# same wells in the same order
+	def plan(self):
+		geometry = self.job.geometry(self.origin)
+		plan = self.job.plan(geometry)
+		if plan.wells != self.wells:
+			raise ValueError("The plate no longer matches the journal")
+		return geometry, plan
+
+	# Raises ValueError if the motors cannot be taken to be where the journal
+	# ends, given whether the axes are homed before resuming: a needle
+	# stopped part way through a move could be anywhere on its way, so only
+	# homing finds it again, and homing only helps if the run's positions
+	# were measured from home in the first place (otherwise it moves every
+	# well of the run)
+	def check_position(self, homing):
+		if self.moving and not self.homed:
+			raise ValueError("The needle stopped part way through a move and the run was not homed, so where it is is not known; start the plate again")
+		if homing and not self.homed:
+			raise ValueError("The run was not homed, so its positions do not hold once the axes are homed; resume without homing or start the plate again")
+		if self.moving and not homing:
+			raise ValueError("The needle stopped part way through a move, home the axes before resuming")
+
+	# One line summary
+	def describe(self):
+		text = "Unfinished run: %d of %d wells done" % (self.next_index, len(self.wells))
+		if self.interrupted is not None:
+			text += ", pump was on over " + self.interrupted
+		if self.moving:
+			text += ", needle was moving"
+		return text
+
+# Read the journal at a path, returning a Resume if it ends part way
+# through a run and None if there is nothing to resume
+def read_journal(path=RUN_JOURNAL_PATH):
+	if not os.path.exists(path):
+		return None
+	header = None
+	records = []
+	with open(path) as f:
+		for line in f:
+			try:
+				record = json.loads(line)
+			except ValueError:
+				# A line cut off by the crash
+				break
+			if record["event"] == "begin":
+				header = record
+				records = []
+			else:
+				records.append(record)
+	if header is None or (records and records[-1]["event"] == "finished"):
+		return None
+	return Resume(header, records)
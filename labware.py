@@ -0,0 +1,91 @@
+"""
+Labware geometry
+
+Compiles an Opentrons labware definition into a table of well positions in
+motor space: how far the table and carriage sliders need to be, in cm, for
+the needle to sit over each well. Every well keeps its own x/y from the
+definition, so irregular layouts are followed exactly and motion can target
+absolute positions instead of adding up well sized steps.
+
+Compiled labware is kept for the rest of the session, keyed by a hash of
+the definition file, so loading the same plate again skips parsing it.
+"""
+from array import array
+import hashlib
+import json
+
+from wellplan import grid_ordering
+
+##  GEOMETRY CONSTANTS  ##
+# - Table position of a well is TABLE_OFFSET_IN_CM - x
+# - Carriage position of a well is (plate depth - y) + CARRIAGE_OFFSET_IN_CM
+# - Opentrons definitions are in mm
+TABLE_OFFSET_IN_CM = 15.0
+CARRIAGE_OFFSET_IN_CM = -0.5
+CM_PER_MM = 0.1
+
+"""
+Labware Class
+
+Well names, the Opentrons ordering and an array of table and carriage
+positions (cm) indexed in the same order as the names.
+"""
+
+class Labware:
+	def __init__(self, ordering, table, carriage):
+		self.ordering = ordering
+		self.names = [name for column in ordering for name in column]
+		self.index = {name: i for i, name in enumerate(self.names)}
+		self.table = table
+		self.carriage = carriage
+		self.rows = len(ordering[0]) if ordering else 0
+		self.cols = len(ordering)
+
+		# Nominal spacing between the first two wells of a column
+		self.well_size = abs(carriage[1] - carriage[0]) if self.rows > 1 else 0.0
+
+	# Plain grid of evenly spaced wells with A1 at a known position
+	@classmethod
+	def uniform(cls, rows, cols, well_size, origin):
+		ordering = grid_ordering(rows, cols)
+		table = array("d", (origin[0] - c * well_size for c in range(cols) for r in range(rows)))
+		carriage = array("d", (origin[1] + r * well_size for c in range(cols) for r in range(rows)))
+		return cls(ordering, table, carriage)
+
+	# Build from a parsed Opentrons definition
+	@classmethod
+	def from_definition(cls, data):
+		ordering = data["ordering"]
+		wells = data["wells"]
+		depth = data["dimensions"]["yDimension"]
+		names = [name for column in ordering for name in column]
+		table = array("d", (TABLE_OFFSET_IN_CM - CM_PER_MM * wells[name]["x"] for name in names))
+		carriage = array("d", (CM_PER_MM * (depth - wells[name]["y"]) + CARRIAGE_OFFSET_IN_CM for name in names))
+		return cls(ordering, table, carriage)
+
+	# Table and carriage position of a well in cm
+	def position(self, name):
+		i = self.index[name]
+		return (self.table[i], self.carriage[i])
+
+	# Whether this labware has the given number of rows and columns
+	def matches(self, rows, cols):
+		return self.rows == rows and self.cols == cols
+
+	# Travel distance between two wells in cm along the slower axis, since
+	# the table and carriage move at the same time
+	def distance(self, a, b):
+		i, j = self.index[a], self.index[b]
+		return max(abs(self.table[i] - self.table[j]), abs(self.carriage[i] - self.carriage[j]))
+
+# Compiled labware already loaded in this session, keyed by content hash
+compiled = {}
+
+# Load a labware definition, compiling it the first time it is seen
+def load_labware(path):
+	with open(path, "rb") as f:
+		content = f.read()
+	key = hashlib.sha256(content).hexdigest()
+	if key not in compiled:
+		compiled[key] = Labware.from_definition(json.loads(content))
+	return compiled[key]
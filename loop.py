@@ -0,0 +1,104 @@
+"""
+Event loops
+
+The fractionation sequence only needs two things from an event loop: a way
+to call a function after a delay, and a way to hear back from the workers
+that run moves and dispenses on their own threads. TkLoop provides them on top of a Tk widget for the
+GUI, and HeadlessLoop provides them on its own for scripted runs.
+
+With a virtual clock both loops jump the clock forwards instead of waiting,
+so a whole plate replays in seconds.
+"""
+import heapq
+import itertools
+import queue
+
+# How often the GUI checks for finished moves, in milliseconds
+MOTION_POLL_MS = 10
+
+class TkLoop:
+	def __init__(self, widget, clock, motion):
+		self.widget = widget
+		self.clock = clock
+		self.workers = [motion]
+		self.poll_motion()
+
+	# Also hand back results from another worker
+	def add_worker(self, worker):
+		self.workers.append(worker)
+
+	# Call a function after a number of seconds
+	def call_later(self, seconds, callback):
+		if self.clock.virtual:
+			self.clock.sleep(seconds)
+			return self.widget.after(1, callback)
+		return self.widget.after(round(seconds * 1000), callback)
+
+	def cancel(self, task):
+		self.widget.after_cancel(task)
+
+	# Hand finished moves and dispenses back to the GUI thread
+	def poll_motion(self):
+		for worker in self.workers:
+			worker.poll()
+		self.widget.after(MOTION_POLL_MS, self.poll_motion)
+
+class HeadlessLoop:
+	def __init__(self, clock, motion):
+		self.clock = clock
+		self.workers = []
+		self.timers = []
+		self.cancelled = set()
+		self.counter = itertools.count()
+
+		# The workers poke this queue to wake the loop up
+		self.wakeups = queue.Queue()
+		self.add_worker(motion)
+
+	# Also hand back results from another worker
+	def add_worker(self, worker):
+		self.workers.append(worker)
+		if not self.clock.virtual:
+			worker.notify = lambda: self.wakeups.put_nowait(None)
+
+	# Call a function after a number of seconds
+	def call_later(self, seconds, callback):
+		task = next(self.counter)
+		heapq.heappush(self.timers, (self.clock.now() + seconds, task, callback))
+		return task
+
+	def cancel(self, task):
+		self.cancelled.add(task)
+
+	# Run timers and worker callbacks until done() returns True
+	# Returns False if there was nothing left that could make done() true
+	def run_until(self, done):
+		while not done():
+			for worker in self.workers:
+				worker.poll()
+			if done():
+				break
+
+			# Skip over cancelled timers
+			while self.timers and self.timers[0][1] in self.cancelled:
+				self.cancelled.discard(heapq.heappop(self.timers)[1])
+
+			if self.clock.virtual:
+				# Workers finish inline, so anything left is a timer
+				if any(not worker.results.empty() for worker in self.workers):
+					continue
+				if not self.timers:
+					return False
+				self.clock.sleep_until(self.timers[0][0])
+			else:
+				# Sleep until the next timer, or until a worker finishes
+				timeout = max(0.0, self.timers[0][0] - self.clock.now()) if self.timers else None
+				try:
+					self.wakeups.get(timeout=timeout)
+					continue
+				except queue.Empty:
+					pass
+
+			deadline, task, callback = heapq.heappop(self.timers)
+			callback()
+		return True
@@ -1,105 +1,52 @@
 # Import statements
-from time import sleep, time
-from math import floor
 import tkinter as tk
-import json
+import os
+import sys
+from time import perf_counter
 
-# Raspi specific imports
-from adafruit_motorkit import MotorKit
-from adafruit_motor import stepper
-from gpiozero import LED
+# Hardware is reached through a backend so that the GUI can also run
+# against the simulator on machines that are not a Raspberry Pi
+from hardware import make_backend
+from gantry import open_gantry
+from loop import TkLoop
+from fractionation import make_fractionation
+from dispenser import Dispenser
+from jobs import Job, JobQueue, JobRunner
+from journal import RunJournal, read_journal, RUN_JOURNAL_PATH
+from runlog import RunLog, RUN_LOG_DIR
+from wellplan import WellPlan, ORDERS, parse_selection
+from labware import Labware, load_labware
+from plate_view import PlateView
+from profiler import StepProfiler
+from calibration import load_calibration, save_calibration
+from flow import FlowModel
+from telemetry import Telemetry, TELEMETRY_HOST
+from schedule import compile_run, format_duration
 
-##  GLOBAL CONSTANTS  ##
-# - NEMA 17 data taken from motor datasheet
-# - Lead screw pitch is as designed
-NEMA_17_STEPS_PER_DEGREE = 3200.0 / 360.0
-LEAD_SCREW_PITCH_IN_CM = 4.0
+# Time between updates of the progress label in milliseconds
+PROGRESS_MS = 1000
 
-"""
-StepperMotor Class
+# Time between updates of the position label in Manual mode in milliseconds
+POSITION_MS = 100
 
-Used to keep track of stepper motor states. All angles in degrees
-"""
+# Arrow keys that jog an axis in Manual mode, as (axis, forwards)
+JOG_KEYS = {"Left": ("table", False), "Right": ("table", True), "Down": ("carriage", False), "Up": ("carriage", True)}
 
-class StepperMotor:
-	def __init__(self, index, steps_per_degree, lead_screw_pitch, reverse=False):
-		kit = MotorKit()
-		
-        # Index determines whether we are using the table or carriage motor
-		self.motor = kit.stepper2 if index == 2 else kit.stepper1
-		self.angle = 0.0
-		self.steps_per_degree = steps_per_degree
-		self.cm_per_deg = lead_screw_pitch / 360.0
-
-        # Reverse keep track of whether the motor is reversed or not
-        # That is, which way does it need to turn to push the slider
-        # in a specific direction
-		self.reverse = reverse
-
-        # Keeps track of which direction the needle is moving during fractionation
-		self.forwards = True
-	
-    # Get current angle of the motor shaft (unbounded)
-	def get_angle(self):
-		return self.angle
-		
-    # Tares the motor angle
-	def tare(self):
-		self.angle = 0.0
-		
-    # Releases the motor hold to prevent unnecessary energy usage and
-    # overheating
-	def release(self):
-		self.motor.release()
-	
-    # Turn the motor shaft a number of degrees relative to its current position
-	def move_relative(self, angle):
-		backlash = 0.3 / self.cm_per_deg
-		
-		if self.forwards and angle < 0:
-			angle -= backlash
-			self.forwards = False
-		elif not self.forwards and angle > 0:
-			angle += backlash
-			self.forwards = True
-		
-		steps_needed = floor(self.steps_per_degree * angle)
-		
-		# FORWARD if positive angle and not reversed or if negative angle and reversed
-		
-		direction = stepper.FORWARD if (angle > 0 and not self.reverse) or (angle < 0 and self.reverse) else stepper.BACKWARD
-		
-		for _ in range(0, abs(steps_needed)):
-			self.motor.onestep(direction=direction, style=stepper.MICROSTEP)
-			sleep(0.0001)
-	
-		self.angle = self.angle + steps_needed / self.steps_per_degree
-		
-		self.release()
+# Holding a key repeats its press and release, so a jog only stops once the
+# key has been up this many milliseconds
+KEY_REPEAT_MS = 60
+
+# Bit of a key event's state that is set while Shift is held
+SHIFT_MASK = 0x1
 
-    # Turn the motor shaft to a specific angle relative to its
-    # initial starting position
-	def move_absolute(self, angle):
-		delta_angle = angle - self.angle
-		self.move_relative(delta_angle)
-	
-    # Move the slider on this motor a number of centimeters
-    # relative to its current position
-	def move_dist_relative(self, dist):
-		self.move_relative(dist / self.cm_per_deg)
-		
-    # Move the slider on this motor to a specific position
-    # relative to its initial starting position (also in centimeters)
-	def move_dist_absolute(self, dist):
-		self.move_absolute(dist / self.cm_per_deg)
-		
 # Composite widget to take advantage of code reuse
 # Consists of a label and a text edit for user input
+# Pass a StringVar to share the value with entries on other screens
 class TextEntry:
-	def __init__(self, window, text, row):
-		self.label = tk.Label(text=text)
+	def __init__(self, window, text, row, var=None):
+		self.label = tk.Label(window, text=text)
 		self.label.grid(row=row, column=0, columnspan=1)
-		self.var = tk.StringVar()
+		self.var = var if var is not None else tk.StringVar()
 		self.entry = tk.Entry(window, textvariable=self.var)
 		self.entry.grid(row=row, column=1, columnspan=2, sticky="we")
 	
@@ -109,282 +56,397 @@ class TextEntry:
 		
     # Set the text entry to a specific string value
 	def set(self, text):
-		self.entry.delete(0, tk.END)
-		self.entry.insert(0, text)
+		self.var.set(text)
 		
     # Remove the widget from the screen
 	def grid_forget(self):
 		self.label.grid_forget()
 		self.entry.grid_forget()
+
+# Plate settings shared by the Automated and Manual screens, so a value
+# entered on one is there on the other
+class PlateSettings:
+	def __init__(self):
+		self.rows = tk.StringVar()
+		self.cols = tk.StringVar()
+		self.well_size = tk.StringVar()
+		self.wells = tk.StringVar()
+		self.order = tk.StringVar(value=ORDERS[0])
+		self.continuous = tk.BooleanVar(value=False)
+		self.table = tk.StringVar()
+		self.carriage = tk.StringVar()
 		
 # Main application class
 class App(tk.Tk):
-	def __init__(self):
+	def __init__(self, backend, profiler=None, home=False, serve=None, serve_host=TELEMETRY_HOST, journal_path=RUN_JOURNAL_PATH, log_dir=RUN_LOG_DIR, binary_log=False):
+		start = perf_counter()
 		super().__init__()
 		self.title("Robotic Fractionator GUI v0.1")
+
+		# Backend that provides the motor drivers, pump and clock
+		self.backend = backend
+		self.clock = backend.clock
+
+		# Optional StepProfiler shared by both motors
+		self.profiler = profiler
+
+		# Moves run on a worker thread so the GUI never blocks on the motors
+		calibration = load_calibration()
+		self.gantry = open_gantry(backend, profiler, calibration)
+		self.table_motor = self.gantry.table_motor
+		self.carriage_motor = self.gantry.carriage_motor
+		self.loop = TkLoop(self, self.clock, self.gantry.motion)
+
+        # Create the pump object
+        # We use an LED object because digital output of 1 or 0
+        # Is the same for the pump as it is for an LED
+		# The dispenser runs the pump for each well on its own thread, timed
+		# by the pump's calibrated flow
+		self.pump = self.backend.pump()
+		self.pump_is_on = False
+		self.dispenser = Dispenser(self.pump, self.clock, FlowModel.from_dict(calibration.get("flow")))
+		self.loop.add_worker(self.dispenser.worker)
+
+		# Optionally serve the run state and controls on a port, so runs can
+		# be watched from elsewhere
+		self.telemetry = None
+		if serve is not None:
+			self.telemetry = Telemetry(self.loop, self.gantry, self.pump, self.clock, serve_host, serve)
+			self.telemetry.start()
+
+		# Plates queued to run back to back, kept on disk between sessions
+		self.jobs = JobQueue()
+		self.runner = None
+
+		# Every run is journaled, and a run that was cut short last time
+		# can carry on from where the motors stopped
+		self.journal = RunJournal(journal_path)
+
+		# Every run is also logged for looking over afterwards
+		self.run_log = RunLog(log_dir, binary_log)
+		# A needle that stopped part way through a move has to be homed
+		# instead (see resume_run)
+		self.unfinished = read_journal(journal_path)
+		if self.unfinished is not None and not self.unfinished.moving:
+			self.gantry.restore(self.unfinished.state)
+
+        # Define all variables
+		self.settings = PlateSettings()
+		self.ROWS = 0
+		self.COLS = 0
+		self.well_size = 0
+		self.pump_time = 0.0
+		self.cycle = None
+		self.schedule = None
 		
-        # Initialize in the automated fractionation mode
-		self.mode = "Automated"
+        # Current state of fractionation
+		self.run = None
+		self.x = 0
+		self.y = 0
+		self.plan = None
+		self.plan_index = 0
+		self.origin = (0.0, 0.0)
+		self.geometry = None
+
+		# When the last well of the run was done and how far behind the
+		# schedule it was, and the timer that keeps the label up to date
+		self.last_done = None
+		self.late = None
+		self.progress_task = None
+
+		# Compiled labware from the last loaded JSON file, if any
+		self.labware = None
+		self.labware_path = None
+
+		# The jog in progress in Manual mode: the event that stops it, the
+		# arrow key driving it and the timer that stops it once the key is
+		# let go
+		self.coarse_jog = tk.BooleanVar(value=False)
+		self.jog_release = None
+		self.jog_key = None
+		self.jog_stop_task = None
+		self.position_task = None
+
+		# Each mode has its own screen, built once and shown when needed
 		self.mode_btn = tk.Button(self, text="Mode: Automated", command=self.cycle_mode)
 		self.mode_btn.grid(row=0, column=0, columnspan=3, sticky="we")
+		for i in range(3):
+			self.grid_columnconfigure(i, weight=1, uniform="a")
+		self.frames = {
+			"Automated": self.build_automated(tk.Frame(self)),
+			"Manual": self.build_manual(tk.Frame(self)),
+			"Cleaning": self.build_cleaning(tk.Frame(self)),
+		}
 		
-		self.set_mode_automated(True)
+        # Initialize in the automated fractionation mode
+		self.mode = "Automated"
+		self.frames[self.mode].grid(row=1, column=0, columnspan=3, sticky="nsew")
+
+		# The arrow keys jog the needle in Manual mode
+		self.bind("<KeyPress>", self.key_pressed)
+		self.bind("<KeyRelease>", self.key_released)
+
+        # Move the motors a small distance to better initialize, or home
+		# them if asked to
+		if home:
+			self.home_gantry(False)
+		else:
+			self.gantry.initialize()
+
+		# Time taken to open the hardware and build the screens
+		self.startup_time = perf_counter() - start
+		self.mode_switch_times = []
 	
     # Cycle between the different modes
     # Automated -> Manual -> Cleaning -> Automated
+	# The time each switch takes is kept in mode_switch_times
 	def cycle_mode(self):
+		start = perf_counter()
+		self.frames[self.mode].grid_remove()
 		if self.mode == "Automated":
 			self.mode = "Manual"
-			self.set_mode_manual()
 		elif self.mode == "Manual":
 			self.mode = "Cleaning"
-			self.set_mode_cleaning()
 		elif self.mode == "Cleaning":
 			self.mode = "Automated"
-			self.set_mode_automated(False)
+		self.frames[self.mode].grid(row=1, column=0, columnspan=3, sticky="nsew")
+
+		# Keep the position up to date in Manual mode, and never leave a jog
+		# running in another
+		if self.mode == "Manual":
+			self.refresh_position()
+		else:
+			self.stop_jog()
 		
 		self.mode_btn["text"] = "Mode: " + self.mode
-		
-    # Handle changing the screen to automated mode
-	def set_mode_automated(self, first):
-        # If this is not the initial bootup of the app, 
-        # remove the Cleaning widgets from the screen
-		if not first:
-			self.carriage_lbl.grid_forget()
-			self.carriage_entry.grid_forget()
-			self.movement_btn.grid_forget()
-			self.pump_btn.grid_forget()
-			self.progress_lbl.grid_forget()
-        else:
-			self.step_lbl = tk.Label(text="")
-			self.step_forwards_btn = tk.Button(self, text="", command=lambda: self.manual_step(True))
-			self.step_backwards_btn = tk.Button(self, text="", command=lambda: self.manual_step(False))
-		
+		self.mode_switch_times.append(perf_counter() - start)
+		
+	# Startup and mode switch times
+	def timing_report(self):
+		text = "Startup: %.1f ms" % (1000 * self.startup_time)
+		if self.mode_switch_times:
+			text += "\nMode switches: %d, mean %.1f ms, worst %.1f ms" % (len(self.mode_switch_times),
+				1000 * sum(self.mode_switch_times) / len(self.mode_switch_times), 1000 * max(self.mode_switch_times))
+		return text
+		
+    # Build the automated mode screen
+	def build_automated(self, frame):
         # Add the JSON file select widgets
-		self.json_lbl = tk.Label(text="Load well plate file: ")
-		self.json_lbl.grid(row=1, column=0, columnspan=1)
-		self.json_entry = tk.Entry(self)
+		tk.Label(frame, text="Load well plate file: ").grid(row=1, column=0, columnspan=1)
+		self.json_entry = tk.Entry(frame)
 		self.json_entry.grid(row=1, column=1, columnspan=1)
-		self.json_btn = tk.Button(self, text="Load", command=self.load_json)
-		self.json_btn.grid(row=1, column=2, columnspan=1, sticky="we")
+		tk.Button(frame, text="Load", command=self.load_json).grid(row=1, column=2, columnspan=1, sticky="we")
 		
         # Add the manual text entry widgets
-		self.rows_text_entry = TextEntry(self, "Enter # of rows:", 2)
-		self.cols_text_entry = TextEntry(self, "Enter # of columns:", 3)
-		self.ws_text_entry = TextEntry(self, "Enter well size in cm:", 4)
-		self.pump_rate_text_entry = TextEntry(self, "Enter pump rate in cc/hr:", 5)
-		self.vol_text_entry = TextEntry(self, "Enter desired volume in cc:", 6)
-		
-        # Add the table/carriage movement entry widgets
-		self.table_lbl = tk.Label(text="Move table to: ")
-		self.table_lbl.grid(row=7, column=0, columnspan=1)
-		self.carriage_lbl = tk.Label(text="Move carriage to: ")
-		self.carriage_lbl.grid(row=8, column=0, columnspan=1)
-		self.table_entry = tk.Entry(self)
-		self.table_entry.grid(row=7, column=1, columnspan=1)
-		self.carriage_entry = tk.Entry(self)
-		self.carriage_entry.grid(row=8, column=1, columnspan=1)
+		self.add_plate_widgets(frame, 2)
+		self.pump_rate_text_entry = TextEntry(frame, "Enter pump rate in cc/hr:", 5)
+		self.vol_text_entry = TextEntry(frame, "Enter desired volume in cc:", 6)
+
+		# Optional settle and dwell times, defaulting to the pump time
+		self.settle_text_entry = TextEntry(frame, "Enter drip settle time in s:", 7)
+		self.dwell_text_entry = TextEntry(frame, "Enter dwell time in s:", 8)
+
+		# Add the well selection widgets
+		self.add_plan_widgets(frame, 9)
 		
-        # Add the move button
-		self.movement_btn = tk.Button(self, text="Move", command=self.set_table_carriage)
-		self.movement_btn.grid(row=7, column=2, columnspan=1, rowspan=2, sticky="we")
+        # Add the table/carriage movement entry widgets and move button
+		self.add_movement_widgets(frame, 11)
 		
         # Ensure the columns are laid out properly
 		for i in range(3):
-			self.grid_columnconfigure(i, weight=1, uniform="a")
+			frame.grid_columnconfigure(i, weight=1, uniform="a")
 			
         # Add the pump toggle button
-		self.pump_btn = tk.Button(self, text="Toggle pump", command=self.toggle_pump)
-		self.pump_btn.grid(row=9, column=0, columnspan=3, sticky="we")
+		tk.Button(frame, text="Toggle pump", command=self.toggle_pump).grid(row=13, column=0, columnspan=2, sticky="we")
+
+		# Keep the pump on and move between wells in the flow
+		tk.Checkbutton(frame, text="Continuous flow", variable=self.settings.continuous).grid(row=13, column=2, columnspan=1, sticky="w")
 		
         # Add the start button
-		self.btn = tk.Button(self, text="Begin fractionation", command=self.run_checks)
-		self.btn.grid(row=10, column=0, columnspan=3, sticky="we")
+		tk.Button(frame, text="Begin fractionation", command=self.run_checks).grid(row=14, column=0, columnspan=3, sticky="we")
 		
         # Add the pause button
-		self.pause_btn =tk.Button(self, text="Click to pause", command = self.toggle_pause)
-		self.pause_btn.grid(row=11, column=0,columnspan=3, sticky="we")
-		self.is_paused = False
+		self.pause_btn = tk.Button(frame, text="Click to pause", command = self.toggle_pause)
+		self.pause_btn.grid(row=15, column=0,columnspan=3, sticky="we")
 			
         # Add the progress label
-		self.progress_lbl = tk.Label(text="System idle.")
-		self.progress_lbl.grid(row=12, column=0, columnspan=3, sticky="we")
+		self.progress_lbl = tk.Label(frame, text="System idle.")
+		self.progress_lbl.grid(row=16, column=0, columnspan=3, sticky="we")
 
         # Add the canvas for showing current progress
-		self.canvas = tk.Canvas(self, width=500, height=300, bd=0, highlightthickness=0)
-		self.canvas.grid(row = 13, column = 0, columnspan=3)
-			
-        # Initialize the motor objects
-		self.table_motor = StepperMotor(2, NEMA_17_STEPS_PER_DEGREE, LEAD_SCREW_PITCH_IN_CM, True)
-		self.carriage_motor = StepperMotor(1, NEMA_17_STEPS_PER_DEGREE, LEAD_SCREW_PITCH_IN_CM, True)
-		
-        # Create the pump object if booting up
-        # We use an LED object because digital output of 1 or 0
-        # Is the same for the pump as it is for an LED
-		if first:
-			self.pump = LED("5")
-		
-        # Move the motors a small distance to better initialize
-		self.table_motor.move_dist_relative(-0.1)
-		self.carriage_motor.move_dist_relative(-0.1)
-		self.pump_is_on = False
-		
-        # Define all variables
-		self.ROWS = 0
-		self.COLS = 0
-		self.well_size = 0
-		self.pump_time = 0.0
-		
-        # Keep track of taskID for pausing
-		self.taskId = None
-		self.state = "idle"
-		
-        # Current state of fractionation
-		self.x = 0
-		self.y = 0
-		self.carriage_forwards = True
-		
-    # Handle changing the screen to manual mode
-	def set_mode_manual(self):
-        # Remove all Automated mode widgets
-		self.json_lbl.grid_forget()
-		self.json_entry.grid_forget()
-		self.json_btn.grid_forget()
-		self.rows_text_entry.grid_forget()
-		self.cols_text_entry.grid_forget()
-		self.ws_text_entry.grid_forget()
-		self.pump_rate_text_entry.grid_forget()
-		self.vol_text_entry.grid_forget()
-		self.table_lbl.grid_forget()
-		self.table_entry.grid_forget()
-		self.pump_btn.grid_forget()
-		self.btn.grid_forget()
-		self.pause_btn.grid_forget()
-		self.progress_lbl.grid_forget()
-		self.canvas.grid_forget()
-		self.carriage_lbl.grid_forget()
-		self.carriage_entry.grid_forget()
-		self.movement_btn.grid_forget()
-		
+		canvas = tk.Canvas(frame, width=500, height=300, bd=0, highlightthickness=0)
+		canvas.grid(row = 17, column = 0, columnspan=3)
+		self.plate_view = PlateView(canvas, 500, 300)
+
+		# Add the job queue widgets
+		self.hold_text_entry = TextEntry(frame, "Hold between plates in s (blank to ask):", 18)
+		tk.Button(frame, text="Add to queue", command=self.add_job).grid(row=19, column=0, columnspan=1, sticky="we")
+		self.queue_run_btn = tk.Button(frame, text="Run queue", command=self.run_queue)
+		self.queue_run_btn.grid(row=19, column=1, columnspan=1, sticky="we")
+		tk.Button(frame, text="Clear finished", command=self.clear_jobs).grid(row=19, column=2, columnspan=1, sticky="we")
+		self.queue_list = tk.Listbox(frame, height=5)
+		self.queue_list.grid(row=20, column=0, columnspan=3, sticky="we")
+		self.show_jobs()
+
+		# Add the resume button if there is a run to resume
+		self.resume_btn = tk.Button(frame, text="Resume unfinished run", command=self.resume_run)
+		if self.unfinished is not None:
+			self.resume_btn.grid(row=21, column=0, columnspan=3, sticky="we")
+			self.progress_lbl["text"] = self.unfinished.describe()
+		return frame
+
+	# Add the rows, columns and well size entries on three rows
+	def add_plate_widgets(self, frame, row):
+		TextEntry(frame, "Enter # of rows:", row, self.settings.rows)
+		TextEntry(frame, "Enter # of columns:", row + 1, self.settings.cols)
+		TextEntry(frame, "Enter well size in cm:", row + 2, self.settings.well_size)
+		
+	# Add the well selection and visiting order widgets on two rows
+	def add_plan_widgets(self, frame, row):
+		TextEntry(frame, "Enter wells (blank for all):", row, self.settings.wells)
+		tk.Label(frame, text="Visiting order:").grid(row=row + 1, column=0, columnspan=1)
+		tk.OptionMenu(frame, self.settings.order, *ORDERS).grid(row=row + 1, column=1, columnspan=2, sticky="we")
+
+	# Add the table/carriage movement entries and the move button on two rows
+	def add_movement_widgets(self, frame, row):
+		tk.Label(frame, text="Move table to: ").grid(row=row, column=0, columnspan=1)
+		tk.Label(frame, text="Move carriage to: ").grid(row=row + 1, column=0, columnspan=1)
+		tk.Entry(frame, textvariable=self.settings.table).grid(row=row, column=1, columnspan=1)
+		tk.Entry(frame, textvariable=self.settings.carriage).grid(row=row + 1, column=1, columnspan=1)
+		tk.Button(frame, text="Move", command=self.set_table_carriage).grid(row=row, column=2, columnspan=1, rowspan=2, sticky="we")
+
+    # Build the manual mode screen
+	def build_manual(self, frame):
 		# Add the manual entry widgets
-		self.rows_text_entry = TextEntry(self, "Enter # of rows:", 1)
-		self.cols_text_entry = TextEntry(self, "Enter # of columns:", 2)
-		self.ws_text_entry = TextEntry(self, "Enter well size in cm:", 3)
+		self.add_plate_widgets(frame, 1)
+
+		# Add the well selection widgets
+		self.add_plan_widgets(frame, 4)
 		
         # Add the table/carriage movement widgets
-		self.table_lbl = tk.Label(text="Move table to: ")
-		self.table_lbl.grid(row=4, column=0, columnspan=1)
-		self.carriage_lbl = tk.Label(text="Move carriage to: ")
-		self.carriage_lbl.grid(row=5, column=0, columnspan=1)
-		self.table_entry = tk.Entry(self)
-		self.table_entry.grid(row=4, column=1, columnspan=1)
-		self.carriage_entry = tk.Entry(self)
-		self.carriage_entry.grid(row=5, column=1, columnspan=1)
-		
-        # Add the Move button
-		self.movement_btn = tk.Button(self, text="Move", command=self.set_table_carriage)
-		self.movement_btn.grid(row=4, column=2, columnspan=1, rowspan=2, sticky="we")
+		self.add_movement_widgets(frame, 6)
 		
         # Add the single step forwards/backwards buttons
-		self.step_lbl = tk.Label(text="Move the needle one step:")
-		self.step_lbl.grid(row=6, column=0, columnspan=1, sticky="we")
-		self.step_forwards_btn = tk.Button(self, text="Forwards", command=lambda: self.manual_step(True))
-		self.step_forwards_btn.grid(row=6, column=1, columnspan=1, sticky="we")
-		self.step_backwards_btn = tk.Button(self, text="Backwards", command=lambda: self.manual_step(False))
-		self.step_backwards_btn.grid(row=6, column=2, columnspan=1, sticky="we")
+		self.step_lbl = tk.Label(frame, text="Move the needle one step:")
+		self.step_lbl.grid(row=8, column=0, columnspan=1, sticky="we")
+		tk.Button(frame, text="Forwards", command=lambda: self.manual_step(True)).grid(row=8, column=1, columnspan=1, sticky="we")
+		tk.Button(frame, text="Backwards", command=lambda: self.manual_step(False)).grid(row=8, column=2, columnspan=1, sticky="we")
+
+		# Add the homing status and buttons
+		self.home_lbl = tk.Label(frame, text="Not homed.")
+		self.home_lbl.grid(row=9, column=0, columnspan=1, sticky="we")
+		tk.Button(frame, text="Home", command=lambda: self.home_gantry(False)).grid(row=9, column=1, columnspan=1, sticky="we")
+		tk.Button(frame, text="Home, measure backlash", command=lambda: self.home_gantry(True)).grid(row=9, column=2, columnspan=1, sticky="we")
+
+		# Add the jog buttons, which run an axis for as long as they are
+		# held, like the arrow keys
+		tk.Label(frame, text="Hold to jog, or use the arrow keys:").grid(row=10, column=0, columnspan=1, sticky="we")
+		tk.Checkbutton(frame, text="Coarse (or hold Shift)", variable=self.coarse_jog).grid(row=11, column=0, columnspan=1, sticky="we")
+		for text, row, column, axis, forwards in (("Table -", 10, 1, "table", False), ("Table +", 10, 2, "table", True),
+				("Carriage -", 11, 1, "carriage", False), ("Carriage +", 11, 2, "carriage", True)):
+			button = tk.Button(frame, text=text)
+			button.grid(row=row, column=column, columnspan=1, sticky="we")
+			button.bind("<ButtonPress-1>", lambda event, axis=axis, forwards=forwards: self.start_jog(axis, forwards, self.coarse_jog.get()))
+			button.bind("<ButtonRelease-1>", lambda event: self.stop_jog())
+
+		# Add the live position of the needle
+		self.position_lbl = tk.Label(frame, text="")
+		self.position_lbl.grid(row=12, column=0, columnspan=3, sticky="we")
 		
         # Make the column layout widths equal
 		for i in range(3):
-			self.grid_columnconfigure(i, weight=1, uniform="a")
+			frame.grid_columnconfigure(i, weight=1, uniform="a")
 			
         # Add pump toggle button
-		self.pump_btn = tk.Button(self, text="Toggle pump", command=self.toggle_pump)
-		self.pump_btn.grid(row=7, column=0, columnspan=3, sticky="we")
+		tk.Button(frame, text="Toggle pump", command=self.toggle_pump).grid(row=13, column=0, columnspan=3, sticky="we")
 		
         # Add canvas for showing progress
-		self.canvas = tk.Canvas(self, width=500, height=300, bd=0, highlightthickness=0)
-		self.canvas.grid(row = 8, column = 0, columnspan=3)
-		
-        # Define variables 
-		self.ROWS = 0
-		self.COLS = 0
-		self.well_size = 0
-		
-        # Current position of needle
-		self.x = 0
-		self.y = 0
-		self.carriage_forwards = True
-		
-	# Handle changing the screen to cleaning mode
-	def set_mode_cleaning(self):
-        # Remove all Manual mode widgets
-		self.rows_text_entry.grid_forget()
-		self.cols_text_entry.grid_forget()
-		self.ws_text_entry.grid_forget()
-		self.pump_btn.grid_forget()
-		self.canvas.grid_forget()
-		self.movement_btn.grid_forget()
-		self.step_lbl.grid_forget()
-		self.step_forwards_btn.grid_forget()
-		self.step_backwards_btn.grid_forget()
+		canvas = tk.Canvas(frame, width=500, height=300, bd=0, highlightthickness=0)
+		canvas.grid(row = 14, column = 0, columnspan=3)
+		self.manual_plate_view = PlateView(canvas, 500, 300)
+		return frame
 		
+	# Build the cleaning mode screen
+	def build_cleaning(self, frame):
         # Add carriage movement widgets
-		self.carriage_lbl = tk.Label(text="Move carriage to: ")
-		self.carriage_lbl.grid(row=1, column=0, columnspan=1)
-		self.carriage_entry = tk.Entry(self)
-		self.carriage_entry.grid(row=1, column=1, columnspan=1)
-		self.carriage_entry.delete(0, tk.END)
-		self.carriage_entry.insert(0, "14.0")
+		tk.Label(frame, text="Move carriage to: ").grid(row=1, column=0, columnspan=1)
+		self.cleaning_carriage = tk.StringVar(value="14.0")
+		tk.Entry(frame, textvariable=self.cleaning_carriage).grid(row=1, column=1, columnspan=1)
 		
         # Add move button
-		self.movement_btn = tk.Button(self, text="Move", command=self.set_table_carriage)
-		self.movement_btn.grid(row=1, column=2, columnspan=1, sticky="we")
+		tk.Button(frame, text="Move", command=self.move_cleaning_carriage).grid(row=1, column=2, columnspan=1, sticky="we")
 		
 		for i in range(3):
-			self.grid_columnconfigure(i, weight=1, uniform="a")
+			frame.grid_columnconfigure(i, weight=1, uniform="a")
 			
         # Add pump toggle button
-		self.pump_btn = tk.Button(self, text="Toggle pump", command=self.toggle_pump)
-		self.pump_btn.grid(row=2, column=0, columnspan=3, sticky="we")
+		tk.Button(frame, text="Toggle pump", command=self.toggle_pump).grid(row=2, column=0, columnspan=3, sticky="we")
 			
         # Add progress label
-		self.progress_lbl = tk.Label(text="System idle.")
-		self.progress_lbl.grid(row=3, column=0, columnspan=3, sticky="we")
-		
-        # Initialize
-		self.table_motor.move_dist_relative(-0.1)
-		self.carriage_motor.move_dist_relative(-0.1)
-		self.pump_is_on = False
-		self.carriage_forwards = True
+		self.cleaning_lbl = tk.Label(frame, text="System idle.")
+		self.cleaning_lbl.grid(row=3, column=0, columnspan=3, sticky="we")
+		return frame
 			
     # Load custom specifications from a JSON file
     # Used Opentrons standard for this
+	# Every well keeps its own position, so irregular plates are followed exactly
 	def load_json(self):
-		json_spec = open(self.json_entry.get())
-		data = json.load(json_spec)
-	
-		r = len(data["ordering"][0])
-		c = len(data["ordering"])
+		self.labware = load_labware(self.json_entry.get())
+		self.labware_path = os.path.abspath(self.json_entry.get())
+		table, carriage = self.labware.position(self.labware.names[0])
 	
-		self.rows_text_entry.set(str(r))
-		self.cols_text_entry.set(str(c))
-		self.ws_text_entry.set(str(abs(data["wells"]["A1"]["y"] - data["wells"]["B1"]["y"]) / 10.0))
-	
-		self.table_entry.delete(0, tk.END)
-		self.table_entry.insert(0, str(15 - data["wells"]["A1"]["x"] * 0.1))
-
-		self.carriage_entry.delete(0, tk.END)
-		self.carriage_entry.insert(0, str(0.1 * (data["dimensions"]["yDimension"] - data["wells"]["A1"]["y"]) - 0.5))
+		self.settings.rows.set(str(self.labware.rows))
+		self.settings.cols.set(str(self.labware.cols))
+		self.settings.well_size.set(str(round(self.labware.well_size, 4)))
+		self.settings.table.set(str(round(table, 4)))
+		self.settings.carriage.set(str(round(carriage, 4)))
 	
     # Move the table and carriage based on table/carriage entry values
+	# The entries are on both the Automated and Manual screens, so a problem
+	# is shown on the label of the one in use
 	def set_table_carriage(self):
-		
-		if self.table_entry.get() != '':
-			self.table_motor.move_dist_absolute(float(self.table_entry.get()))
-		
-		if self.carriage_entry.get() != '':
-			self.carriage_motor.move_dist_absolute(float(self.carriage_entry.get()))
-		
+		try:
+			table = float(self.settings.table.get()) if self.settings.table.get() != '' else None
+			carriage = float(self.settings.carriage.get()) if self.settings.carriage.get() != '' else None
+			self.move_to(table, carriage)
+		except ValueError as e:
+			label = self.progress_lbl if self.mode == "Automated" else self.step_lbl
+			label["text"] = str(e)
+
+	# Move the carriage out of the way for cleaning
+	def move_cleaning_carriage(self):
+		try:
+			self.move_to(None, float(self.cleaning_carriage.get()))
+		except ValueError as e:
+			self.cleaning_lbl["text"] = str(e)
+
+	# Move the table and carriage to absolute positions in cm at the same time
+	# Leave a position as None to keep that axis where it is
+	# Once homed, raises ValueError if a position is out of reach
+	def move_to(self, table, carriage, on_done=None):
+		self.gantry.move_to(table, carriage, on_done)
+
+	# Move the table and carriage a distance in cm relative to where they
+	# are when the move starts
+	def move_by(self, table, carriage, on_done=None):
+		self.gantry.move_by(table, carriage, on_done)
+
+	# Home both axes against the limit switches, measuring and saving the
+	# backlash if calibrate is True
+	def home_gantry(self, calibrate):
+		self.home_lbl["text"] = "Homing..."
+		self.gantry.home(lambda completed: self.homed(completed, calibrate), calibrate)
+
+	def homed(self, completed, calibrate):
+		if not completed:
+			self.home_lbl["text"] = self.gantry.error or "Homing stopped."
+			return
+		text = "Homed."
+		if calibrate:
+			save_calibration("backlash", self.gantry.backlash())
+			text += " Backlash %(table)d/%(carriage)d microsteps." % self.gantry.backlash()
+		self.home_lbl["text"] = text
+
     # Turn pump on or off
     # If cleaning, set progress label as needed
 	def toggle_pump(self):
@@ -392,239 +454,402 @@ class App(tk.Tk):
 		self.pump_is_on = not self.pump_is_on
 		if self.pump_is_on:
 			self.pump.on()
-			if self.mode == "Cleaning":
-				self.progress_lbl["text"] = "System cleaning."
+			self.cleaning_lbl["text"] = "System cleaning."
 		else:
 			self.pump.off()
-			if self.mode == "Cleaning":
-				self.progress_lbl["text"] = "System idle."
+			self.cleaning_lbl["text"] = "System idle."
 			
     # Handle pause functionality
 	def toggle_pause(self):
-		self.is_paused = not self.is_paused
-		
-        # If we are now paused...
-		if self.is_paused:
-            # Cancel what is happening right now and force pump to off state
-			if self.taskId is not None:
-				self.after_cancel(self.taskId)
-				self.pump.off()
-			self.pause_btn["text"] = "Click to unpause"
-			self.progress_lbl["text"] = "Fractionation paused..."
-		# If we are now unpaused...
-        else:
-			self.pause_btn["text"] = "Click to pause"
-			self.progress_lbl["text"] = "Fractionation in progress..."
-			
-            # Based on the current state, go to the next step in the
-            # fractionation process
-			if self.state == "pump":
-				self.stop_pump()
-			elif self.state == "wait":
-				self.move()
-			elif self.state == "move":
-				self.pump()
+		if self.run is None or self.run.is_over():
+			return
+		if self.run.is_paused:
+			self.run.resume()
+		else:
+			self.run.pause()
 				
+	# Whether a run is going, or the queue is running or holding before its
+	# next plate, either of which will drive the gantry and pump
+	def is_busy(self):
+		if self.run is not None and not self.run.is_over():
+			return True
+		return self.runner is not None and self.runner.is_busy()
+
 	# Validate all inputs to make sure fractionation can begin
 	def run_checks(self):
-	
-		self.ROWS = int(self.rows_text_entry.get())
-		self.COLS = int(self.cols_text_entry.get())
-		self.well_size = float(self.ws_text_entry.get())
-	
-		self.pump_time = float(self.vol_text_entry.get()) / (float(self.pump_rate_text_entry.get()) / 3600)
-	
-		if self.ROWS != 0 and self.COLS != 0 and self.well_size != 0 and self.pump_time != 0:
-			self.movement()
+		# Only one run at a time
+		if self.is_busy():
+			return
+
+		try:
+			job = self.job_from_entries()
+
+			# The needle starts over A1
+			self.origin = self.gantry.position()
+			self.geometry = job.geometry(self.origin)
+			self.plan = job.plan(self.geometry)
+
+			# Plan the whole run before anything moves
+			self.cycle = job.cycle(self.dispenser.flow)
+			self.schedule = compile_run(self.gantry, self.geometry, self.plan, self.cycle)
+		except (OSError, ValueError, KeyError) as e:
+			self.progress_lbl["text"] = str(e)
+			return
+
+		self.ROWS = job.rows
+		self.COLS = job.cols
+		self.well_size = job.well_size
+		self.pump_time = job.pump_time(self.dispenser.flow)
+		self.movement(job)
+
+	# Build a job from the current entries
+	# Blank settle/dwell times fall back to the pump time
+	def job_from_entries(self, hold=None):
+		rows = int(self.settings.rows.get())
+		cols = int(self.settings.cols.get())
+		well_size = float(self.settings.well_size.get())
+
+		# Use the loaded labware file if it matches the entries
+		labware = self.labware_path if self.uses_labware(rows, cols, well_size) else None
+		return Job(float(self.pump_rate_text_entry.get()), float(self.vol_text_entry.get()), labware, rows, cols, well_size,
+			float(self.settle_text_entry.get()) if self.settle_text_entry.get() != '' else None,
+			float(self.dwell_text_entry.get()) if self.dwell_text_entry.get() != '' else None,
+			self.settings.wells.get().strip(), self.settings.order.get(), hold, self.settings.continuous.get())
+
+	# Work out where the wells are: the loaded labware if it matches the
+	# entries, otherwise an even grid with A1 at the origin
+	def make_geometry(self, origin):
+		if self.uses_labware(self.ROWS, self.COLS, self.well_size):
+			return self.labware
+		return Labware.uniform(self.ROWS, self.COLS, self.well_size, origin)
+
+	# Whether the loaded labware matches a plate size
+	def uses_labware(self, rows, cols, well_size):
+		return self.labware is not None and self.labware.matches(rows, cols) and abs(self.labware.well_size - well_size) < 1e-3
+
+	# Build the well plan from the selected wells and visiting order
+	def make_plan(self, geometry):
+		wells = None
+		if self.settings.wells.get().strip() != '':
+			positions = WellPlan(geometry.ordering).positions
+			wells = parse_selection(self.settings.wells.get(), positions)
+		return WellPlan(geometry.ordering, wells, self.settings.order.get(), geometry.distance)
 			
+	# Build a job from the current entries and add it to the queue
+	def add_job(self):
+		try:
+			job = self.job_from_entries(float(self.hold_text_entry.get()) if self.hold_text_entry.get() != '' else None)
+		except ValueError as e:
+			self.progress_lbl["text"] = str(e)
+			return
+		self.jobs.add(job)
+		self.show_jobs()
+
+	# Start the queue, or carry on once the next plate is in place
+	# Given a Resume for the first pending job, carry that job on first
+	def run_queue(self, resume=None):
+		if self.run is not None and not self.run.is_over():
+			return
+		if self.runner is None:
+			self.runner = JobRunner(self.jobs, self.loop, self.gantry, self.dispenser, self.clock, self.journal, self.run_log)
+			self.runner.listeners.append(self.show_queue_progress)
+			self.runner.run_listeners.append(self.show_progress)
+			if self.telemetry is not None:
+				self.telemetry.watch_runner(self.runner)
+		if self.runner.state == "waiting":
+			self.runner.proceed()
+		else:
+			self.runner.start(resume)
+
+	def clear_jobs(self):
+		self.jobs.clear_finished()
+		self.show_jobs()
+
+	# List every job with its status
+	def show_jobs(self):
+		self.queue_list.delete(0, tk.END)
+		for job in self.jobs.jobs:
+			self.queue_list.insert(tk.END, job.describe())
+
+	# Keep the labels and job list in step with the queue
+	def show_queue_progress(self, event, runner):
+		self.show_jobs()
+		if event == "start":
+			self.run = runner.fractionation
+			self.show_plate(runner.fractionation, runner.index)
+			self.progress_lbl["text"] = "Job #%d in progress..." % runner.job.id
+			self.queue_run_btn["text"] = "Run queue"
+		elif event == "hold":
+			self.progress_lbl["text"] = "Job #%d starts in %g s..." % (runner.job.id, runner.job.hold)
+		elif event == "waiting":
+			self.progress_lbl["text"] = "Load the plate for job #%d, then press Continue." % runner.job.id
+			self.queue_run_btn["text"] = "Continue"
+		elif event == "idle":
+			self.progress_lbl["text"] = "Queue finished!"
+
     # Beginning portion of the fractionation
-	def movement(self):
+	# When resuming, start at a later well and add to the old journal
+	def movement(self, job, index=0, resuming=False):
+		self.run = make_fractionation(self.loop, self.gantry, self.dispenser, self.clock, self.geometry, self.plan, self.cycle, self.schedule)
+		self.journal.attach(self.run, job, self.origin, resuming)
+		self.run_log.attach(self.run, job)
+		self.run.listeners.append(self.show_progress)
+		if self.telemetry is not None:
+			self.telemetry.watch(self.run)
+
+		# A new run replaces the journal of the unfinished one
+		self.unfinished = None
+		self.resume_btn.grid_forget()
+
         # Show the current progress
-		self.canvas.create_rectangle(0, 0, self.COLS * 25 + 5, self.ROWS * 25 + 5, fill="black")
-		self.update()
-	
-        # Start off moving forwards
-		self.carriage_forwards = True
-	
-		self.progress_lbl["text"] = "Fractionation in progress..."
-		
-		self.x = 0
-		self.y = 0
-		
-		self.pump_liquid()
-		
-    # Move to the next well in the plate
-	def move(self):
-		self.state = "move"
-		if self.carriage_forwards:
-			self.y = self.y + 1
-			if self.y < self.ROWS:
-				self.carriage_motor.move_dist_relative(self.well_size)
-			else:
-                # If we are at the end of the column, go to the next column
-				self.y = self.ROWS - 1
-				self.table_motor.move_dist_relative(-self.well_size)
-				self.x = self.x + 1
-				self.carriage_forwards = not self.carriage_forwards
-		else:
-			self.y = self.y - 1
-			if self.y >= 0:
-				self.carriage_motor.move_dist_relative(-self.well_size)
-			else:
-                # If we are at the end of the column, go to the next column
-				self.y = 0
-				self.table_motor.move_dist_relative(-self.well_size)
-				self.x = self.x + 1
-				self.carriage_forwards = not self.carriage_forwards
-			
-        # If the user paused during the motor movement,
-        # then stop the movement
-		if self.is_paused:
+		self.show_plate(self.run, index)
+		self.run.start(index)
+		self.progress_lbl["text"] = self.progress_text(self.run)
+
+	# Carry on the run that was cut short, from its first unfinished well
+	def resume_run(self):
+		if self.unfinished is None or self.is_busy():
 			return
-		
-        # If there are no more columns...
-		if self.x == self.COLS:
-            # Return to the starting position
-			self.progress_lbl["text"] = "Fractionation finished!"
-			self.carriage_return()
+		unfinished = self.unfinished
+		try:
+			unfinished.check_position(self.gantry.homed)
+		except ValueError as e:
+			self.progress_lbl["text"] = str(e)
+			return
+
+		# A queued job carries on as part of the queue
+		pending = self.jobs.next_pending()
+		if pending is not None and pending.id == unfinished.job.id:
+			self.unfinished = None
+			self.resume_btn.grid_forget()
+			self.run_queue(unfinished)
+			return
+
+		try:
+			self.geometry, self.plan = unfinished.plan()
+			self.cycle = unfinished.job.cycle(self.dispenser.flow)
+			self.schedule = compile_run(self.gantry, self.geometry, self.plan, self.cycle, unfinished.next_index)
+		except (OSError, ValueError, KeyError) as e:
+			self.progress_lbl["text"] = str(e)
+			return
+		self.origin = unfinished.origin
+		self.movement(unfinished.job, unfinished.next_index, True)
+
+	# Show a fresh plate, with the wells still to do in the plan in gray and
+	# the wells before index already finished, and keep the label following
+	# the run against its schedule
+	def show_plate(self, run, index):
+		self.plate_view.reset(run.geometry.rows, run.geometry.cols, "black")
+		for i in range(len(run.plan)):
+			self.plate_view.set_well(*run.plan.position(i), "blue" if i < index else "gray")
+
+		self.last_done = None
+		self.late = None
+		if self.progress_task is not None:
+			self.after_cancel(self.progress_task)
+		self.progress_task = self.after(PROGRESS_MS, self.refresh_progress)
+
+	# Update the progress label every PROGRESS_MS until the run is over
+	def refresh_progress(self):
+		self.progress_task = None
+		if self.run is None or self.run.is_over():
+			return
+		if not self.run.is_paused:
+			self.progress_lbl["text"] = self.progress_text(self.run)
+		self.progress_task = self.after(PROGRESS_MS, self.refresh_progress)
+
+	# Where a run is, and how long it has left by its schedule
+	def progress_text(self, run):
+		if 0 <= run.plan_index < len(run.plan):
+			text = "Well %s, %d of %d done" % (run.well(), run.wells_done, len(run.plan))
 		else:
-			self.pump_liquid()
-		
-    # Turn on the pump for the time specified by the desired volume
-	def pump_liquid(self):
-		self.state = "pump"
-		self.pump.on()
-
-        # Show that the well is in progress by making it green
-		x1, x2 = 5 + 25 * self.x, 25 + 25 * self.x
-		y1, y2 = 5 + 25 * self.y, 25 + 25 * self.y
-		self.canvas.create_rectangle(x1, y1, x2, y2, fill="green")
-		
-        self.taskId = self.after(round(self.pump_time * 1000), self.stop_pump)
-	
-    # Turn off the pump for the same amount of time it was on to prevent
-    # drops from entering other wells
-	def stop_pump(self):
-		self.state = "wait"
-		self.pump.off()
-
-        # Show that the well is finished by making it blue
-		x1, x2 = 5 + 25 * self.x, 25 + 25 * self.x
-		y1, y2 = 5 + 25 * self.y, 25 + 25 * self.y
-		self.canvas.create_rectangle(x1, y1, x2, y2, fill="blue")
-
-		self.taskId = self.after(round(self.pump_time * 1000), self.move)
-		
-    # Return the needle to the starting position
-	def carriage_return(self):
-		self.table_motor.move_dist_absolute(0.0)
-		self.carriage_motor.move_dist_absolute(0.0)
+			text = "Returning to the start"
+		if self.runner is not None and run is self.runner.fractionation:
+			text = "Job #%d: %s" % (self.runner.job.id, text)
+		if run.schedule is not None:
+			since = 0.0
+			if run.start_time is not None:
+				since = self.clock.now() - (self.last_done if self.last_done is not None else run.start_time)
+			text += ", %s left of %s" % (format_duration(run.schedule.remaining(run.wells_done, since)), format_duration(run.schedule.duration))
+			if self.late is not None and abs(self.late) >= 1:
+				text += " (%s %s plan)" % (format_duration(abs(self.late)), "behind" if self.late > 0 else "ahead of")
+			elif self.late is not None:
+				text += " (on plan)"
+		return text
+
+	# Keep the plate and labels in step with the fractionation
+	def show_progress(self, event, run):
+		if event == "pump":
+            # Show that the well is in progress by making it green
+			self.plate_view.set_well(*run.position(), "green")
+		elif event == "done":
+            # Show that the well is finished by making it blue
+			self.plate_view.set_well(*run.position(), "blue")
+			self.last_done = self.clock.now()
+			if run.schedule is not None:
+				self.late = run.schedule.lateness(run.plan_index, self.last_done - run.start_time)
+			self.progress_lbl["text"] = self.progress_text(run)
+		elif event == "paused":
+			self.pause_btn["text"] = "Click to unpause"
+			self.progress_lbl["text"] = "Fractionation paused..."
+		elif event == "resumed":
+			self.pause_btn["text"] = "Click to pause"
+			self.progress_lbl["text"] = self.progress_text(run)
+		elif event == "finished":
+			self.progress_lbl["text"] = "Fractionation finished!"
 		
     # Move the needle a single step forwards or backwards
 	def manual_step(self, forwards):
 		
-		self.ROWS = int(self.rows_text_entry.get())
-		self.COLS = int(self.cols_text_entry.get())
-		self.well_size = float(self.ws_text_entry.get())
+		self.ROWS = int(self.settings.rows.get())
+		self.COLS = int(self.settings.cols.get())
+		self.well_size = float(self.settings.well_size.get())
 		
-        # Make the entire canvas again
-        # We can do this because only one square needs to be highlighted
-        # during manual mode
-		self.canvas.create_rectangle(0, 0, self.COLS * 25 + 5, self.ROWS * 25 + 5, fill="black")
-		for i in range(0, self.COLS):
-			for j in range(0, self.ROWS):
-				x1, x2 = 5 + 25 * i, 25 + 25 * i
-				y1, y2 = 5 + 25 * j, 25 + 25 * j
-				self.canvas.create_rectangle(x1, y1, x2, y2, fill="gray")
+        # Only one square is highlighted during manual mode, so clear
+        # the old one before moving
+		self.manual_plate_view.resize(self.ROWS, self.COLS, "gray")
+		self.manual_plate_view.set_well(self.x, self.y, "gray")
 		
         # If invalid inputs, do not step
 		if self.ROWS == 0 or self.COLS == 0 or self.well_size == 0:
 			return
-		
-        # If stepping forwards...
-		if forwards:
-            # If we are at the end of the fractionation, highlight the square
-            # and end early
-			if self.x == self.COLS - 1 and self.y == (self.ROWS - 1 if self.COLS % 2 == 1 else 0):
-				x1, x2 = 5 + 25 * self.x, 25 + 25 * self.x
-				y1, y2 = 5 + 25 * self.y, 25 + 25 * self.y
-				self.canvas.create_rectangle(x1, y1, x2, y2, fill="yellow")
-		
-				self.update()
-				return
-            
-            # Move based on which way the carriage would normally
-            # go in this column during an automated fractionation
-			if self.carriage_forwards:
-				self.y = self.y + 1
-				if self.y < self.ROWS:
-					self.carriage_motor.move_dist_relative(self.well_size)
-				else:
-                    # If at the end of the column, go to the next column
-					self.y = self.ROWS - 1
-					self.table_motor.move_dist_relative(-self.well_size)
-					self.x = self.x + 1
-					self.carriage_forwards = not self.carriage_forwards
-			else:
-				self.y = self.y - 1
-				if self.y >= 0:
-					self.carriage_motor.move_dist_relative(-self.well_size)
-				else:
-                    # If at the end of the column, go to the next column
-					self.y = 0
-					self.table_motor.move_dist_relative(-self.well_size)
-					self.x = self.x + 1
-					self.carriage_forwards = not self.carriage_forwards
-		# If stepping backwards...
-        else:
-            # If we are at the beginning of the fractionation, highlight the square
-            # and end early
-			if self.x == 0 and self.y == 0:
-				x1, x2 = 5 + 25 * self.x, 25 + 25 * self.x
-				y1, y2 = 5 + 25 * self.y, 25 + 25 * self.y
-				self.canvas.create_rectangle(x1, y1, x2, y2, fill="yellow")
-		
-				self.update()
-				return
-            
-            # Move based on which way the carriage would normally
-            # go in this column during an automated fractionation
-			if self.carriage_forwards:
-				self.y = self.y - 1
-				if self.y >= 0:
-					self.carriage_motor.move_dist_relative(-self.well_size)
-				else:
-                    # If at the end of the column, go to the next column
-					self.y = 0
-					self.table_motor.move_dist_relative(self.well_size)
-					self.x = self.x - 1
-					self.carriage_forwards = not self.carriage_forwards
+
+		# Start a new plan from the current position if the plate changed
+		geometry = self.make_geometry(self.origin)
+		try:
+			plan = self.make_plan(geometry)
+		except ValueError as e:
+			self.step_lbl["text"] = str(e)
+			return
+		if self.plan is None or self.plan.wells != plan.wells:
+			self.plan = plan
+			self.plan_index = 0
+			self.x, self.y = plan.position(0)
+
+			# Without labware, take the needle to be over the first well
+			if geometry is not self.labware:
+				self.origin = (self.table_motor.get_dist() + self.x * self.well_size, self.carriage_motor.get_dist() - self.y * self.well_size)
+				geometry = self.make_geometry(self.origin)
+		self.geometry = geometry
+
+        # Step along the plan, stopping at either end
+		index = self.plan_index + 1 if forwards else self.plan_index - 1
+		if 0 <= index < len(self.plan):
+			try:
+				self.move_to(*self.geometry.position(self.plan.wells[index]))
+			except ValueError as e:
+				self.step_lbl["text"] = str(e)
 			else:
-				self.y = self.y + 1
-				if self.y < self.ROWS:
-					self.carriage_motor.move_dist_relative(self.well_size)
-				else:
-                    # If at the end of the column, go to the next column
-					self.y = self.ROWS - 1
-					self.table_motor.move_dist_relative(self.well_size)
-					self.x = self.x - 1
-					self.carriage_forwards = not self.carriage_forwards
+				self.plan_index = index
+				self.x, self.y = self.plan.position(index)
 		
         # Highlight the square after movement
-		x1, x2 = 5 + 25 * self.x, 25 + 25 * self.x
-		y1, y2 = 5 + 25 * self.y, 25 + 25 * self.y
-		self.canvas.create_rectangle(x1, y1, x2, y2, fill="yellow")
-		
-        # Update the app to ensure the change to the canvas is visible
-		self.update()
+		self.manual_plate_view.set_well(self.x, self.y, "yellow")
+
+	# Jog an axis until stop_jog(), unless a run or another jog is going
+	def start_jog(self, axis, forwards, coarse=False):
+		if self.jog_release is not None or self.is_busy():
+			return
+		self.jog_release = self.gantry.jog(axis, forwards, coarse, self.jogged)
+
+	def stop_jog(self):
+		if self.jog_stop_task is not None:
+			self.after_cancel(self.jog_stop_task)
+		self.jog_stop_task = None
+		self.jog_key = None
+		if self.jog_release is not None:
+			self.jog_release.set()
+
+	def jogged(self, completed):
+		self.jog_release = None
+		self.show_position()
+
+	# Jog with the arrow keys in Manual mode, coarsely with Shift, unless a
+	# text box has the keys
+	def key_pressed(self, event):
+		if event.keysym not in JOG_KEYS or self.mode != "Manual" or isinstance(self.focus_get(), tk.Entry):
+			return
+
+		# A repeat of the key that is already jogging
+		if event.keysym == self.jog_key:
+			if self.jog_stop_task is not None:
+				self.after_cancel(self.jog_stop_task)
+				self.jog_stop_task = None
+			return
+		if self.jog_release is not None:
+			return
+		self.jog_key = event.keysym
+		self.start_jog(*JOG_KEYS[event.keysym], self.coarse_jog.get() or bool(event.state & SHIFT_MASK))
+
+	def key_released(self, event):
+		if event.keysym == self.jog_key and self.jog_stop_task is None:
+			self.jog_stop_task = self.after(KEY_REPEAT_MS, self.stop_jog)
+
+	# Update the position label every POSITION_MS while in Manual mode
+	def refresh_position(self):
+		if self.position_task is not None:
+			self.after_cancel(self.position_task)
+		self.position_task = None
+		if self.mode != "Manual":
+			return
+		self.show_position()
+		self.position_task = self.after(POSITION_MS, self.refresh_position)
+
+	def show_position(self):
+		self.position_lbl["text"] = "Needle at table %.3f cm, carriage %.3f cm" % self.gantry.position()
+
+# Open the hardware and run the GUI until the window is closed
+def run_gui(simulate=False, profile_path=None, home=False, serve=None, serve_host=TELEMETRY_HOST, journal_path=RUN_JOURNAL_PATH,
+		log_dir=RUN_LOG_DIR, binary_log=False):
+	backend = make_backend(simulate)
+	profiler = StepProfiler() if profile_path else None
+
+	# Create the app object
+	app = App(backend, profiler, home, serve, serve_host, journal_path, log_dir, binary_log)
+
+	# Begin the event loop
+	app.mainloop()
+
+	# Once the loop is done and the application is closed,
+	# release the motors to prevent overheating
+	app.dispenser.shutdown()
+	app.gantry.shutdown()
+	app.journal.close()
+	if app.telemetry is not None:
+		app.telemetry.close()
+
+	# Report on the last run, from its log
+	if app.run_log.path is not None:
+		print(app.run_log.report())
+	print(backend.report())
+	print(app.timing_report())
 
-# Create the app object
-app = App()
+	if profiler is not None:
+		profiler.export(profile_path)
+		print(profiler.summary())
 
-# Begin the event loop
-app.mainloop()
+if __name__ == "__main__":
+	# Pass --simulate to run against the simulated hardware
+	# Pass --home to home both axes at start up
+	# Pass --profile-steps=FILE to time every move and save the results
+	# as CSV (or JSON if FILE ends in .json) when the app closes
+	# Pass --serve=PORT to serve the run state and controls on localhost
+	# Pass --journal=FILE to keep the run journal somewhere else
+	# Pass --log-dir=DIR to log runs somewhere else, and --binary-log to
+	# also log them in the binary columnar format
+	profile_path = None
+	serve = None
+	journal_path = RUN_JOURNAL_PATH
+	log_dir = RUN_LOG_DIR
+	for arg in sys.argv[1:]:
+		if arg.startswith("--profile-steps="):
+			profile_path = arg.split("=", 1)[1]
+		elif arg.startswith("--serve="):
+			serve = int(arg.split("=", 1)[1])
+		elif arg.startswith("--journal="):
+			journal_path = arg.split("=", 1)[1]
+		elif arg.startswith("--log-dir="):
+			log_dir = arg.split("=", 1)[1]
 
-# Once the loop is done and the application is closed,
-# release the motors to prevent overheating
-app.table_motor.release()
-app.carriage_motor.release()
+	run_gui("--simulate" in sys.argv, profile_path, "--home" in sys.argv, serve, TELEMETRY_HOST, journal_path,
+		log_dir, "--binary-log" in sys.argv)
@@ -0,0 +1,107 @@
+"""
+Motion profiles
+
+A profile describes how fast an axis may go: the speed it can safely start
+and stop at, its top speed, how quickly it may change speed (acceleration)
+and how quickly the acceleration itself may change (jerk). Distances are in
+cm, so velocities are cm/s, accelerations cm/s^2 and jerk cm/s^3.
+
+From a profile we precompute the delay between consecutive steps for a move
+of any length. Moves ramp up from the start speed, cruise at the top speed
+and ramp back down with the mirror image of the ramp up. Short moves that
+cannot reach the top speed simply turn around half way.
+"""
+from math import sqrt
+
+# Time step used when integrating a jerk limited ramp
+RAMP_TIME_STEP = 0.0001
+
+class MotionProfile:
+	def __init__(self, start_velocity, max_velocity, acceleration, jerk=0.0):
+		self.start_velocity = start_velocity
+		self.max_velocity = max(max_velocity, start_velocity) if acceleration > 0 else start_velocity
+		self.acceleration = acceleration
+		self.jerk = jerk
+
+		# Ramps only depend on the step size, so keep one per step size
+		self.ramps = {}
+
+	# Delay after each step of a ramp from the start speed to the top speed
+	def ramp(self, step_cm):
+		if step_cm not in self.ramps:
+			if self.max_velocity <= self.start_velocity:
+				self.ramps[step_cm] = []
+			elif self.jerk > 0:
+				self.ramps[step_cm] = self.jerk_limited_ramp(step_cm)
+			else:
+				self.ramps[step_cm] = self.constant_ramp(step_cm)
+		return self.ramps[step_cm]
+
+	# Constant acceleration ramp, using the exact time at which each step
+	# is reached rather than integrating
+	def constant_ramp(self, step_cm):
+		v0 = self.start_velocity
+		a = self.acceleration
+		delays = []
+		previous = 0.0
+		k = 1
+		while True:
+			v = sqrt(v0 * v0 + 2.0 * a * k * step_cm)
+			if v >= self.max_velocity:
+				break
+			t = (v - v0) / a
+			delays.append(t - previous)
+			previous = t
+			k += 1
+		return delays
+
+	# S-curve ramp where the acceleration builds up and dies down at the
+	# jerk limit so the motor never sees a sudden change in torque
+	def jerk_limited_ramp(self, step_cm):
+		dt = min(RAMP_TIME_STEP, step_cm / self.max_velocity / 10.0)
+		v = self.start_velocity
+		a = 0.0
+		position = 0.0
+		t = 0.0
+		previous = 0.0
+		delays = []
+		while v < self.max_velocity:
+			# Start easing off early enough to land on the top speed
+			if v + a * a / (2.0 * self.jerk) >= self.max_velocity:
+				a = max(a - self.jerk * dt, self.jerk * dt)
+			else:
+				a = min(a + self.jerk * dt, self.acceleration)
+			v = min(v + a * dt, self.max_velocity)
+			position += v * dt
+			t += dt
+			while position >= (len(delays) + 1) * step_cm:
+				delays.append(t - previous)
+				previous = t
+		return delays
+
+	# Delay to wait after each of the steps in a move
+	def step_delays(self, steps, step_cm):
+		if steps <= 0:
+			return []
+		ramp = self.ramp(step_cm)
+		ramp_steps = min(len(ramp), steps // 2)
+		up = ramp[:ramp_steps]
+
+		# Cruise at the top speed, or at the peak of a short move
+		if ramp_steps == len(ramp):
+			cruise_delay = step_cm / self.max_velocity
+		else:
+			cruise_delay = up[-1] if up else step_cm / self.start_velocity
+
+		return up + [cruise_delay] * (steps - 2 * ramp_steps) + up[::-1]
+
+	# How long a move of a number of steps will take, ignoring driver latency
+	def duration(self, steps, step_cm):
+		return sum(self.step_delays(steps, step_cm))
+
+# Speed the original fixed cadence could always start and stop at
+START_VELOCITY_IN_CM_PER_S = 0.5
+
+# Per axis defaults. The table carries the plate so it is given a gentler ramp
+TABLE_PROFILE = MotionProfile(START_VELOCITY_IN_CM_PER_S, 2.0, 4.0, 40.0)
+CARRIAGE_PROFILE = MotionProfile(START_VELOCITY_IN_CM_PER_S, 2.5, 6.0, 60.0)
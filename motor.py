@@ -0,0 +1,417 @@
+from math import floor
+
+from hardware import FORWARD, BACKWARD, DOUBLE, MICROSTEP, MICROSTEPS, PiBackend
+from motion import MotionProfile, START_VELOCITY_IN_CM_PER_S
+
+##  GLOBAL CONSTANTS  ##
+# - NEMA 17 data taken from motor datasheet
+# - Lead screw pitch is as designed
+NEMA_17_STEPS_PER_DEGREE = 3200.0 / 360.0
+LEAD_SCREW_PITCH_IN_CM = 4.0
+
+# Slack between the lead screw and the slider until it is measured (see
+# homing.py)
+DEFAULT_BACKLASH_IN_CM = 0.3
+
+##  STEP MODE CONSTANTS  ##
+# - In hybrid mode, moves of at least HYBRID_MIN_MICROSTEPS are made with
+#   full (DOUBLE) or half (INTERLEAVE) steps, which cost one driver call
+#   each just like a microstep but cover 16 or 8 times the distance
+# - The last APPROACH_MICROSTEPS or more are always microstepped
+# - The driver's coil phase repeats every 4 full steps
+HYBRID_MIN_MICROSTEPS = 10 * MICROSTEPS
+APPROACH_MICROSTEPS = 2 * MICROSTEPS
+PHASE_CYCLE = 4 * MICROSTEPS
+
+"""
+StepperMotor Class
+
+Used to keep track of stepper motor states. All angles in degrees
+
+The position is kept as a whole number of microsteps so it stays exact
+whichever step style the motor is driven with.
+"""
+
+class StepperMotor:
+	def __init__(self, index, steps_per_degree, lead_screw_pitch, reverse=False, backend=None, profile=None, name=None, hybrid=False):
+		if backend is None:
+			backend = PiBackend()
+
+		# Without a profile, run at the start speed with no ramp
+		if profile is None:
+			profile = MotionProfile(START_VELOCITY_IN_CM_PER_S, START_VELOCITY_IN_CM_PER_S, 0.0)
+
+        # Index determines whether we are using the table or carriage motor
+		self.motor = backend.stepper(index)
+		self.name = name if name is not None else "stepper%d" % index
+		self.clock = backend.clock
+		self.position = 0
+		self.steps_per_degree = steps_per_degree
+		self.cm_per_deg = lead_screw_pitch / 360.0
+		self.cm_per_step = self.cm_per_deg / steps_per_degree
+		self.profile = profile
+
+		# Microsteps taken up when the motor changes direction, and how many
+		# of them are still to be taken up before the slider follows in the
+		# current direction (some are left when a move is cancelled)
+		self.backlash = round(DEFAULT_BACKLASH_IN_CM / self.cm_per_step)
+		self.slack = 0
+
+        # Reverse keep track of whether the motor is reversed or not
+        # That is, which way does it need to turn to push the slider
+        # in a specific direction
+		self.reverse = reverse
+
+        # Keeps track of which direction the needle is moving during fractionation
+		self.forwards = True
+
+		# Attach a StepProfiler to time every move of this motor
+		self.profiler = None
+
+		# Hybrid mode makes long moves in coarse steps of this style
+		self.hybrid = hybrid
+		self.coarse_style = DOUBLE
+
+		# Coil phase reported by the driver after the last step, in
+		# microsteps (None until the first step)
+		self.phase = None
+
+	# Angle of the motor shaft in degrees, from the position in microsteps
+	@property
+	def angle(self):
+		return self.position / self.steps_per_degree
+
+	@angle.setter
+	def angle(self, angle):
+		self.position = round(angle * self.steps_per_degree)
+
+    # Get current angle of the motor shaft (unbounded)
+	def get_angle(self):
+		return self.angle
+
+    # Tares the motor angle
+	def tare(self):
+		self.angle = 0.0
+
+    # Releases the motor hold to prevent unnecessary energy usage and
+    # overheating
+	def release(self):
+		self.motor.release()
+
+    # Get the current position of the slider in centimeters
+	def get_dist(self):
+		return self.angle * self.cm_per_deg
+
+	# Work out the direction and number of steps for a relative move,
+	# including any backlash from changing direction
+	# Also returns how many of the steps only take up the backlash
+	def plan_relative(self, angle):
+		# Moves of less than a step (rounding left over from absolute
+		# targets) must not count as a change of direction
+		if abs(self.steps_per_degree * angle) < 1:
+			return FORWARD, 0, 0
+
+		direction, backlash_steps = self.turn(angle > 0)
+		steps_needed = floor(self.steps_per_degree * angle)
+		steps_needed += backlash_steps if angle > 0 else -backlash_steps
+		return direction, steps_needed, backlash_steps
+
+	# Set the direction of travel, returning the driver direction and the
+	# microsteps of backlash to take up first
+	# Turning back before the slack was all taken up only has to undo the
+	# part that was
+	def turn(self, forwards):
+		if self.forwards != forwards:
+			self.forwards = forwards
+			self.slack = max(self.backlash - self.slack, 0)
+
+		# FORWARD if moving forwards and not reversed or if moving
+		# backwards and reversed
+		direction = FORWARD if forwards != self.reverse else BACKWARD
+		return direction, self.slack
+
+	# Take up slack with microsteps actually taken, returning how many of
+	# them moved the slider
+	def take_up(self, taken):
+		used = max(min(taken, self.slack), 0)
+		self.slack -= used
+		return max(taken - used, 0)
+
+	# Split a move of a number of microsteps into three segments of
+	# (style, steps, microsteps per step): microsteps up to the next coarse
+	# step boundary, coarse steps, then microsteps for the final approach
+	def plan_segments(self, direction, microsteps):
+		size = MICROSTEPS if self.coarse_style == DOUBLE else MICROSTEPS // 2
+		if not self.hybrid or self.phase is None or microsteps < HYBRID_MIN_MICROSTEPS:
+			return [(MICROSTEP, microsteps, 1), (self.coarse_style, 0, size), (MICROSTEP, 0, 1)]
+
+		# DOUBLE steps are a full step each from an odd half step,
+		# INTERLEAVE steps a half step each from any half step
+		boundary = size // 2 if self.coarse_style == DOUBLE else 0
+		if direction == FORWARD:
+			align = (boundary - self.phase) % size
+		else:
+			align = (self.phase - boundary) % size
+
+		coarse = max(0, (microsteps - align - APPROACH_MICROSTEPS) // size)
+		if coarse == 0:
+			return [(MICROSTEP, microsteps, 1), (self.coarse_style, 0, size), (MICROSTEP, 0, 1)]
+		return [(MICROSTEP, align, 1), (self.coarse_style, coarse, size), (MICROSTEP, microsteps - align - coarse * size, 1)]
+
+    # Turn the motor shaft a number of degrees relative to its current position
+	def move_relative(self, angle):
+		move_together([(self, angle)])
+
+	# Update the coil phase after some steps and return how many
+	# microsteps the motor actually turned
+	# The nominal count is corrected by the phase the driver reported, in
+	# case it had to snap to a step boundary first
+	def track_phase(self, direction, microsteps, reported):
+		if microsteps == 0:
+			return 0
+		sign = 1 if direction == FORWARD else -1
+		if self.phase is None or reported is None:
+			self.phase = reported
+			return microsteps
+
+		expected = (self.phase + sign * microsteps) % PHASE_CYCLE
+		error = (reported - expected + PHASE_CYCLE // 2) % PHASE_CYCLE - PHASE_CYCLE // 2
+		self.phase = reported
+		return microsteps + sign * error
+
+    # Turn the motor shaft to a specific angle relative to its
+    # initial starting position
+	def move_absolute(self, angle):
+		delta_angle = angle - self.angle
+		self.move_relative(delta_angle)
+
+    # Move the slider on this motor a number of centimeters
+    # relative to its current position
+	def move_dist_relative(self, dist):
+		self.move_relative(dist / self.cm_per_deg)
+
+    # Move the slider on this motor to a specific position
+    # relative to its initial starting position (also in centimeters)
+	def move_dist_absolute(self, dist):
+		self.move_absolute(dist / self.cm_per_deg)
+
+# Turn several motors at once so that they start and finish together
+# Each move is a (motor, relative angle) pair. The motor with the most steps
+# sets the pace using its own profile and the others step along with it,
+# Bresenham style, so a diagonal move takes as long as its longest axis
+# If a cancel event is given and gets set, the motors stop between steps
+# and the positions reflect the steps actually taken. Returns True if the
+# move ran to completion
+def move_together(moves, cancel=None):
+	axes = []
+	for motor, angle in moves:
+		direction, steps_needed, backlash_steps = motor.plan_relative(angle)
+		axes.append((motor, direction, steps_needed, backlash_steps))
+
+	# Moves are made in up to three segments (see plan_segments), with all
+	# axes running each segment together before moving on to the next
+	segments = [motor.plan_segments(direction, abs(steps_needed)) for motor, direction, steps_needed, backlash_steps in axes]
+	microsteps_taken = [0] * len(axes)
+
+	completed = True
+	for segment in range(3):
+		counts = [plan[segment][1] for plan in segments]
+		total = max(counts)
+		if total == 0:
+			continue
+		lead = counts.index(total)
+		lead_motor = axes[lead][0]
+		style, _, size = segments[lead][segment]
+		delays = lead_motor.profile.step_delays(total, lead_motor.cm_per_step * size)
+
+		# Each axis keeps an error term and steps whenever it overflows,
+		# counting the steps it has taken and the last coil phase reported
+		stepping = [[motor.motor.onestep, direction, plan[segment][1], total // 2, 0, plan[segment][0], None] for (motor, direction, steps_needed, backlash_steps), plan in zip(axes, segments)]
+
+		profiler = next((axis[0].profiler for axis in axes if axis[0].profiler is not None), None)
+		if profiler is None:
+			completed = run_ticks(stepping, delays, lead_motor.clock, cancel)
+		else:
+			completed = run_ticks_profiled(stepping, delays, lead_motor.clock, cancel, profiler, "+".join(axis[0].name for axis in axes))
+
+		for i, ((motor, direction, steps_needed, backlash_steps), axis) in enumerate(zip(axes, stepping)):
+			microsteps_taken[i] += motor.track_phase(direction, axis[4] * segments[i][segment][2], axis[6])
+
+		if not completed:
+			break
+
+	# Steps spent taking up backlash do not move the slider, so they are
+	# left out of the position, and whatever a cancel left is kept for the
+	# next move
+	for (motor, direction, steps_needed, backlash_steps), taken in zip(axes, microsteps_taken):
+		moved = motor.take_up(taken)
+		motor.position = motor.position + (moved if steps_needed > 0 else -moved)
+		motor.release()
+
+	return completed
+
+# Run one motor until release is set, for jogging by hand
+# It ramps up along its profile, no faster than max_velocity if given, and
+# once released ramps back down and stops, having gone at least
+# min_microsteps and never more than max_microsteps. Backlash is taken up
+# first at the start speed. The position is kept up to date as it goes so
+# it can be shown live. Returns True unless cancelled
+# With coarse, a hybrid motor lines up with a step boundary and then runs
+# in coarse steps, as long moves do (see plan_segments)
+def jog(motor, forwards, release, cancel=None, min_microsteps=1, max_microsteps=None, max_velocity=None, coarse=False):
+	direction, backlash_steps = motor.turn(forwards)
+	sign = 1 if forwards else -1
+
+	style, size, align = MICROSTEP, 1, 0
+	if coarse and motor.hybrid and motor.phase is not None:
+		style = motor.coarse_style
+		size = MICROSTEPS if style == DOUBLE else MICROSTEPS // 2
+		boundary = size // 2 if style == DOUBLE else 0
+		align = (boundary - motor.phase) % size if direction == FORWARD else (motor.phase - boundary) % size
+
+		# Too close to the end of travel to line up, so stay in microsteps
+		if max_microsteps is not None and align + size > max_microsteps:
+			style, size, align = MICROSTEP, 1, 0
+
+	step_cm = motor.cm_per_step * size
+	start_delay = motor.cm_per_step / motor.profile.start_velocity
+	cruise_delay = step_cm / motor.profile.max_velocity
+	ramp = motor.profile.ramp(step_cm)
+
+	# A lower top speed cuts the ramp short
+	if max_velocity is not None and step_cm / max_velocity > cruise_delay:
+		cruise_delay = step_cm / max_velocity
+		ramp = [delay for delay in ramp if delay >= cruise_delay]
+
+	onestep = motor.motor.onestep
+	clock = motor.clock
+	start = motor.position
+	reported = None
+	taken = 0
+	moved = 0
+	completed = True
+	deadline = clock.now()
+
+	# Take one step, returning whether it kept to its time
+	def step(style, microsteps, delay):
+		nonlocal reported, taken, deadline
+		reported = onestep(direction=direction, style=style)
+		taken += microsteps
+		deadline += delay
+		now = clock.now()
+		if deadline > now:
+			clock.sleep_until(deadline)
+			return True
+		deadline = now
+		return False
+
+	# Backlash and lining up are microsteps at the start speed
+	while taken < backlash_steps + align:
+		if cancel is not None and cancel.is_set():
+			completed = False
+			break
+		step(MICROSTEP, 1, start_delay)
+		if taken > backlash_steps:
+			moved += 1
+			motor.position = start + sign * moved
+
+	# speed counts the steps up the ramp, which is also how many it takes
+	# to come back down
+	# It only rises while steps keep to their time, so when the driver
+	# cannot keep up the ramp down is no longer than the ramp up really was
+	speed = 0
+	while completed:
+		if cancel is not None and cancel.is_set():
+			completed = False
+			break
+		rising = 2 if speed < len(ramp) else 1
+		if release.is_set() and moved + speed * size >= min_microsteps:
+			break
+		if max_microsteps is not None and moved + (speed + rising) * size > max_microsteps:
+			break
+		on_time = step(style, size, ramp[speed] if speed < len(ramp) else cruise_delay)
+		moved += size
+		motor.position = start + sign * moved
+		if on_time:
+			speed = min(speed + 1, len(ramp))
+
+	while completed and speed > 0:
+		if cancel is not None and cancel.is_set():
+			completed = False
+			break
+		speed -= 1
+		step(style, size, ramp[speed])
+		moved += size
+		motor.position = start + sign * moved
+
+	# As with any move, take the count the driver reports over the nominal
+	# one, less the backlash
+	moved = motor.take_up(motor.track_phase(direction, taken, reported))
+	motor.position = start + sign * moved
+	motor.release()
+	return completed
+
+# Move several sliders to absolute positions in centimeters at once
+# Each target is a (motor, position) pair
+def move_dist_absolute_together(targets, cancel=None):
+	return move_together([(motor, dist / motor.cm_per_deg - motor.angle) for motor, dist in targets], cancel)
+
+# The step loop: one tick per delay, where every axis that is due steps once
+# Each tick is timed from the previous one, and if the drivers were slower
+# than the schedule we carry on from now rather than rushing to catch up
+def run_ticks(stepping, delays, clock, cancel):
+	total = len(delays)
+	deadline = clock.now()
+	for delay in delays:
+		if cancel is not None and cancel.is_set():
+			return False
+
+		for axis in stepping:
+			axis[3] += axis[2]
+			if axis[3] >= total:
+				axis[3] -= total
+				axis[6] = axis[0](direction=axis[1], style=axis[5])
+				axis[4] += 1
+
+		deadline += delay
+		now = clock.now()
+		if deadline > now:
+			clock.sleep_until(deadline)
+		else:
+			deadline = now
+	return True
+
+# Same as run_ticks, but timing the driver calls and sleeps of every tick
+# and handing them to a StepProfiler at the end
+def run_ticks_profiled(stepping, delays, clock, cancel, profiler, axes):
+	total = len(delays)
+	latencies = []
+	sleep_time = 0.0
+	start = clock.now()
+	deadline = start
+	completed = True
+	for delay in delays:
+		if cancel is not None and cancel.is_set():
+			completed = False
+			break
+
+		before = clock.now()
+		for axis in stepping:
+			axis[3] += axis[2]
+			if axis[3] >= total:
+				axis[3] -= total
+				axis[6] = axis[0](direction=axis[1], style=axis[5])
+				axis[4] += 1
+		now = clock.now()
+		latencies.append(now - before)
+
+		deadline += delay
+		if deadline > now:
+			clock.sleep_until(deadline)
+			sleep_time += clock.now() - now
+		else:
+			deadline = now
+
+	planned = sum(delays[:len(latencies)])
+	profiler.record(start, axes, sum(axis[4] for axis in stepping), clock.now() - start, planned, latencies, sleep_time)
+	return completed
@@ -0,0 +1,82 @@
+"""
+PlateView Class
+
+Draws the well plate on a canvas. The background and one rectangle per well
+are created once, when the plate size changes, and after that only the fill
+of wells that actually changed is updated. Changes are collected and applied
+together once per frame, so a burst of updates costs a single redraw.
+"""
+
+# Largest well size in pixels, and the gap around each well
+CELL_SIZE = 25
+CELL_GAP = 5
+
+# Time between redraws in milliseconds (about 60 per second)
+FRAME_MS = 16
+
+class PlateView:
+	def __init__(self, canvas, width, height):
+		self.canvas = canvas
+		self.width = width
+		self.height = height
+		self.rows = 0
+		self.cols = 0
+		self.background = None
+		self.items = {}
+		self.fills = {}
+		self.pending = {}
+		self.flush_id = None
+
+	# Make sure the canvas shows a plate of this size, with every well in
+	# the given colour
+	def reset(self, rows, cols, fill):
+		if rows != self.rows or cols != self.cols:
+			self.build(rows, cols, fill)
+		else:
+			for well in self.items:
+				self.set_well(well[0], well[1], fill)
+
+	# Make sure the canvas shows a plate of this size, leaving the wells as
+	# they are if it already does
+	def resize(self, rows, cols, fill):
+		if rows != self.rows or cols != self.cols:
+			self.build(rows, cols, fill)
+
+	# Create the canvas items for a new plate size
+	# Wells shrink to fit if the plate would not fit at full size
+	def build(self, rows, cols, fill):
+		self.canvas.delete("all")
+		self.pending.clear()
+		self.rows = rows
+		self.cols = cols
+
+		cell = CELL_SIZE
+		if cols > 0 and rows > 0:
+			cell = min(CELL_SIZE, (self.width - CELL_GAP) // cols, (self.height - CELL_GAP) // rows)
+		gap = max(1, cell * CELL_GAP // CELL_SIZE)
+
+		self.background = self.canvas.create_rectangle(0, 0, cols * cell + gap, rows * cell + gap, fill="black")
+		self.items = {}
+		self.fills = {}
+		for i in range(cols):
+			for j in range(rows):
+				x1, y1 = gap + cell * i, gap + cell * j
+				self.items[(i, j)] = self.canvas.create_rectangle(x1, y1, x1 + cell - gap, y1 + cell - gap, fill=fill)
+				self.fills[(i, j)] = fill
+
+	# Change the colour of a single well on the next frame
+	def set_well(self, x, y, fill):
+		if (x, y) not in self.items:
+			return
+		self.pending[(x, y)] = fill
+		if self.flush_id is None:
+			self.flush_id = self.canvas.after(FRAME_MS, self.flush)
+
+	# Apply all the changes collected since the last frame
+	def flush(self):
+		self.flush_id = None
+		for well, fill in self.pending.items():
+			if self.fills[well] != fill:
+				self.canvas.itemconfig(self.items[well], fill=fill)
+				self.fills[well] = fill
+		self.pending.clear()
@@ -0,0 +1,92 @@
+"""
+StepProfiler Class
+
+Optional timing for the step loop in motor.move_together. When a motor has
+a profiler attached, every move records how many steps it took, the step
+rate it actually achieved, how long each round of onestep() calls took on
+the driver (the I2C transactions on the HAT) and how much time went to the
+Python loop itself rather than stepping or sleeping.
+
+Motors without a profiler run the plain loop, so there is no cost unless
+profiling is switched on.
+"""
+import csv
+import json
+
+# Upper edges of the latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05)
+
+# Columns written for each move
+FIELDS = ("start", "axes", "steps", "step_calls", "duration", "planned_duration",
+	"step_rate", "latency_p50", "latency_p99", "latency_max", "sleep_time",
+	"loop_overhead", "histogram")
+
+# Value at a fraction of the way through a sorted list
+def percentile(values, fraction):
+	if not values:
+		return 0.0
+	return values[min(len(values) - 1, int(fraction * len(values)))]
+
+class StepProfiler:
+	def __init__(self):
+		self.moves = []
+
+	# Store the timing of one move
+	# latencies holds the time spent in onestep() for each tick of the loop
+	def record(self, start, axes, step_calls, duration, planned_duration, latencies, sleep_time):
+		ordered = sorted(latencies)
+		histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+		for latency in ordered:
+			bucket = 0
+			while bucket < len(LATENCY_BUCKETS) and latency > LATENCY_BUCKETS[bucket]:
+				bucket += 1
+			histogram[bucket] += 1
+
+		self.moves.append({
+			"start": start,
+			"axes": axes,
+			"steps": len(latencies),
+			"step_calls": step_calls,
+			"duration": duration,
+			"planned_duration": planned_duration,
+			"step_rate": len(latencies) / duration if duration > 0 else 0.0,
+			"latency_p50": percentile(ordered, 0.5),
+			"latency_p99": percentile(ordered, 0.99),
+			"latency_max": ordered[-1] if ordered else 0.0,
+			"sleep_time": sleep_time,
+			"loop_overhead": max(0.0, duration - sum(latencies) - sleep_time),
+			"histogram": histogram,
+		})
+
+	# Totals across every recorded move
+	def summary(self):
+		steps = sum(move["steps"] for move in self.moves)
+		duration = sum(move["duration"] for move in self.moves)
+		return {
+			"moves": len(self.moves),
+			"steps": steps,
+			"duration": duration,
+			"step_rate": steps / duration if duration > 0 else 0.0,
+			"latency_p99": max((move["latency_p99"] for move in self.moves), default=0.0),
+			"latency_max": max((move["latency_max"] for move in self.moves), default=0.0),
+			"loop_overhead": sum(move["loop_overhead"] for move in self.moves),
+		}
+
+	# Write one row per move, with the histogram as bucket counts separated by "|"
+	def export_csv(self, path):
+		with open(path, "w", newline="") as f:
+			writer = csv.writer(f)
+			writer.writerow(FIELDS)
+			for move in self.moves:
+				writer.writerow([("|".join(str(n) for n in move[field]) if field == "histogram" else move[field]) for field in FIELDS])
+
+	def export_json(self, path):
+		with open(path, "w") as f:
+			json.dump({"buckets": LATENCY_BUCKETS, "summary": self.summary(), "moves": self.moves}, f, indent=1)
+
+	# Pick the format from the file extension
+	def export(self, path):
+		if path.endswith(".json"):
+			self.export_json(path)
+		else:
+			self.export_csv(path)
@@ -0,0 +1,304 @@
+"""
+Run log
+
+A record of every run kept for auditing afterwards, unlike the run journal
+which only exists to carry on a run that was cut short. Every event of the
+run becomes one row: when it happened, the well, the motor positions and,
+for each finished well, how long the pump was actually open against the
+pump time, the volume that gave by the pump's FlowModel and when the
+schedule had the well done.
+
+Rows are written as CSV, and optionally also in a compact binary columnar
+format. Like the journal, rows are handed to a writer thread so the run
+never waits on the disk.
+
+The binary format is a magic line followed by row groups. Each row group is
+a length prefixed JSON header giving the number of rows and, for every
+column, its array typecode, its length in bytes and, for text columns, the
+dictionary its codes index into. The column data follows, one packed array
+after another, so a reader can pick out a single column without parsing
+the rest.
+
+A report from a log gives the pump open time and volume of every well and
+splits the run into time spent moving, pumping, waiting on settle and
+dwell, and paused, so lost time shows up where it happened.
+"""
+from array import array
+import csv
+import json
+import math
+import os
+import queue
+import struct
+import threading
+import time
+
+from schedule import format_duration
+
+# Where run logs are kept, one file per run
+RUN_LOG_DIR = os.path.join(os.path.expanduser("~"), ".local", "share", "robotic-fractionator", "runs")
+
+# Columns of a run log and their array typecodes ("s" for text)
+# Times are in seconds from the start of the run and positions in cm
+# Columns that do not apply to an event are NaN, -1 or empty
+COLUMNS = (
+	("time", "d"),
+	("wall", "d"),
+	("event", "s"),
+	("index", "i"),
+	("well", "s"),
+	("table", "d"),
+	("carriage", "d"),
+	("open_time", "d"),
+	("pump_time", "d"),
+	("volume", "d"),
+	("planned", "d"),
+)
+
+# First bytes of a binary run log
+BINARY_MAGIC = b"FRLOG1\n"
+
+# Rows in each row group of a binary run log
+ROW_GROUP_ROWS = 256
+
+# What the instrument is doing after each event, for the time breakdown
+EVENT_ACTIVITIES = {
+	"move": "moving",
+	"return": "moving",
+	"arrived": "waiting",
+	"pump": "pumping",
+	"done": "waiting",
+	"paused": "paused",
+}
+
+# Order the time breakdown is reported in
+ACTIVITIES = ("moving", "pumping", "waiting", "paused")
+
+class RunLog:
+	def __init__(self, directory=RUN_LOG_DIR, binary=False):
+		self.directory = directory
+		self.binary = binary
+		self.rows = queue.Queue()
+		self.thread = None
+
+		# Path of the CSV log of the last run attached to, and the pump
+		# rate of its job in cc/hr
+		self.path = None
+		self.rate = None
+
+	# Start logging a run, with the rate of its job for the volumes
+	def attach(self, run, job):
+		self.close()
+		self.rows = queue.Queue()
+		os.makedirs(self.directory, exist_ok=True)
+		self.path = self.new_path(time.strftime("run-%Y%m%d-%H%M%S"))
+		self.rate = job.rate
+
+		self.thread = threading.Thread(target=self.write, args=(self.path,), daemon=True)
+		self.thread.start()
+		run.listeners.append(self.record)
+
+	# A path for a new log that does not overwrite an older one
+	def new_path(self, name):
+		path = os.path.join(self.directory, name + ".csv")
+		count = 1
+		while os.path.exists(path):
+			count += 1
+			path = os.path.join(self.directory, "%s-%d.csv" % (name, count))
+		return path
+
+	# Listener for Fractionation events
+	def record(self, event, run):
+		start = run.start_time if run.start_time is not None else run.clock.now()
+		index = run.plan_index
+		well = run.plan.wells[index] if 0 <= index < len(run.plan) else ""
+		table, carriage = run.gantry.position()
+		row = [run.clock.now() - start, time.time(), event, index, well, table, carriage, math.nan, math.nan, math.nan, math.nan]
+		if event == "done":
+			open_time = run.open_times[index]
+			volume = run.dispenser.flow.volume(open_time, self.rate, run.cycle.continuous)
+			row[7:10] = [open_time, run.cycle.pump_time, volume]
+			if run.schedule is not None:
+				row[10] = run.schedule.finishes.get(index, math.nan)
+		self.rows.put(row)
+		if event in ("finished", "stopped"):
+			self.rows.put(None)
+
+	# Write rows as they come, a batch at a time
+	def write(self, path):
+		names = [name for name, typecode in COLUMNS]
+		binary = None
+		if self.binary:
+			binary = open(os.path.splitext(path)[0] + ".frlog", "wb")
+			binary.write(BINARY_MAGIC)
+		group = []
+		with open(path, "w", newline="") as f:
+			writer = csv.writer(f)
+			writer.writerow(names)
+			while True:
+				row = self.rows.get()
+				batch = []
+				while row is not None:
+					batch.append(row)
+					try:
+						row = self.rows.get_nowait()
+					except queue.Empty:
+						break
+				writer.writerows(format_row(values) for values in batch)
+				f.flush()
+
+				if binary is not None:
+					group.extend(batch)
+					if len(group) >= ROW_GROUP_ROWS or row is None:
+						write_row_group(binary, group)
+						group = []
+				if row is None:
+					break
+		if binary is not None:
+			binary.close()
+
+	# Wait for every row so far to be written
+	def close(self):
+		if self.thread is not None:
+			self.rows.put(None)
+			self.thread.join()
+			self.thread = None
+
+	# Report on the last run once its log is written, with a line for
+	# every well if wells is True
+	def report(self, wells=False):
+		self.close()
+		return run_report(read_run_log(self.path), wells)
+
+# CSV text of a row, with columns that do not apply left empty
+def format_row(values):
+	return ["" if isinstance(value, float) and math.isnan(value) else value for value in values]
+
+# Write rows to a binary run log as one row group
+def write_row_group(f, rows):
+	if not rows:
+		return
+	columns = []
+	data = []
+	for i, (name, typecode) in enumerate(COLUMNS):
+		values = [row[i] for row in rows]
+		column = {"name": name, "typecode": typecode}
+		if typecode == "s":
+			# Text is stored as codes into a dictionary of the values
+			dictionary = sorted(set(values))
+			codes = {value: code for code, value in enumerate(dictionary)}
+			column["dictionary"] = dictionary
+			packed = array("H", (codes[value] for value in values)).tobytes()
+			column["typecode"] = "H"
+		else:
+			packed = array(typecode, values).tobytes()
+		column["bytes"] = len(packed)
+		columns.append(column)
+		data.append(packed)
+	header = json.dumps({"rows": len(rows), "columns": columns}).encode()
+	f.write(struct.pack("<I", len(header)))
+	f.write(header)
+	for packed in data:
+		f.write(packed)
+
+# Read a run log written as CSV or in the binary format, as a list of rows
+# that are dictionaries keyed by column name
+def read_run_log(path):
+	with open(path, "rb") as f:
+		if f.read(len(BINARY_MAGIC)) == BINARY_MAGIC:
+			return read_binary(f)
+
+	rows = []
+	with open(path, newline="") as f:
+		for record in csv.DictReader(f):
+			row = {}
+			for name, typecode in COLUMNS:
+				value = record[name]
+				if typecode == "d":
+					row[name] = float(value) if value != "" else math.nan
+				elif typecode == "i":
+					row[name] = int(value)
+				else:
+					row[name] = value
+			rows.append(row)
+	return rows
+
+def read_binary(f):
+	rows = []
+	while True:
+		size = f.read(4)
+		if len(size) < 4:
+			return rows
+		header = json.loads(f.read(struct.unpack("<I", size)[0]))
+		columns = {}
+		for column in header["columns"]:
+			values = array(column["typecode"])
+			values.frombytes(f.read(column["bytes"]))
+			if "dictionary" in column:
+				values = [column["dictionary"][code] for code in values]
+			columns[column["name"]] = values
+		for i in range(header["rows"]):
+			rows.append({name: columns[name][i] for name, typecode in COLUMNS})
+
+# The newest CSV log in a directory, or None if there are none
+def latest_run_log(directory=RUN_LOG_DIR):
+	if not os.path.isdir(directory):
+		return None
+	paths = [os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(".csv")]
+	return max(paths, key=os.path.getmtime, default=None)
+
+# Seconds spent moving, pumping, waiting and paused over a run
+# The time after each event counts towards what the instrument was doing
+# then, and a resumed run goes back to what it was doing before the pause
+def time_breakdown(rows):
+	totals = {activity: 0.0 for activity in ACTIVITIES}
+	activity = None
+	before_pause = None
+	last = None
+	for row in rows:
+		if activity is not None:
+			totals[activity] += row["time"] - last
+		last = row["time"]
+		event = row["event"]
+		if event == "paused":
+			before_pause = activity
+			activity = "paused"
+		elif event == "resumed":
+			activity = before_pause
+		elif event in ("finished", "stopped"):
+			activity = None
+		elif event in EVENT_ACTIVITIES:
+			activity = EVENT_ACTIVITIES[event]
+	return totals
+
+# Report on a run from its log, with a line for every well if wells is True
+def run_report(rows, wells=False):
+	done = [row for row in rows if row["event"] == "done"]
+	lines = []
+	if wells:
+		lines.append("Well    Open (s)  Error (ms)  Volume (cc)  Late (s)")
+		for row in done:
+			late = row["time"] - row["planned"]
+			lines.append("%-6s %9.3f %+11.2f %12.4f %9s" % (row["well"], row["open_time"], 1000 * (row["open_time"] - row["pump_time"]),
+				row["volume"], "" if math.isnan(late) else "%+.1f" % (round(late, 1) + 0.0)))
+
+	if done:
+		errors = [row["open_time"] - row["pump_time"] for row in done]
+		worst = max(range(len(done)), key=lambda i: abs(errors[i]))
+		volumes = [row["volume"] for row in done]
+		lines.append("%d wells, pump open %.3f s each planned, error mean %+.2f ms, worst %+.2f ms (%s)" % (
+			len(done), done[0]["pump_time"], 1000 * sum(errors) / len(errors), 1000 * errors[worst], done[worst]["well"]))
+		lines.append("Volume %.3f cc in all, %.4f to %.4f cc per well" % (sum(volumes), min(volumes), max(volumes)))
+	else:
+		lines.append("No wells were done")
+
+	if rows:
+		total = rows[-1]["time"] - rows[0]["time"]
+		end = rows[-1]["event"] if rows[-1]["event"] in ("finished", "stopped") else "cut short"
+		lines.append("Run %s after %s" % (end, format_duration(total)))
+		for activity, seconds in time_breakdown(rows).items():
+			lines.append("  %-8s %9.1f s %5.1f%%" % (activity, seconds, 100 * seconds / total if total > 0 else 0.0))
+		late = [row["time"] - row["planned"] for row in done if not math.isnan(row["planned"])]
+		if late:
+			lines.append("Last well %+.1f s against the plan" % (round(late[-1], 1) + 0.0))
+	return "\n".join(lines)
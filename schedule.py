@@ -0,0 +1,194 @@
+"""
+Run schedules
+
+Before anything moves, a run is compiled into a Schedule: the timed list of
+every move, with its step counts and duration, and every pump edge, from
+the start of the run to the needle's return. Its length is how long the
+plate will take, and the time each well is planned to finish lets a live
+run be followed against the plan.
+
+Compiling first checks every target against the travel of both axes, so a
+mistyped well size fails straight away instead of when the carriage reaches
+the end of the lead screw. The run is then played out by the same
+Fractionation the real run uses, on simulated drivers that start where the
+real motors are (position, direction of travel, coil phase, backlash and
+motion profiles) against a virtual clock. That way the timing rules of the
+cycles are only written once, and backlash and hybrid steps come out just
+as they will on the instrument. Each driver call is taken to cost
+SIM_STEP_LATENCY, as on the motor HAT.
+"""
+from hardware import SimBackend
+from gantry import open_gantry
+from loop import HeadlessLoop
+from dispenser import Dispenser
+from fractionation import make_fractionation
+
+# Write a number of seconds the way a person would say it
+def format_duration(seconds):
+	seconds = round(seconds)
+	if seconds >= 3600:
+		return "%d h %02d min" % (seconds // 3600, seconds % 3600 // 60)
+	if seconds >= 60:
+		return "%d min %02d s" % (seconds // 60, seconds % 60)
+	return "%d s" % seconds
+
+"""
+Action Class
+
+One thing that happens in a run, start seconds after it begins: a "move"
+to a well or the "return" to the start, taking duration seconds and a
+number of driver steps on the table and carriage, or a "pump on" or
+"pump off" over a well.
+"""
+
+class Action:
+	def __init__(self, kind, start, well=None, duration=0.0, target=None, steps=(0, 0)):
+		self.kind = kind
+		self.start = start
+		self.well = well
+		self.duration = duration
+		self.target = target
+		self.steps = steps
+
+	def describe(self):
+		if self.target is None:
+			return "%9.2f s  %-8s %s" % (self.start, self.kind, self.well)
+		return "%9.2f s  %-8s %-4s table %.3f cm, carriage %.3f cm in %.2f s, %d + %d steps" % (
+			self.start, self.kind, self.well or "", self.target[0], self.target[1], self.duration, self.steps[0], self.steps[1])
+
+"""
+Schedule Class
+
+The compiled run: every Action in order, the time each well in the plan is
+planned to be done (by index in the plan) and the length of the whole run.
+"""
+
+class Schedule:
+	def __init__(self, actions, finishes, duration):
+		self.actions = actions
+		self.finishes = finishes
+		self.duration = duration
+
+	# Total time the pump is planned to be open
+	def pump_time(self):
+		total = 0.0
+		opened = None
+		for action in self.actions:
+			if action.kind == "pump on":
+				opened = action.start
+			elif action.kind == "pump off" and opened is not None:
+				total += action.start - opened
+				opened = None
+		return total
+
+	# Total driver steps of the table and carriage
+	def steps(self):
+		moves = [action.steps for action in self.actions if action.target is not None]
+		return (sum(table for table, carriage in moves), sum(carriage for table, carriage in moves))
+
+	# Seconds left in the run, once a number of wells are done and since
+	# seconds after the last of them
+	# Never less than what is left once the next well is done, so a pause
+	# does not run it down to nothing
+	def remaining(self, wells_done, since=0.0):
+		last = self.finishes.get(wells_done - 1, 0.0)
+		following = self.finishes.get(wells_done, self.duration)
+		return self.duration - min(last + since, following)
+
+	# Seconds a run is behind the plan (ahead if negative) when the well at
+	# an index in the plan is done, elapsed seconds after the run began
+	def lateness(self, index, elapsed):
+		return elapsed - self.finishes.get(index, elapsed)
+
+	def describe(self):
+		table, carriage = self.steps()
+		return "Plan: %d wells in %s, pump open %.1f s, %d table and %d carriage steps" % (
+			len(self.finishes), format_duration(self.duration), self.pump_time(), table, carriage)
+
+# Raise ValueError if a well of the run, or the start it returns to, is out
+# of reach of either axis
+# Without homing the positions are only known from where the motors
+# started, so then only the distance the run covers can be checked
+def check_travel(gantry, geometry, plan, index=0):
+	targets = [("Well " + name, geometry.position(name)) for name in plan.wells[index:]]
+	targets.append(("The start", (0.0, 0.0)))
+	here = gantry.position()
+	for axis, (low, high) in enumerate((gantry.travel["table"], gantry.travel["carriage"])):
+		name = ("table", "carriage")[axis]
+		if gantry.homed:
+			for target, position in targets:
+				if not low <= position[axis] <= high:
+					raise ValueError("%s is at %.2f cm on the %s, outside its travel of %.2f to %.2f cm" % (target, position[axis], name, low, high))
+		else:
+			points = [here[axis]] + [position[axis] for target, position in targets]
+			if max(points) - min(points) > high - low:
+				raise ValueError("The plate covers %.2f cm of %s travel, more than the %.2f cm there is" % (max(points) - min(points), name, high - low))
+
+# Compile a run that starts at the well at index in the plan
+# Raises ValueError if anything is out of reach
+def compile_run(gantry, geometry, plan, cycle, index=0):
+	check_travel(gantry, geometry, plan, index)
+
+	# Simulated drivers, set up like the real ones
+	backend = SimBackend()
+	dry = open_gantry(backend)
+	dry.homed = gantry.homed
+	dry.travel = dict(gantry.travel)
+	for motor, real in ((dry.table_motor, gantry.table_motor), (dry.carriage_motor, gantry.carriage_motor)):
+		motor.position = real.position
+		motor.forwards = real.forwards
+		motor.backlash = real.backlash
+		motor.slack = real.slack
+		motor.profile = real.profile
+		motor.hybrid = real.hybrid
+		motor.coarse_style = real.coarse_style
+		motor.phase = real.phase
+		if real.phase is not None:
+			motor.motor.current_microstep = real.phase
+
+	clock = backend.clock
+	loop = HeadlessLoop(clock, dry.motion)
+	dispenser = Dispenser(backend.pump(), clock)
+	loop.add_worker(dispenser.worker)
+	run = make_fractionation(loop, dry, dispenser, clock, geometry, plan, cycle)
+
+	# Note each move as it happens
+	moves = []
+	steppers = (dry.table_motor.motor, dry.carriage_motor.motor)
+	move_to = dry.move_to
+	def record_move(table, carriage, on_done=None):
+		start = clock.now()
+		before = [len(stepper.steps) for stepper in steppers]
+		well = run.well() if run.state == "move" else None
+		def moved(completed):
+			steps = tuple(len(stepper.steps) - count for stepper, count in zip(steppers, before))
+			moves.append(Action("move" if well else "return", start, well, clock.now() - start, (table, carriage), steps))
+			on_done(completed)
+		move_to(table, carriage, moved)
+	dry.move_to = record_move
+
+	finishes = {}
+	def record(event, run):
+		if event == "done":
+			finishes[run.plan_index] = clock.now()
+	run.listeners.append(record)
+
+	run.start(index)
+	loop.run_until(run.is_over)
+	dry.shutdown()
+	dispenser.shutdown()
+
+	# Pump edges are over the well the needle last reached, and come after
+	# a move that takes no time but before any other move that starts with
+	# them
+	actions = []
+	reached = 0
+	well = None
+	for time, state in backend.pump().edges:
+		while reached < len(moves) and moves[reached].start + moves[reached].duration <= time:
+			well = moves[reached].well
+			reached += 1
+		actions.append(Action("pump on" if state else "pump off", time, well))
+	actions.extend(moves)
+	actions.sort(key=lambda action: (action.start, 0 if action.target is None else 1 if action.duration > 0 else -1))
+	return Schedule(actions, finishes, clock.now())
@@ -0,0 +1,481 @@
+"""
+Telemetry server
+
+A small HTTP and WebSocket server, so a run can be watched and paused from
+a browser or a dashboard instead of at the Pi's screen:
+
+	GET  /state    the current state as JSON
+	GET  /ws       a WebSocket that sends the state straight away and again
+	               every time it changes
+	POST /pause    pause the run
+	POST /resume   carry on a paused run
+	POST /stop     abandon the run (and the queue, when running one)
+	POST /proceed  carry on the queue once the next plate is in place
+
+The same commands can be sent over the WebSocket as {"command": "pause"}.
+
+One server can serve several instruments. /instruments then lists the state
+of each, /<name>/state and /<name>/pause (and so on) reach one of them, and
+the commands without a name go to all of them. WebSocket messages carry the
+instrument's name, and commands sent over it can name one too.
+
+The state is the current well, how many are done, the motor positions, the
+pump, the time left and how far behind its schedule the run is (see
+schedule.py). It is put together by the run's own listeners whenever
+something happens, so nothing polls for it, and is handed to the server
+thread, which sends it out. Commands go the other way through an Inbox
+that the event loop polls like a worker, so they are carried out on the
+thread that owns the run. The server never touches the motion worker, so
+the step loop runs exactly as it does without it.
+
+Only the standard library is used: the server is asyncio streams with just
+enough HTTP and WebSocket (RFC 6455) for the above.
+"""
+import asyncio
+import base64
+import hashlib
+import json
+import queue
+import struct
+import threading
+import time
+
+# Default address; use "0.0.0.0" as the host to be seen from other machines
+TELEMETRY_HOST = "127.0.0.1"
+TELEMETRY_PORT = 8765
+
+# Commands that can be sent to a run
+COMMANDS = ("pause", "resume", "stop", "proceed")
+
+# Key suffix from RFC 6455 for the WebSocket handshake
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+# Longest request head or WebSocket message accepted, in bytes
+MAX_MESSAGE = 65536
+
+"""
+Inbox Class
+
+Functions handed over from another thread to be called on the thread that
+runs the event loop. It looks like a MotionWorker to TkLoop and HeadlessLoop,
+which poll() it along with the workers.
+"""
+
+class Inbox:
+	def __init__(self):
+		self.results = queue.Queue()
+
+		# Set by HeadlessLoop so it wakes up for new functions
+		self.notify = None
+
+	# Call a function on the event loop thread
+	def put(self, function):
+		self.results.put(function)
+		if self.notify is not None:
+			self.notify()
+
+	def poll(self):
+		while True:
+			try:
+				function = self.results.get_nowait()
+			except queue.Empty:
+				return
+			function()
+
+"""
+Telemetry Class
+
+The state of one instrument, following the runs it is told to watch:
+watch() follows a single Fractionation, watch_runner() every job a
+JobRunner starts. name tells instruments apart when one dashboard watches
+several.
+
+start() serves it on its own; to serve several instruments together, add
+them to a TelemetryServer instead.
+"""
+
+class Telemetry:
+	def __init__(self, loop, gantry, pump, clock, host=TELEMETRY_HOST, port=TELEMETRY_PORT, name="fractionator"):
+		self.gantry = gantry
+		self.pump = pump
+		self.clock = clock
+		self.name = name
+
+		self.inbox = Inbox()
+		loop.add_worker(self.inbox)
+
+		self.run = None
+		self.runner = None
+		self.started = None
+		self.first_done = 0
+		self.last_done = None
+		self.late = None
+		self.snapshot = self.state()
+
+		# The server this instrument is published on
+		self.server = None
+		self.own_server = TelemetryServer(host, port)
+
+	# Serve this instrument on its own
+	# Raises OSError if the port cannot be opened
+	def start(self):
+		self.own_server.add(self)
+		self.own_server.start()
+
+	def close(self):
+		self.own_server.close()
+
+	# Port being served on, once started
+	@property
+	def host(self):
+		return self.own_server.host
+
+	@property
+	def port(self):
+		return self.own_server.port
+
+	# Follow a Fractionation
+	def watch(self, run):
+		self.run = run
+		self.started = None
+		self.last_done = None
+		self.late = None
+		run.listeners.append(self.fractionation_event)
+		self.publish()
+
+	# Follow every job a JobRunner starts
+	def watch_runner(self, runner):
+		self.runner = runner
+		runner.listeners.append(self.runner_event)
+		self.publish()
+
+	def fractionation_event(self, event, run):
+		if run is not self.run:
+			return
+		if self.started is None:
+			self.started = self.clock.now()
+			self.first_done = run.wells_done
+		if event == "done":
+			self.last_done = self.clock.now()
+			if run.schedule is not None:
+				self.late = run.schedule.lateness(run.plan_index, self.last_done - run.start_time)
+		self.publish(event)
+
+	def runner_event(self, event, runner):
+		if event == "start":
+			self.watch(runner.fractionation)
+		else:
+			self.publish(event)
+
+	# Everything a dashboard shows, as a dictionary that converts to JSON
+	def state(self, event=None):
+		table, carriage = self.gantry.position()
+		snapshot = {
+			"name": self.name,
+			"time": time.time(),
+			"event": event,
+			"state": "idle",
+			"paused": False,
+			"well": None,
+			"wells_done": 0,
+			"wells_total": 0,
+			"table": table,
+			"carriage": carriage,
+			"pump": bool(self.pump.value),
+			"eta": None,
+			"planned": None,
+			"late": None,
+			"queue": None,
+		}
+		run = self.run
+		if run is not None:
+			snapshot.update(state=run.state, paused=run.is_paused, wells_done=run.wells_done, wells_total=len(run.plan))
+			if 0 <= run.plan_index < len(run.plan):
+				snapshot["well"] = run.well()
+
+			# The dispenser turns the pump on just after the "pump" event
+			if run.state == "pump" and not run.is_paused:
+				snapshot["pump"] = True
+			snapshot["eta"] = self.eta(run)
+			if run.schedule is not None:
+				snapshot.update(planned=run.schedule.duration, late=self.late)
+		if self.runner is not None:
+			job = self.runner.job
+			snapshot["queue"] = {"state": self.runner.state, "job": job.id if job is not None else None}
+		return snapshot
+
+	# Seconds left in a run, from its schedule, or from how long its wells
+	# have taken so far if it has none
+	def eta(self, run):
+		if run.is_over():
+			return 0.0
+		if run.schedule is not None:
+			since = 0.0
+			if run.start_time is not None:
+				since = self.clock.now() - (self.last_done if self.last_done is not None else run.start_time)
+			return run.schedule.remaining(run.wells_done, since)
+		remaining = len(run.plan) - run.wells_done
+		done = run.wells_done - self.first_done
+		if self.started is not None and done > 0:
+			return remaining * (self.clock.now() - self.started) / done
+		return remaining * run.cycle.period(0.0)
+
+	# Hand the latest state to the server
+	def publish(self, event=None):
+		self.snapshot = self.state(event)
+		if self.server is not None:
+			self.server.publish(self, json.dumps(self.snapshot))
+
+	# Carry out a command on the event loop thread
+	# Stop and proceed go to the runner while it has the instrument, running
+	# one of its jobs or between them, and a run started on its own is
+	# stopped by itself
+	def command(self, name):
+		runner = self.runner
+		if runner is not None and name in ("stop", "proceed") and (self.run is runner.fractionation or runner.state in ("hold", "waiting")):
+			if name == "stop":
+				runner.stop()
+			else:
+				runner.proceed()
+			return
+		run = self.run
+		if run is None:
+			return
+		if name == "pause":
+			run.pause()
+		elif name == "resume":
+			run.resume()
+		elif name == "stop":
+			run.stop()
+
+	# Pass a command over to the event loop thread
+	def send(self, name):
+		self.inbox.put(lambda: self.command(name))
+
+"""
+TelemetryServer Class
+
+Serves any number of instruments (Telemetry objects) on one port, from an
+asyncio loop on a thread of its own.
+"""
+
+class TelemetryServer:
+	def __init__(self, host=TELEMETRY_HOST, port=TELEMETRY_PORT):
+		self.host = host
+		self.port = port
+		self.instruments = {}
+
+		# Only touched on the server thread once started
+		self.server_loop = None
+		self.server = None
+		self.clients = set()
+		self.thread = None
+
+	def add(self, telemetry):
+		self.instruments[telemetry.name] = telemetry
+		telemetry.server = self
+
+	# Start serving on a thread of its own
+	# Raises OSError if the port cannot be opened
+	def start(self):
+		ready = threading.Event()
+		errors = []
+
+		def serve():
+			self.server_loop = asyncio.new_event_loop()
+			try:
+				self.server = self.server_loop.run_until_complete(asyncio.start_server(self.handle, self.host, self.port))
+			except OSError as e:
+				errors.append(e)
+				ready.set()
+				return
+			ready.set()
+			self.server_loop.run_forever()
+
+			# Let the connections that are still open wind up
+			self.server_loop.run_until_complete(cancel_tasks())
+			self.server_loop.close()
+
+		self.thread = threading.Thread(target=serve, daemon=True)
+		self.thread.start()
+		ready.wait()
+		if errors:
+			self.thread = None
+			raise errors[0]
+
+		# The port actually opened, in case it was 0
+		self.port = self.server.sockets[0].getsockname()[1]
+
+	def close(self):
+		if self.thread is not None:
+			self.server_loop.call_soon_threadsafe(self.shutdown)
+			self.thread.join()
+			self.thread = None
+
+	# Send out the newest state of an instrument, from any thread
+	def publish(self, telemetry, text):
+		if self.thread is not None:
+			self.server_loop.call_soon_threadsafe(self.broadcast, telemetry.name, text)
+
+	# Send a command to one instrument by name, or to all of them
+	def send(self, command, name=None):
+		for telemetry in self.instruments.values():
+			if name is None or telemetry.name == name:
+				telemetry.send(command)
+
+	##  SERVER THREAD  ##
+
+	def shutdown(self):
+		self.server.close()
+		self.server_loop.stop()
+
+	# Wake every WebSocket up to send the newest state
+	def broadcast(self, name, text):
+		for client in self.clients:
+			client.latest[name] = text
+			client.ready.set()
+
+	async def handle(self, reader, writer):
+		try:
+			request = await reader.readuntil(b"\r\n\r\n")
+			lines = request.decode("latin-1").split("\r\n")
+			method, path = lines[0].split(" ")[:2]
+			headers = {}
+			for line in lines[1:]:
+				if ":" in line:
+					key, value = line.split(":", 1)
+					headers[key.strip().lower()] = value.strip()
+			length = int(headers.get("content-length", 0))
+			if length > MAX_MESSAGE:
+				raise ValueError("Request too long")
+			if length:
+				await reader.readexactly(length)
+
+			# Paths are /action, or /<name>/action for one instrument
+			parts = path.strip("/").split("/")
+			name = parts[0] if len(parts) == 2 else None
+			action = parts[-1]
+
+			if action == "ws" and headers.get("upgrade", "").lower() == "websocket":
+				if "sec-websocket-key" in headers:
+					await self.websocket(reader, writer, headers)
+				else:
+					self.respond(writer, 400, {"error": "Missing Sec-WebSocket-Key"})
+			elif name is not None and name not in self.instruments:
+				self.respond(writer, 404, {"error": "Unknown instrument: " + name})
+			elif method == "GET" and action == "instruments" and name is None:
+				self.respond(writer, 200, [telemetry.snapshot for telemetry in self.instruments.values()])
+			elif method == "GET" and action == "state":
+				# Without a name, the state of the only instrument
+				if name is None and len(self.instruments) == 1:
+					name = next(iter(self.instruments))
+				if name is None:
+					self.respond(writer, 200, [telemetry.snapshot for telemetry in self.instruments.values()])
+				else:
+					self.respond(writer, 200, self.instruments[name].snapshot)
+			elif method == "POST" and action in COMMANDS:
+				self.send(action, name)
+				self.respond(writer, 202, {"command": action, "name": name})
+			else:
+				self.respond(writer, 404, {"error": "Not found"})
+			await writer.drain()
+		except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, ValueError):
+			pass
+		finally:
+			writer.close()
+
+	def respond(self, writer, status, data):
+		body = json.dumps(data).encode()
+		reasons = {200: "OK", 202: "Accepted", 400: "Bad Request", 404: "Not Found"}
+		writer.write(("HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n"
+			"Access-Control-Allow-Origin: *\r\nConnection: close\r\n\r\n" % (status, reasons[status], len(body))).encode() + body)
+
+	async def websocket(self, reader, writer, headers):
+		accept = base64.b64encode(hashlib.sha1((headers["sec-websocket-key"] + WEBSOCKET_GUID).encode()).digest()).decode()
+		writer.write(("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+			"Sec-WebSocket-Accept: %s\r\n\r\n" % accept).encode())
+
+		client = Client({name: json.dumps(telemetry.snapshot) for name, telemetry in self.instruments.items()})
+		self.clients.add(client)
+		receiving = asyncio.ensure_future(self.receive(reader, writer, client))
+		try:
+			while True:
+				await client.ready.wait()
+				client.ready.clear()
+				if client.closed:
+					break
+				latest, client.latest = client.latest, {}
+				for text in latest.values():
+					writer.write(frame(0x1, text.encode()))
+				await writer.drain()
+		except asyncio.CancelledError:
+			# The server is closing, so tell the client it is going away
+			writer.write(frame(0x8, struct.pack("!H", 1001)))
+		finally:
+			self.clients.discard(client)
+			receiving.cancel()
+
+	# Read frames from a WebSocket client until it closes
+	async def receive(self, reader, writer, client):
+		try:
+			while True:
+				opcode, payload = await read_frame(reader)
+				if opcode == 0x8:
+					writer.write(frame(0x8, payload[:2]))
+					break
+				if opcode == 0x9:
+					writer.write(frame(0xA, payload))
+				elif opcode == 0x1:
+					try:
+						message = json.loads(payload.decode())
+						command, name = message.get("command"), message.get("name")
+					except (ValueError, AttributeError):
+						continue
+					if command in COMMANDS:
+						self.send(command, name)
+		except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+			pass
+		client.closed = True
+		client.ready.set()
+
+# Cancel every other task on the running loop and wait for them to end
+async def cancel_tasks():
+	tasks = asyncio.all_tasks() - {asyncio.current_task()}
+	for task in tasks:
+		task.cancel()
+	await asyncio.gather(*tasks, return_exceptions=True)
+
+# One WebSocket client, holding the newest state of each instrument that it
+# has not been sent yet
+class Client:
+	def __init__(self, latest):
+		self.latest = latest
+		self.ready = asyncio.Event()
+		self.ready.set()
+		self.closed = False
+
+# Build an unmasked WebSocket frame, as sent by a server
+def frame(opcode, payload):
+	header = bytes([0x80 | opcode])
+	if len(payload) < 126:
+		header += bytes([len(payload)])
+	elif len(payload) < 65536:
+		header += bytes([126]) + struct.pack("!H", len(payload))
+	else:
+		header += bytes([127]) + struct.pack("!Q", len(payload))
+	return header + payload
+
+# Read one WebSocket frame, returning (opcode, payload)
+# Frames from clients are always masked
+async def read_frame(reader):
+	first, second = await reader.readexactly(2)
+	length = second & 0x7F
+	if length == 126:
+		length = struct.unpack("!H", await reader.readexactly(2))[0]
+	elif length == 127:
+		length = struct.unpack("!Q", await reader.readexactly(8))[0]
+	if length > MAX_MESSAGE:
+		raise ValueError("Message too long")
+	mask = await reader.readexactly(4) if second & 0x80 else bytes(4)
+	payload = await reader.readexactly(length)
+	return first & 0x0F, bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
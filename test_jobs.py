@@ -0,0 +1,79 @@
+"""
+Job queue tests
+
+Queues run through a JobRunner on the simulated hardware, with the queue
+kept in a temporary file.
+"""
+import os
+import tempfile
+import unittest
+
+from hardware import SimBackend
+from gantry import open_gantry
+from loop import HeadlessLoop
+from dispenser import Dispenser
+from jobs import Job, JobQueue, JobRunner
+
+class RunnerTest(unittest.TestCase):
+	def setUp(self):
+		self.backend = SimBackend()
+		self.gantry = open_gantry(self.backend)
+		self.loop = HeadlessLoop(self.backend.clock, self.gantry.motion)
+		self.dispenser = Dispenser(self.backend.pump(), self.backend.clock)
+		self.loop.add_worker(self.dispenser.worker)
+		self.directory = tempfile.TemporaryDirectory()
+		self.queue = JobQueue(os.path.join(self.directory.name, "jobs.json"))
+
+	def tearDown(self):
+		self.dispenser.shutdown()
+		self.gantry.shutdown()
+		self.directory.cleanup()
+
+	# Move the needle and wait for it to get there
+	def move_to(self, table, carriage):
+		ready = []
+		self.gantry.move_to(table, carriage, ready.append)
+		self.loop.run_until(lambda: ready)
+
+	# Run the queue until it has nothing left to do
+	def run_queue(self, runner):
+		runner.start()
+		self.loop.run_until(lambda: runner.state in ("idle", "stopped"))
+
+	# Every run ends back at the start of the axes, and plates without
+	# labware must still take A1 from where the queue started
+	def test_plates_without_labware_share_origin(self):
+		self.move_to(5.0, 3.0)
+		for _ in range(2):
+			self.queue.add(Job(360, 0.5, rows=2, cols=2, well_size=0.9, hold=0))
+		runner = JobRunner(self.queue, self.loop, self.gantry, self.dispenser, self.backend.clock)
+		first_wells = []
+		def record(event, run):
+			if event == "pump" and run.plan_index == 0:
+				first_wells.append(self.gantry.position())
+		runner.run_listeners.append(record)
+		self.run_queue(runner)
+
+		self.assertEqual(len(first_wells), 2)
+		for a, b in zip(first_wells[0], first_wells[1]):
+			self.assertAlmostEqual(a, b, places=2)
+
+	# A job that fails before it starts must not leave the last job's run
+	# behind for its end to be reported with
+	def test_failed_job_has_no_run(self):
+		self.queue.add(Job(360, 0.5, rows=1, cols=2, well_size=0.9, hold=0))
+		self.queue.add(Job(360, 0.5, rows=1, cols=2, well_size=50, hold=0))
+		runner = JobRunner(self.queue, self.loop, self.gantry, self.dispenser, self.backend.clock)
+		ends = []
+		def record(event, runner):
+			if event == "end":
+				ends.append((runner.job.status, runner.fractionation))
+		runner.listeners.append(record)
+		self.run_queue(runner)
+
+		self.assertEqual([status for status, run in ends], ["done", "failed"])
+		self.assertIsNotNone(ends[0][1])
+		self.assertIsNone(ends[1][1])
+
+if __name__ == "__main__":
+	unittest.main()
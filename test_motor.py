@@ -0,0 +1,66 @@
+"""
+Motor tests
+
+Moves on the simulated drivers, whose sliders only follow the shaft once the
+backlash is taken up, checked against the position the motor keeps. The
+simulated slider starts against the other side of the screw from the motor,
+so positions are compared from the end of a first forward move.
+"""
+import unittest
+
+from hardware import SimBackend
+from motor import StepperMotor, NEMA_17_STEPS_PER_DEGREE, LEAD_SCREW_PITCH_IN_CM, move_together
+
+# Looks like a cancel event, and is set after a number of ticks
+class CancelAfter:
+	def __init__(self, ticks):
+		self.ticks = ticks
+
+	def is_set(self):
+		self.ticks -= 1
+		return self.ticks < 0
+
+class CancelTest(unittest.TestCase):
+	def setUp(self):
+		backend = SimBackend(backlash=240)
+		self.motor = StepperMotor(1, NEMA_17_STEPS_PER_DEGREE, LEAD_SCREW_PITCH_IN_CM, False, backend)
+		self.motor.backlash = 240
+		self.stepper = self.motor.motor
+		self.motor.move_dist_absolute(0.5)
+		self.offset = self.motor.position - self.stepper.slider
+
+	def assertAtSlider(self):
+		self.assertEqual(self.motor.position - self.stepper.slider, self.offset)
+
+	# Cancel a reversing move while it is still taking up the backlash, then
+	# finish it, and the position must still be where the slider is
+	def check_cancel_while_reversing(self, ticks):
+		self.motor.move_dist_absolute(1.0)
+		self.assertAtSlider()
+
+		completed = move_together([(self.motor, -1.0 / self.motor.cm_per_deg)], CancelAfter(ticks))
+		self.assertFalse(completed)
+		self.assertAtSlider()
+
+		self.motor.move_dist_absolute(0.0)
+		self.assertAtSlider()
+		self.assertEqual(self.motor.slack, 0)
+
+	def test_cancel_during_take_up(self):
+		self.check_cancel_while_reversing(5)
+
+	def test_cancel_late_in_take_up(self):
+		self.check_cancel_while_reversing(20)
+
+	def test_cancel_after_take_up(self):
+		self.check_cancel_while_reversing(300)
+
+	# Turn back again before the slack was all taken up
+	def test_turn_back_during_take_up(self):
+		self.motor.move_dist_absolute(1.0)
+		move_together([(self.motor, -1.0 / self.motor.cm_per_deg)], CancelAfter(5))
+		self.motor.move_dist_absolute(2.0)
+		self.assertAtSlider()
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,153 @@
+"""
+Well plans
+
+A well plan is the list of wells to visit and the order to visit them in.
+Wells are named the Opentrons way (row letter then column number) and laid
+out by an Opentrons style "ordering": a list of columns, each listing its
+wells from top to bottom.
+
+Any subset of the plate can be selected, and the visiting order can be:
+- serpentine: down the first column, up the next, and so on
+- nearest: always go to the closest well not yet visited
+- 2-opt: nearest, then repeatedly untangle crossing legs of the path
+
+Distances are measured in wells along each axis and the larger of the two
+is used, because the table and carriage move at the same time.
+"""
+import re
+from string import ascii_uppercase
+
+# Visiting orders that can be picked from the GUI
+ORDERS = ("serpentine", "nearest", "2-opt")
+
+# Give up on improving a 2-opt path after this many passes
+TWO_OPT_MAX_PASSES = 50
+
+# Name of a row, A to Z then AA, AB, ... for large plates
+def row_name(row):
+	name = ""
+	row = row + 1
+	while row > 0:
+		row, remainder = divmod(row - 1, 26)
+		name = ascii_uppercase[remainder] + name
+	return name
+
+# Ordering for a plain grid of wells, in the same layout Opentrons uses
+def grid_ordering(rows, cols):
+	return [[row_name(r) + str(c + 1) for r in range(rows)] for c in range(cols)]
+
+# Turn text such as "A1-H6, A7, B7" into a list of well names
+# A range selects the block of wells between its two corners
+def parse_selection(text, positions):
+	wells = []
+	for token in re.split(r"[\s,]+", text.strip().upper()):
+		if token == "":
+			continue
+		corners = token.split("-")
+		for corner in corners:
+			if corner not in positions:
+				raise ValueError("Unknown well: " + corner)
+		if len(corners) == 1:
+			block = corners
+		elif len(corners) == 2:
+			(c1, r1), (c2, r2) = positions[corners[0]], positions[corners[1]]
+			cols = range(min(c1, c2), max(c1, c2) + 1)
+			rows = range(min(r1, r2), max(r1, r2) + 1)
+			block = [name for name, (c, r) in positions.items() if c in cols and r in rows]
+		else:
+			raise ValueError("Bad well range: " + token)
+		for name in block:
+			if name not in wells:
+				wells.append(name)
+	return wells
+
+"""
+WellPlan Class
+
+Holds the selected wells in visiting order along with their grid positions
+(column, row) on the plate.
+"""
+
+class WellPlan:
+	def __init__(self, ordering, wells=None, order="serpentine", distance=None):
+		self.positions = {}
+		for col, names in enumerate(ordering):
+			for row, name in enumerate(names):
+				self.positions[name] = (col, row)
+
+		# Distance between two wells, by default in wells along the slower axis
+		self.distance = distance if distance is not None else self.grid_distance
+
+		if wells is None:
+			wells = list(self.positions)
+		for name in wells:
+			if name not in self.positions:
+				raise ValueError("Unknown well: " + name)
+
+		self.wells = self.serpentine(wells)
+		if order == "nearest":
+			self.wells = self.nearest(self.wells)
+		elif order == "2-opt":
+			self.wells = self.two_opt(self.nearest(self.wells))
+		elif order != "serpentine":
+			raise ValueError("Unknown order: " + order)
+
+	def __len__(self):
+		return len(self.wells)
+
+	# Grid position (column, row) of the well at a point in the plan
+	def position(self, index):
+		return self.positions[self.wells[index]]
+
+	# Total distance travelled when following the plan
+	def travel(self):
+		return sum(self.distance(a, b) for a, b in zip(self.wells, self.wells[1:]))
+
+	def grid_distance(self, a, b):
+		(c1, r1), (c2, r2) = self.positions[a], self.positions[b]
+		return max(abs(c1 - c2), abs(r1 - r2))
+
+	# Column by column, alternating down and up, matching the original path
+	def serpentine(self, wells):
+		cols = sorted(set(self.positions[name][0] for name in wells))
+		flip = {col: i % 2 == 1 for i, col in enumerate(cols)}
+
+		def key(name):
+			col, row = self.positions[name]
+			return (col, -row if flip[col] else row)
+
+		return sorted(wells, key=key)
+
+	# Greedy path starting from the first well
+	def nearest(self, wells):
+		if not wells:
+			return []
+		remaining = list(wells[1:])
+		path = [wells[0]]
+		while remaining:
+			closest = min(remaining, key=lambda name: self.distance(path[-1], name))
+			remaining.remove(closest)
+			path.append(closest)
+		return path
+
+	# Reverse sections of an open path with a fixed start while that makes
+	# it shorter
+	def two_opt(self, path):
+		path = list(path)
+		n = len(path)
+		dist = self.distance
+		for _ in range(TWO_OPT_MAX_PASSES):
+			improved = False
+			for i in range(1, n - 1):
+				for j in range(i + 1, n):
+					before = dist(path[i - 1], path[i])
+					after = dist(path[i - 1], path[j])
+					if j + 1 < n:
+						before += dist(path[j], path[j + 1])
+						after += dist(path[i], path[j + 1])
+					if after < before:
+						path[i:j + 1] = path[i:j + 1][::-1]
+						improved = True
+			if not improved:
+				break
+		return path
@@ -0,0 +1,97 @@
+"""
+MotionWorker Class
+
+Runs motor moves one at a time on a background thread so the GUI stays
+responsive while the motors turn. Moves are queued as functions that take a
+cancel event and return True if they ran to completion. The event is set by
+cancel() and moves check it between steps, so a pause stops the motors
+within a step or two.
+
+Completion is reported through a results queue that the GUI thread drains
+with poll(), so callbacks always run on the thread that owns the widgets.
+"""
+import queue
+import threading
+import traceback
+
+class MotionWorker:
+	def __init__(self, synchronous=False):
+		self.commands = queue.Queue()
+		self.results = queue.Queue()
+		self.cancel_event = threading.Event()
+		self.lock = threading.Lock()
+
+		# Bumped on every cancel so queued moves from before it are dropped
+		self.generation = 0
+
+		# Optional function called from the worker whenever a result is
+		# ready, so an event loop can wake up and poll()
+		self.notify = None
+
+		# With a virtual clock there is nothing to wait for, so moves run
+		# straight away on the calling thread
+		self.synchronous = synchronous
+		self.thread = None
+		if not synchronous:
+			self.thread = threading.Thread(target=self.run, daemon=True)
+			self.thread.start()
+
+	# Queue a move
+	# on_done is called from poll() with True if the move completed
+	# or False if it was cancelled
+	def submit(self, function, on_done=None):
+		command = (self.generation, function, on_done)
+		if self.synchronous:
+			self.execute(command)
+		else:
+			self.commands.put(command)
+
+	# Stop the current move between steps and drop any queued moves
+	def cancel(self):
+		with self.lock:
+			self.generation += 1
+			self.cancel_event.set()
+
+	# Run the completion callbacks of any finished moves
+	# Must be called from the thread that should run the callbacks
+	def poll(self):
+		while True:
+			try:
+				on_done, completed = self.results.get_nowait()
+			except queue.Empty:
+				return
+			if on_done is not None:
+				on_done(completed)
+
+	# Wait for the queue to empty and shut the thread down
+	def stop(self):
+		if self.thread is not None:
+			self.commands.put((None, None, None))
+			self.thread.join()
+			self.thread = None
+
+	def execute(self, command):
+		generation, function, on_done = command
+		with self.lock:
+			cancelled = generation != self.generation
+			if not cancelled:
+				self.cancel_event.clear()
+		completed = False
+		if not cancelled:
+			try:
+				completed = function(self.cancel_event)
+			except Exception:
+				traceback.print_exc()
+		self.results.put((on_done, completed))
+		if self.notify is not None:
+			self.notify()
+
+	def run(self):
+		while True:
+			command = self.commands.get()
+			try:
+				if command[1] is None:
+					return
+				self.execute(command)
+			finally:
+				self.commands.task_done()